@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+
+Benchmark for reading MTpy time series (TS) data files.
+
+A synthetic TS file is written and read with np.loadtxt (the former 
+implementation of read_ts_file) and with the chunk-wise reader of 
+mtpy.utils.filehandling in different modes (float64/float32, sample range,
+binary sidecar cache).
+
+        optional arguments:
+        - number of samples (default 10 000 000)
+        - output directory (default: temporary directory, removed afterwards)
+
+"""
+
+import numpy as np
+import sys, os
+import os.path as op
+import time
+import tempfile
+import shutil
+
+import mtpy.utils.filehandling as MTfh
+
+
+def main():
+
+    nsamples = 10000000
+    outdir = None
+
+    if len(sys.argv) > 1:
+        nsamples = int(float(sys.argv[1]))
+    if len(sys.argv) > 2:
+        outdir = op.abspath(sys.argv[2])
+
+    remove_outdir = False
+    if outdir is None:
+        outdir = tempfile.mkdtemp()
+        remove_outdir = True
+    elif not op.isdir(outdir):
+        os.makedirs(outdir)
+
+    tsfile = op.join(outdir, 'bench.{0}.ex'.format(nsamples))
+    header_dict = {'station':'bench', 'channel':'ex', 'samplingrate':256.,
+                   't_min':0., 'nsamples':nsamples, 'unit':'mV', 'lat':0.,
+                   'lon':0., 'elev':0.}
+
+    print 'writing {0} samples to {1}'.format(nsamples, tsfile)
+    F = open(tsfile, 'w')
+    F.write(MTfh.get_ts_header_string(header_dict))
+    np.savetxt(F, np.random.normal(0, 1, nsamples), fmt='%.8e')
+    F.close()
+    print 'file size: {0:.1f} MB\n'.format(op.getsize(tsfile) / 1024.**2)
+
+    cachefile = MTfh.get_ts_cache_filename(tsfile)
+    if op.isfile(cachefile):
+        os.remove(cachefile)
+
+    lo_benchmarks = [
+        ('np.loadtxt', lambda: np.loadtxt(tsfile)),
+        ('read_ts_file float64', lambda: MTfh.read_ts_file(tsfile)),
+        ('read_ts_file float32', 
+            lambda: MTfh.read_ts_file(tsfile, dtype=np.float32)),
+        ('read_ts_file last 10%', 
+            lambda: MTfh.read_ts_file(tsfile, 
+                        sample_range=(int(0.9 * nsamples), None))),
+        ('read_ts_file cache (build)', 
+            lambda: MTfh.read_ts_file(tsfile, use_cache=True)),
+        ('read_ts_file cache (reuse)', 
+            lambda: MTfh.read_ts_file(tsfile, use_cache=True)),
+        ('read_ts_file cache (mmap)', 
+            lambda: MTfh.read_ts_file(tsfile, use_cache=True, mmap=True))]
+
+    reference = None
+    for name, function in lo_benchmarks:
+        t0 = time.time()
+        result = function()
+        seconds = time.time() - t0
+        if isinstance(result, tuple):
+            result = result[-1]
+        if reference is None:
+            reference = result
+        elif len(result) == nsamples:
+            if not np.allclose(result, reference, rtol=1e-6):
+                print 'WARNING - result of {0} differs'.format(name)
+        print '{0:<30} {1:8.3f} s  {2:10.1f} Msamples/s'.format(name, 
+                                    seconds, len(result) / seconds / 1e6)
+
+    if remove_outdir is True:
+        shutil.rmtree(outdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+
+"""
+mtpy/mtpy/analysis/uncertainty.py
+
+Monte Carlo estimation of uncertainties for quantities derived from the
+impedance tensor Z (phase tensor parameters, strike, resistivity and phase).
+
+Instead of perturbing Z and recomputing a PhaseTensor object once per
+realisation, all realisations of Z are drawn from its errors as one array
+of shape (n_realisations, n_freq, 2, 2) and pushed through vectorised
+kernels. Realisations are processed in chunks to bound the memory of the
+intermediate complex arrays; chunks can optionally be distributed over a
+pool of processes.
+
+    Functions:
+
+    - draw_z_realisations
+    - z2pt_array
+    - pt_parameters
+    - z2resphase_array
+    - z_parameters
+    - compute_realisations
+    - summarise_realisations
+    - monte_carlo_z
+    - monte_carlo_z_object
+    - monte_carlo_z_objects
+
+"""
+
+#=================================================================
+import numpy as np
+import multiprocessing
+
+import mtpy.utils.exceptions as MTex
+
+#=================================================================
+
+#default number of realisations evaluated at once
+chunk_size_default = 1000
+
+#default percentiles reported in the summary
+percentiles_default = (2.5, 16., 50., 84., 97.5)
+
+#names of all parameters returned by z_parameters
+lo_parameters = ['phimin', 'phimax', 'alpha', 'beta', 'azimuth',
+                 'ellipticity', 'skew', 'resxy', 'resyx', 'phasexy',
+                 'phaseyx']
+
+#=================================================================
+
+
+def draw_z_realisations(z_array, zerr_array, n_realisations,
+                        sigma_scaling=1., random_state=None):
+    """
+        Draw realisations of Z from its uncertainties.
+
+        Real and imaginary parts of each component are perturbed
+        independently by normally distributed values with standard
+        deviation sigma_scaling * Zerr.
+
+        Input:
+        - z_array : complex Numpy array (n_freq, 2, 2)
+        - zerr_array : real Numpy array (n_freq, 2, 2), stddev of Z
+        - n_realisations : number of realisations
+
+        Optional:
+        - sigma_scaling : factor applied to Zerr
+        - random_state : np.random.RandomState instance (or seed)
+
+        Return:
+        - complex Numpy array (n_realisations, n_freq, 2, 2)
+    """
+
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+
+    z_array = np.asarray(z_array)
+    sigma = sigma_scaling * np.real(np.asarray(zerr_array))
+
+    shape = (int(n_realisations),) + z_array.shape
+    noise = np.empty(shape, dtype='complex')
+    noise.real = random_state.standard_normal(shape)
+    noise.imag = random_state.standard_normal(shape)
+    noise *= sigma
+
+    noise += z_array
+
+    return noise
+
+
+def z2pt_array(z_array):
+    """
+        Calculate Phase Tensors for an arbitrary stack of Z matrices.
+
+        Input:
+        - z_array : complex Numpy array (..., 2, 2)
+
+        Return:
+        - PT : real Numpy array (..., 2, 2); entries for singular
+               real parts of Z are set to NaN
+    """
+
+    realz = np.real(z_array)
+    imagz = np.imag(z_array)
+
+    detreal = realz[..., 0, 0] * realz[..., 1, 1] - \
+              realz[..., 0, 1] * realz[..., 1, 0]
+    detreal = np.where(detreal == 0, np.nan, detreal)
+
+    pt_array = np.empty(realz.shape)
+    pt_array[..., 0, 0] = realz[..., 1, 1] * imagz[..., 0, 0] - \
+                          realz[..., 0, 1] * imagz[..., 1, 0]
+    pt_array[..., 0, 1] = realz[..., 1, 1] * imagz[..., 0, 1] - \
+                          realz[..., 0, 1] * imagz[..., 1, 1]
+    pt_array[..., 1, 0] = realz[..., 0, 0] * imagz[..., 1, 0] - \
+                          realz[..., 1, 0] * imagz[..., 0, 0]
+    pt_array[..., 1, 1] = realz[..., 0, 0] * imagz[..., 1, 1] - \
+                          realz[..., 1, 0] * imagz[..., 0, 1]
+
+    pt_array /= detreal[..., np.newaxis, np.newaxis]
+
+    return pt_array
+
+
+def pt_parameters(pt_array):
+    """
+        Calculate Phase Tensor parameters for a stack of PT matrices.
+
+        All angles follow the definitions of the PhaseTensor class
+        (Caldwell et al., 2004; Bibby et al., 2005) and are given in degrees.
+
+        Input:
+        - PT : real Numpy array (..., 2, 2)
+
+        Return:
+        - dictionary with keys phimin, phimax, alpha, beta, azimuth,
+          ellipticity, skew - each a Numpy array of shape (...)
+    """
+
+    p00 = pt_array[..., 0, 0]
+    p01 = pt_array[..., 0, 1]
+    p10 = pt_array[..., 1, 0]
+    p11 = pt_array[..., 1, 1]
+
+    pi1 = 0.5 * np.sqrt((p00 - p11)**2 + (p01 + p10)**2)
+    pi2 = 0.5 * np.sqrt((p00 + p11)**2 + (p01 - p10)**2)
+
+    param_dict = {}
+    param_dict['phimin'] = np.degrees(np.arctan(pi2 - pi1))
+    param_dict['phimax'] = np.degrees(np.arctan(pi2 + pi1))
+    param_dict['alpha'] = np.degrees(0.5 * np.arctan2(p01 + p10, p00 - p11))
+    param_dict['beta'] = np.degrees(0.5 * np.arctan2(p01 - p10, p00 + p11))
+    param_dict['azimuth'] = param_dict['alpha'] - param_dict['beta']
+    param_dict['ellipticity'] = (param_dict['phimax'] - param_dict['phimin'])/\
+                                (param_dict['phimax'] + param_dict['phimin'])
+    param_dict['skew'] = p01 - p10
+
+    return param_dict
+
+
+def z2resphase_array(z_array, freq):
+    """
+        Calculate apparent resistivity and phase for a stack of Z matrices.
+
+        Input:
+        - z_array : complex Numpy array (..., n_freq, 2, 2)
+        - freq : Numpy array (n_freq)
+
+        Return:
+        - resistivity in Ohm m : Numpy array (..., n_freq, 2, 2)
+        - phase in degrees : Numpy array (..., n_freq, 2, 2)
+    """
+
+    freq = np.asarray(freq, dtype='float')
+
+    resistivity = 0.2 * np.abs(z_array)**2 / freq[:, np.newaxis, np.newaxis]
+    phase = np.degrees(np.angle(z_array))
+
+    return resistivity, phase
+
+
+def z_parameters(z_array, freq):
+    """
+        Calculate all Z derived parameters handled by the Monte Carlo engine.
+
+        Input:
+        - z_array : complex Numpy array (..., n_freq, 2, 2)
+        - freq : Numpy array (n_freq)
+
+        Return:
+        - dictionary (keys as in 'lo_parameters') of Numpy arrays (..., n_freq)
+    """
+
+    param_dict = pt_parameters(z2pt_array(z_array))
+
+    resistivity, phase = z2resphase_array(z_array, freq)
+    param_dict['resxy'] = resistivity[..., 0, 1]
+    param_dict['resyx'] = resistivity[..., 1, 0]
+    param_dict['phasexy'] = phase[..., 0, 1]
+    param_dict['phaseyx'] = phase[..., 1, 0]
+
+    return param_dict
+
+
+def _realisation_chunk(args):
+    """
+        Draw one chunk of realisations of Z with its own seed and return
+        their derived parameters (see z_parameters).
+    """
+
+    z_array, zerr_array, freq, n_realisations, sigma_scaling, seed = args
+
+    z_real = draw_z_realisations(z_array, zerr_array, n_realisations,
+                                 sigma_scaling=sigma_scaling,
+                                 random_state=seed)
+
+    return z_parameters(z_real, freq)
+
+
+def compute_realisations(z_array, zerr_array, freq, n_realisations,
+                         sigma_scaling=1., chunk_size=chunk_size_default,
+                         n_processes=1, seed=None):
+    """
+        Evaluate Z derived parameters for realisations of Z.
+
+        Realisations are drawn and evaluated in chunks of 'chunk_size', so
+        that only one chunk of complex Z and PT arrays is held in memory
+        per process. Each chunk gets its own random seed (derived from
+        'seed'), so results are reproducible independent of the number
+        of processes.
+
+        Input:
+        - z_array : complex Numpy array (n_freq, 2, 2)
+        - zerr_array : real Numpy array (n_freq, 2, 2)
+        - freq : Numpy array (n_freq)
+        - n_realisations : number of realisations
+
+        Optional:
+        - sigma_scaling : factor applied to Zerr
+        - chunk_size : number of realisations evaluated at once
+        - n_processes : number of worker processes (1 = no pool)
+        - seed : seed for the random number generator
+
+        Return:
+        - dictionary of Numpy arrays (n_realisations, n_freq)
+    """
+
+    z_array = np.asarray(z_array)
+    if z_array.ndim == 2:
+        z_array = z_array.reshape((1, 2, 2))
+    if zerr_array is None:
+        raise MTex.MTpyError_Z('Monte Carlo evaluation requires Z errors')
+    zerr_array = np.real(np.asarray(zerr_array)).reshape(z_array.shape)
+    freq = np.array(freq, dtype='float').reshape(len(z_array))
+
+    n_realisations = int(n_realisations)
+    if n_realisations <= 0:
+        raise MTex.MTpyError_inputarguments('number of realisations must be '
+                                            'a positive integer')
+    chunk_size = max(1, int(chunk_size))
+
+    lo_chunks = [chunk_size] * (n_realisations // chunk_size)
+    if n_realisations % chunk_size != 0:
+        lo_chunks.append(n_realisations % chunk_size)
+
+    lo_seeds = np.random.RandomState(seed).randint(0, 2**31 - 1,
+                                                    size=len(lo_chunks))
+
+    lo_args = [(z_array, zerr_array, freq, n_chunk, sigma_scaling, s)
+               for n_chunk, s in zip(lo_chunks, lo_seeds)]
+
+    if n_processes is None or n_processes > 1:
+        pool = multiprocessing.Pool(processes=n_processes)
+        try:
+            lo_results = pool.map(_realisation_chunk, lo_args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        lo_results = [_realisation_chunk(args) for args in lo_args]
+
+    realisations = {}
+    for key in lo_results[0].keys():
+        realisations[key] = np.concatenate([r[key] for r in lo_results])
+
+    return realisations
+
+
+def summarise_realisations(realisations, percentiles=percentiles_default):
+    """
+        Summarise Monte Carlo realisations per parameter and frequency.
+
+        NaN values (e.g. from singular realisations) are ignored.
+
+        Input:
+        - realisations : dictionary of Numpy arrays (n_realisations, n_freq)
+
+        Optional:
+        - percentiles : sequence of percentiles (0-100)
+
+        Return:
+        - dictionary of dictionaries, e.g. summary['phimin']['std'], with keys
+          mean, std, median, mad (median absolute deviation) and
+          percentiles (Numpy array (n_percentiles, n_freq)), as well as
+          the summary level entry 'percentile_levels'
+    """
+
+    summary = {'percentile_levels': np.array(percentiles, dtype='float')}
+
+    for key, values in realisations.items():
+        median = np.nanmedian(values, axis=0)
+        summary[key] = {'mean': np.nanmean(values, axis=0),
+                        'std': np.nanstd(values, axis=0),
+                        'median': median,
+                        'mad': np.nanmedian(np.abs(values - median), axis=0),
+                        'percentiles': np.nanpercentile(values, percentiles,
+                                                        axis=0)}
+
+    return summary
+
+
+def monte_carlo_z(z_array, zerr_array, freq, n_realisations,
+                  sigma_scaling=1., chunk_size=chunk_size_default,
+                  n_processes=1, seed=None, percentiles=percentiles_default,
+                  return_realisations=False):
+    """
+        Monte Carlo uncertainty estimation for Z derived parameters.
+
+        Input:
+        - z_array : complex Numpy array (n_freq, 2, 2)
+        - zerr_array : real Numpy array (n_freq, 2, 2)
+        - freq : Numpy array (n_freq)
+        - n_realisations : number of realisations
+
+        Optional:
+        - sigma_scaling, chunk_size, n_processes, seed :
+                        see 'compute_realisations'
+        - percentiles : see 'summarise_realisations'
+        - return_realisations : additionally return all realisations
+
+        Return:
+        - summary dictionary (see 'summarise_realisations')
+        - (dictionary of realisations, if return_realisations is True)
+    """
+
+    realisations = compute_realisations(z_array, zerr_array, freq,
+                                        n_realisations,
+                                        sigma_scaling=sigma_scaling,
+                                        chunk_size=chunk_size,
+                                        n_processes=n_processes, seed=seed)
+
+    summary = summarise_realisations(realisations, percentiles=percentiles)
+
+    if return_realisations is True:
+        return summary, realisations
+
+    return summary
+
+
+def monte_carlo_z_object(z_object, n_realisations, **kwargs):
+    """
+        Monte Carlo uncertainty estimation for an MTpy Z object.
+
+        Keyword arguments are passed on to 'monte_carlo_z'.
+    """
+
+    if z_object.z is None or z_object.freq is None:
+        raise MTex.MTpyError_Z('Z object must contain z and freq')
+
+    return monte_carlo_z(z_object.z, z_object.zerr, z_object.freq,
+                         n_realisations, **kwargs)
+
+
+def monte_carlo_z_objects(z_object_dict, n_realisations, **kwargs):
+    """
+        Monte Carlo uncertainty estimation for several stations.
+
+        Input:
+        - z_object_dict : dictionary {station name : MTpy Z object}
+        - n_realisations : number of realisations per station
+
+        Keyword arguments are passed on to 'monte_carlo_z'.
+
+        Return:
+        - dictionary {station name : summary dictionary}
+    """
+
+    summaries = {}
+    for station in sorted(z_object_dict.keys()):
+        summaries[station] = monte_carlo_z_object(z_object_dict[station],
+                                                  n_realisations, **kwargs)
+
+    return summaries
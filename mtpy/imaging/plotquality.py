@@ -22,7 +22,55 @@ import os.path as op
 
 import copy
 
+import matplotlib.pyplot as plt
+
 import mtpy.processing.quality as MTq
 import  mtpy.utils.exceptions as MTexceptions
 
 #=================================================================
+
+def plot_quality_table(table, metrics=['rms', 'n_spikes', 'n_clipped', 
+                                        'powerline_ratio'], fig_num=1):
+    """
+    Plot the per-window data quality metrics of a summary table (see 
+    mtpy.processing.quality) over time, one panel per metric and one line 
+    per station/channel. Windows flagged as dropouts are marked with 
+    crosses.
+
+    input:
+    - summary table or name of a file written by 
+      mtpy.processing.quality.write_quality_table
+    - list of metrics (fields of the table)
+    - figure number
+
+    output:
+    - matplotlib figure
+
+    """
+
+    if isinstance(table, str):
+        table = MTq.read_quality_table(table, mmap=True)
+
+    fig = plt.figure(fig_num)
+    fig.clf()
+
+    lo_keys = sorted(set(zip(table['station'], table['channel'])))
+
+    for ii, metric in enumerate(metrics):
+        ax = fig.add_subplot(len(metrics), 1, ii + 1)
+        for station, channel in lo_keys:
+            rows = table[(table['station'] == station) & 
+                         (table['channel'] == channel)]
+            line = ax.plot(rows['t_start'], rows[metric], 
+                           label='{0} {1}'.format(station, channel))[0]
+            dropout = rows['dropout']
+            if np.any(dropout):
+                ax.plot(rows['t_start'][dropout], rows[metric][dropout], 'x',
+                        color=line.get_color())
+        ax.set_ylabel(metric)
+        if ii == 0:
+            ax.legend(loc='best', fontsize='small')
+
+    ax.set_xlabel('time (s)')
+
+    return fig
@@ -30,9 +30,12 @@ import numpy as np
 import sys, os
 import os.path as op
 import copy
+import time
+import multiprocessing
 
 import  mtpy.utils.exceptions as MTex
 import mtpy.utils.configfile as MTcf
+import mtpy.utils.filehandling as MTfh
 
 #=================================================================
 
@@ -381,7 +384,7 @@ def calibrate_file(filename, outdir, instrument, instrument_amplification,
                                                 additional_header_info)
 
 
-    if time_axis != None:
+    if time_axis is not None:
         data_out[:,1] = outfile_data
     else:
         data_out = outfile_data
@@ -407,6 +410,17 @@ def _data_instrument_consistency_check(data, field, dipole_length, instrument,
     if len(data) == 0 :
         raise MTex.MTpyError_ts_data( 'no data provided for calibration' )
 
+    _calibration_parameter_check(field, dipole_length, instrument, 
+                                 amplification, logger, gain)
+
+
+def _calibration_parameter_check(field, dipole_length, instrument, 
+                                 amplification, logger, gain):
+    """
+    Check, if the calibration parameters make any sense at all.
+
+    """
+
     if not field.lower() in ['e','b']:
         raise MTex.MTpyError_inputarguments( 'Field must be E or B' )
 
@@ -446,6 +460,363 @@ def _data_instrument_consistency_check(data, field, dipole_length, instrument,
             raise MTex.MTpyError_inputarguments( 'wrong choice of instrument')
 
 
+#=================================================================
+# Streaming (batch) calibration
+
+def get_calibration_factor(channel, instrument, instrument_amplification, 
+                           logger, gain, dipole):
+    """
+    Return the conversion factor from raw data to field values and the 
+    unit of the calibrated data for one channel.
+
+    The factor combines the logger gain, the dipole length and the 
+    instrument amplification (incl. the reduced amplification of fluxgate 
+    BZ channels at the EDL) in the same way as calibrate_file, so that a 
+    chunk of data is calibrated by one single multiplication.
+
+    input:
+    - channel ('ex', 'ey', 'bx', 'by', 'bz')
+    - instrument type
+    - instrument amplification factor
+    - data logger type
+    - logger gain factor (value or EDL gain level string)
+    - dipole length in meters (ignored for B-field channels)
+
+    output:
+    - conversion factor (float)
+    - data unit ('microvoltpermeter' or 'nanotesla')
+
+    """
+
+    channel = str(channel).lower()
+    if not channel in list_of_channels:
+        raise MTex.MTpyError_inputarguments('wrong channel specification')
+
+    field = channel[0]
+    instrument = instrument.lower()
+    logger = logger.lower()
+
+    if not instrument in list_of_instruments:
+        raise MTex.MTpyError_inputarguments('instrument type not known')
+
+    if not logger in list_of_loggers:
+        raise MTex.MTpyError_inputarguments('data logger type not known')
+
+    if type(gain) == str:
+        if logger != 'edl' or not gain in dict_of_EDL_gain_factors:
+            raise MTex.MTpyError_inputarguments('invalid gain for {0}: '
+                                                '{1}'.format(logger, gain))
+        gain = dict_of_EDL_gain_factors[gain]
+
+    gain = float(gain)
+    amplification = float(instrument_amplification)
+
+    if field == 'e':
+        dipole = float(dipole)
+        if dipole <= 1:
+            raise MTex.MTpyError_inputarguments('Check dipole length value !'
+                            ' - It is highly improbable to have a {0} meter '
+                            'dipole!!'.format(dipole))
+        instrument = 'electrodes'
+        dataunit = 'microvoltpermeter'
+
+    else:
+        if not instrument in list_of_bfield_instruments:
+            raise MTex.MTpyError_inputarguments('invalid instrument for B-'
+                                                'field measurements')
+        if not logger in list_of_bfield_loggers:
+            raise MTex.MTpyError_inputarguments('invalid logger for B-field'
+                                                ' measurements')
+        if instrument == 'fluxgate' and channel == 'bz':
+            amplification *= dict_of_bz_instrument_amplification[logger]
+        dipole = 1.
+        dataunit = 'nanotesla'
+
+    _calibration_parameter_check(field, dipole, instrument, amplification,
+                                 logger, gain)
+
+    return 1. / dipole / amplification / gain, dataunit
+
+
+def calibrate_file_streaming(filename, outdir, instrument, 
+                    instrument_amplification, logger, gain, dipole, 
+                    stationname, channel, latitude, longitude, elevation, 
+                    offset=0, binary=False, dtype='float32', fmt='%.8e', 
+                    chunksize=2**20):
+    """
+    Calibrate data from one given file and store the output to another file
+    without holding the whole time series in memory.
+
+    Works like calibrate_file, but the data are streamed through the 
+    calibration in chunks of 'chunksize' samples, each chunk being converted
+    by one multiplication with the factor from get_calibration_factor. The 
+    input may be a raw ASCII file (1 column, or 2 columns time/data) or an
+    MTpy ASCII/binary TS file. If 'binary' is True, the output is an MTpy 
+    binary TS file of type 'dtype' (time axis dropped), otherwise an ASCII 
+    file written with format 'fmt'.
+
+    An invalid dipole length raises an error instead of asking for 
+    confirmation, so that the function can run unattended.
+
+    input:
+    - see calibrate_file
+
+    output:
+    - name of the calibrated file
+    - number of calibrated samples
+
+    """
+
+    if not op.isfile(filename):
+        raise MTex.MTpyError_inputarguments('data file not existing')
+
+    if channel is None:
+        channel = filename[-2:].lower()
+
+    factor, dataunit = get_calibration_factor(channel, instrument, 
+                                instrument_amplification, logger, gain, dipole)
+
+    if not op.isdir(outdir):
+        try:
+            os.makedirs(outdir)
+        except OSError:
+            #may have been generated by another process in the meantime
+            if not op.isdir(outdir):
+                raise MTex.MTpyError_inputarguments('output directory is not '
+                                            'existing and cannot be generated')
+
+    try:
+        header = MTfh.read_ts_header(filename)
+    except MTex.MTpyError_ts_data:
+        header = {}
+
+    if not 'station' in header:
+        header['station'] = stationname
+    if not 'channel' in header:
+        header['channel'] = channel
+    header['unit'] = dataunit
+    header['lat'] = '{0:02.5f}'.format(latitude)
+    header['lon'] = '{0:03.5f}'.format(longitude)
+    header['elev'] = '{0:.1f}'.format(elevation)
+
+    infile_base = op.basename(filename)
+    newbasename = '{0}_{1}.{2}'.format(op.splitext(infile_base)[0], dataunit, 
+                                infile_base.split('.')[-1].lower())
+    if binary is True and not newbasename.endswith('.bin'):
+        newbasename += '.bin'
+    outfile = op.join(outdir, newbasename)
+
+    nsamples = 0
+    Fout = open(outfile, 'wb')
+    try:
+        if binary is True:
+            Fout.write(MTfh.get_ts_binary_header_block(header, dtype))
+        else:
+            Fout.write(MTfh.get_ts_header_string(header))
+
+        for chunk in MTfh.iter_ts_data_chunks(filename, chunksize):
+            #at least 2 columns - assume, first is time, second data
+            data = chunk[:, min(1, chunk.shape[1] - 1)]
+            if offset != 0:
+                data -= offset
+            data *= factor
+
+            if binary is True:
+                data.astype(MTfh.dict_of_ts_binary_dtypes[dtype]).tofile(Fout)
+            else:
+                np.savetxt(Fout, chunk, fmt=fmt)
+            nsamples += len(data)
+
+        if binary is True:
+            #header must contain the actual number of samples
+            header['nsamples'] = nsamples
+            Fout.seek(0)
+            Fout.write(MTfh.get_ts_binary_header_block(header, dtype))
+    finally:
+        Fout.close()
+
+    if nsamples == 0:
+        raise MTex.MTpyError_ts_data('no data provided for calibration')
+
+    return outfile, nsamples
+
+
+def _get_calibration_parameters(header, stationdict):
+    """
+    Return the keyword arguments for calibrate_file_streaming for a file 
+    with the given TS header from the station's section of the survey 
+    configuration file - or None, if the channel is not calibrated for 
+    this station type.
+
+    """
+
+    channel = header['channel'].lower()
+    field = channel[0]
+    station_type = stationdict['station_type']
+
+    parameters = {'stationname': header['station'].upper(), 
+                  'channel': channel,
+                  'latitude': float(stationdict['latitude']),
+                  'longitude': float(stationdict['longitude']),
+                  'elevation': float(stationdict['elevation'])}
+
+    if field == 'e':
+        if station_type == 'b':
+            return None
+        if channel[1] == 'x':
+            parameters['dipole'] = float(stationdict['e_xaxis_length'])
+        else:
+            parameters['dipole'] = float(stationdict['e_yaxis_length'])
+        parameters['logger'] = stationdict['e_logger_type']
+        parameters['gain'] = float(stationdict['e_logger_gain'])
+        parameters['instrument'] = stationdict.get('e_instrument_type',
+                                                   'electrodes')
+        parameters['instrument_amplification'] = float(
+                                    stationdict['e_instrument_amplification'])
+    else:
+        if station_type == 'e':
+            return None
+        parameters['dipole'] = 1.
+        parameters['logger'] = stationdict['b_logger_type']
+        parameters['gain'] = float(stationdict['b_logger_gain'])
+        parameters['instrument'] = stationdict.get('b_instrument_type','coil')
+        parameters['instrument_amplification'] = float(
+                                    stationdict['b_instrument_amplification'])
+
+    return parameters
+
+
+def _calibrate_file_task(task):
+    """
+    Calibrate one file for batch_calibrate with calibrate_file_streaming.
+    Return (filename, output file or None on failure, number of samples, 
+    time taken in s).
+
+    """
+
+    filename, outdir, kwargs = task
+
+    t0 = time.time()
+    try:
+        outfile, nsamples = calibrate_file_streaming(filename, outdir, 
+                                                     **kwargs)
+    except (MTex.MTpyError_inputarguments, MTex.MTpyError_ts_data, 
+            IOError, ValueError) as e:
+        print 'could not calibrate file {0}: {1}'.format(filename, e)
+        return filename, None, 0, time.time() - t0
+
+    return filename, outfile, nsamples, time.time() - t0
+
+
+def batch_calibrate(dirpath, configfile, outdir=None, stationname=None,
+                    recursive=True, binary=False, n_processes=1, 
+                    chunksize=2**20, dtype='float32', fmt='%.8e'):
+    """
+    Calibrate all MTpy TS data files in a directory (tree).
+
+    Files are selected by their header (channel 'ex', 'ey', 'bx', 'by' or 
+    'bz' and - if given - station name 'stationname'), files with a 
+    calibrated data unit in the header are skipped. The calibration 
+    parameters of each file are taken from the survey configuration file 
+    (see mtpy.utils.calibratefiles) and the files are calibrated with 
+    calibrate_file_streaming, distributed over 'n_processes' worker 
+    processes. Files which cannot be calibrated are reported and skipped.
+
+    input:
+    - directory containing the data files
+    - survey configuration file
+    - output directory (default: '<dirpath>/calibrated')
+    - station name (optional)
+    - recursive flag - include subdirectories of 'dirpath'
+    - binary flag, 'dtype', 'fmt' and 'chunksize' - see 
+      calibrate_file_streaming
+    - number of worker processes
+
+    output:
+    - list of tuples (input file, output file, number of samples, 
+      processing time in seconds) - output file is None for failed files
+
+    """
+
+    dirpath = op.abspath(dirpath)
+    if not op.isdir(dirpath):
+        raise MTex.MTpyError_inputarguments('Data file(s) path not '
+                                            'existing: {0}'.format(dirpath))
+
+    if outdir is None:
+        outdir = op.join(dirpath, 'calibrated')
+    outdir = op.abspath(outdir)
+
+    config_dict = MTcf.read_survey_configfile(configfile)
+
+    if recursive is True:
+        lo_dirs = [root for root, dirs, files in os.walk(dirpath)]
+    else:
+        lo_dirs = [dirpath]
+
+    lo_tasks = []
+    for folder in sorted(lo_dirs):
+        #do not calibrate former output again
+        if folder == outdir or folder.startswith(outdir + os.sep):
+            continue
+        for fn in sorted(os.listdir(folder)):
+            filename = op.join(folder, fn)
+            if not op.isfile(filename):
+                continue
+            try:
+                header = MTfh.read_ts_header(filename)
+                if not header['channel'].lower() in list_of_channels:
+                    continue
+                #skip data, which have been calibrated already
+                if header.get('unit') in ['microvoltpermeter', 'nanotesla']:
+                    continue
+                station = header['station'].upper()
+            except Exception:
+                continue
+            if stationname is not None and stationname.upper() != station:
+                continue
+            if not station in config_dict:
+                print 'no entry for station {0} found in configuration file'\
+                      ' {1} skipping file {2}'.format(station, configfile,
+                                                     filename)
+                continue
+
+            kwargs = _get_calibration_parameters(header, config_dict[station])
+            if kwargs is None:
+                continue
+            kwargs.update({'binary': binary, 'dtype': dtype, 'fmt': fmt, 
+                           'chunksize': chunksize})
+            lo_tasks.append((filename, outdir, kwargs))
+
+    if len(lo_tasks) == 0:
+        print 'Directory(ies) do(es) not contain files to calibrate: '\
+              '{0}'.format(dirpath)
+        return []
+
+    t0 = time.time()
+    if n_processes > 1:
+        pool = multiprocessing.Pool(n_processes)
+        try:
+            lo_results = pool.map(_calibrate_file_task, lo_tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        lo_results = [_calibrate_file_task(task) for task in lo_tasks]
+    total_time = time.time() - t0
+
+    for infile, outfile, nsamples, seconds in lo_results:
+        if outfile is None:
+            continue
+        print 'read file {0}  ->  wrote file {1} ({2} samples, {3:.2f} s, '\
+              '{4:.1f} Msamples/s)'.format(infile, outfile, nsamples, seconds,
+                                    nsamples / max(seconds, 1e-9) / 1e6)
+
+    n_calibrated = len([r for r in lo_results if r[1] is not None])
+    print '{0} of {1} files calibrated in {2:.2f} s'.format(n_calibrated, 
+                                                len(lo_tasks), total_time)
+
+    return lo_results
 
 
 
@@ -25,5 +25,530 @@ import copy
 
 
 import  mtpy.utils.exceptions as MTex
+import mtpy.utils.filehandling as MTfh
 
 #=================================================================
+
+def get_bands(df, nfft, n_bands=8, fmin=None, fmax=None):
+    """
+    Get logarithmically spaced frequency bands for coherence estimation.
+
+    input:
+    - sampling rate in Hz
+    - length of the FFT segments
+    - number of bands
+    - lowest and highest frequency (default: second frequency bin and 
+      Nyquist frequency)
+
+    output:
+    - list of (fmin, fmax) tuples
+
+    """
+
+    if fmin is None:
+        fmin = 2. * df / nfft
+    if fmax is None:
+        fmax = df / 2.
+
+    edges = np.logspace(np.log10(fmin), np.log10(fmax), n_bands + 1)
+
+    return [(edges[i], edges[i + 1]) for i in range(n_bands)]
+
+
+def get_channel_pairs(n_channels, remote_channels=None):
+    """
+    Get the index pairs of all channels for coherence estimation.
+
+    Without remote channels all pairs (i, j), i < j, are returned. With a 
+    list of remote channel indices, the pairs among the local channels are
+    followed by all pairs of a local and a remote channel.
+
+    """
+
+    if remote_channels is None:
+        remote_channels = []
+    local_channels = [i for i in range(n_channels) 
+                      if i not in remote_channels]
+
+    lo_pairs = [(i, j) for i in local_channels for j in local_channels 
+                if i < j]
+    lo_pairs += [(i, j) for i in local_channels for j in remote_channels]
+
+    return lo_pairs
+
+
+class CoherenceEstimator(object):
+    """
+    Welch-style magnitude-squared coherence of multichannel time series 
+    over sliding windows, for data that come in consecutive chunks.
+
+    The time series are cut into segments of nfft samples (overlapping by
+    'overlap'), which are demeaned, Hann tapered and Fourier transformed 
+    all at once. For each segment and frequency band the cross spectral 
+    matrix of all channels is summed over the band. A coherence window 
+    consists of 'window_segments' consecutive segments and windows are 
+    'step_segments' segments apart, so that each segment is transformed 
+    only once, no matter how many windows it belongs to. The coherence of 
+    channels i and j in a window and band is
+
+        |S_ij|**2 / (S_ii * S_jj)
+
+    with the spectra S summed over the segments of the window and the 
+    frequencies of the band. Memory only depends on the chunk and window 
+    lengths.
+
+    Arguments:
+    ----------
+        **n_channels** : int
+                         number of channels (columns of the chunks)
+
+        **df** : float
+                 sampling rate in Hz
+
+        **bands** : list
+                    [(fmin, fmax), ...] frequency bands in Hz. *default* is
+                    get_bands(df, nfft)
+
+        **pairs** : list
+                    [(i, j), ...] channel index pairs. *default* is 
+                    get_channel_pairs(n_channels)
+
+        **nfft** : int
+                   segment length. *default* is 256
+
+        **overlap** : float
+                      overlap of the segments as a fraction of nfft. 
+                      *default* is 0.5
+
+        **window_segments** : int
+                              number of segments per window. *default* 
+                              is 16
+
+        **step_segments** : int
+                            step between windows in segments. *default* 
+                            is window_segments/2
+
+    Attributes:
+    -----------
+        **window_len** : number of samples in a window
+
+        **window_step** : number of samples between window starts
+
+        **n_processed** : number of samples processed
+
+    ..Example: ::
+
+        >>> import mtpy.processing.coherence as MTcoh
+        >>> ce = MTcoh.CoherenceEstimator(4, 256.)
+        >>> for chunk in chunks:
+        >>> ...    starts, coherence = ce.process(chunk)
+
+    """
+
+    def __init__(self, n_channels, df, bands=None, pairs=None, nfft=256, 
+                 overlap=0.5, window_segments=16, step_segments=None):
+
+        self.n_channels = int(n_channels)
+        self.df = float(df)
+        self.nfft = int(nfft)
+        self.segment_step = max(1, int(round(self.nfft * (1. - overlap))))
+        self.window_segments = int(window_segments)
+        if step_segments is None:
+            step_segments = max(1, self.window_segments // 2)
+        self.step_segments = int(step_segments)
+
+        if bands is None:
+            bands = get_bands(self.df, self.nfft)
+        if pairs is None:
+            pairs = get_channel_pairs(self.n_channels)
+        self.bands = list(bands)
+        self.pairs = list(pairs)
+        if len(self.pairs) == 0:
+            raise MTex.MTpyError_inputarguments('no channel pairs given')
+
+        #frequency bins of the bands
+        freqs = np.fft.rfftfreq(self.nfft, 1. / self.df)
+        self._band_bins = []
+        for fmin, fmax in self.bands:
+            bins = np.flatnonzero((freqs >= fmin) & (freqs < fmax))
+            if len(bins) == 0:
+                raise MTex.MTpyError_inputarguments('frequency band {0}-{1}'
+                    ' Hz contains no frequencies of a {2} point FFT'.format(
+                    fmin, fmax, self.nfft))
+            self._band_bins.append(slice(bins[0], bins[-1] + 1))
+
+        self._ia = np.array([pair[0] for pair in self.pairs])
+        self._ib = np.array([pair[1] for pair in self.pairs])
+        #periodic Hann window
+        self._taper = np.hanning(self.nfft + 1)[:-1, np.newaxis]
+
+        self.window_len = (self.window_segments - 1) * self.segment_step + \
+                          self.nfft
+        self.window_step = self.step_segments * self.segment_step
+        self.n_processed = 0
+
+        #samples not yet used for a segment, index of their first segment
+        self._buffer = np.zeros((0, self.n_channels))
+        self._n_segments = 0
+        #band spectra of the segments of windows not complete yet
+        self._cross = np.zeros((0, len(self.bands), len(self.pairs)), 
+                               dtype=np.complex)
+        self._auto = np.zeros((0, len(self.bands), self.n_channels))
+        self._first_segment = 0
+        self._next_window = 0
+
+    def _segment_spectra(self, data, n_segments):
+        """
+        band summed cross and auto spectra of the segments of data, 
+        returns arrays (n_segments, n_bands, n_pairs) and 
+        (n_segments, n_bands, n_channels).
+        """
+
+        s0, s1 = data.strides
+        segments = np.lib.stride_tricks.as_strided(data, 
+                            shape=(n_segments, self.nfft, self.n_channels),
+                            strides=(self.segment_step * s0, s0, s1))
+        segments = segments - segments.mean(axis=1)[:, np.newaxis, :]
+        segments *= self._taper
+        spectra = np.fft.rfft(segments, axis=1)
+
+        cross = np.empty((n_segments, len(self.bands), len(self.pairs)),
+                         dtype=np.complex)
+        auto = np.empty((n_segments, len(self.bands), self.n_channels))
+        for ii, band in enumerate(self._band_bins):
+            band_spectra = spectra[:, band, :]
+            cross[:, ii, :] = (band_spectra[:, :, self._ia] * 
+                               band_spectra[:, :, self._ib].conj()).sum(axis=1)
+            auto[:, ii, :] = (band_spectra.real**2 + 
+                              band_spectra.imag**2).sum(axis=1)
+
+        return cross, auto
+
+    def process(self, chunk):
+        """
+        add the next chunk of the time series (array of shape 
+        (n_samples, n_channels)).
+
+        Returns:
+        --------
+            **starts** : np.ndarray
+                         index of the first sample of each window completed
+                         with this chunk
+
+            **coherence** : np.ndarray
+                            coherence of these windows, shape 
+                            (n_windows, n_bands, n_pairs)
+        """
+
+        chunk = np.asarray(chunk, dtype=np.float)
+        if chunk.ndim == 1:
+            chunk = chunk.reshape(-1, 1)
+        if chunk.shape[1] != self.n_channels:
+            raise MTex.MTpyError_inputarguments('chunk has {0} channels, '
+                'expected {1}'.format(chunk.shape[1], self.n_channels))
+
+        data = np.concatenate((self._buffer, chunk))
+        self.n_processed += len(chunk)
+
+        n_segments = 0
+        if len(data) >= self.nfft:
+            n_segments = (len(data) - self.nfft) // self.segment_step + 1
+
+        if n_segments > 0:
+            #limit the size of the temporary spectra
+            block = max(1, 2**20 // (self.nfft * self.n_channels))
+            lo_cross, lo_auto = [self._cross], [self._auto]
+            for b_start in range(0, n_segments, block):
+                n_block = min(block, n_segments - b_start)
+                offset = b_start * self.segment_step
+                cross, auto = self._segment_spectra(
+                    data[offset:offset + (n_block - 1) * self.segment_step + 
+                         self.nfft], n_block)
+                lo_cross.append(cross)
+                lo_auto.append(auto)
+            self._cross = np.concatenate(lo_cross)
+            self._auto = np.concatenate(lo_auto)
+
+        self._buffer = data[n_segments * self.segment_step:].copy()
+        self._n_segments += n_segments
+
+        return self._complete_windows()
+
+    def _complete_windows(self):
+        """
+        coherence of all windows, whose segments are available.
+        """
+
+        n_available = self._first_segment + len(self._cross)
+        n_windows = 0
+        if n_available >= self._next_window + self.window_segments:
+            n_windows = (n_available - self._next_window - 
+                         self.window_segments) // self.step_segments + 1
+
+        n_bands, n_pairs = len(self.bands), len(self.pairs)
+        if n_windows == 0:
+            return (np.zeros(0, dtype=np.int64), 
+                    np.zeros((0, n_bands, n_pairs)))
+
+        window_segments = self._next_window + \
+                          self.step_segments * np.arange(n_windows)
+        first = window_segments - self._first_segment
+
+        #sums over the segments of the windows from the cumulative sums
+        cum_cross = np.concatenate((np.zeros((1, n_bands, n_pairs)), 
+                                    np.cumsum(self._cross, axis=0)))
+        cum_auto = np.concatenate((np.zeros((1, n_bands, self.n_channels)), 
+                                   np.cumsum(self._auto, axis=0)))
+        cross = cum_cross[first + self.window_segments] - cum_cross[first]
+        auto = cum_auto[first + self.window_segments] - cum_auto[first]
+
+        denominator = auto[:, :, self._ia] * auto[:, :, self._ib]
+        numerator = cross.real**2 + cross.imag**2
+        coherence = np.zeros(numerator.shape)
+        nonzero = denominator > 0
+        coherence[nonzero] = numerator[nonzero] / denominator[nonzero]
+
+        #drop the segments not needed by the next windows
+        self._next_window += n_windows * self.step_segments
+        n_drop = min(self._next_window - self._first_segment, len(self._cross))
+        self._cross = self._cross[n_drop:]
+        self._auto = self._auto[n_drop:]
+        self._first_segment += n_drop
+
+        return window_segments * self.segment_step, coherence
+
+
+def coherence(data, df, chunksize=2**20, **kwargs):
+    """
+    Coherence of all channel pairs of a multichannel time series (array 
+    of shape (n_samples, n_channels)) over sliding windows.
+
+    The keyword arguments are those of CoherenceEstimator.
+
+    output:
+    - array of window start times in seconds
+    - array of coherences of shape (n_windows, n_bands, n_pairs)
+    - CoherenceEstimator with the bands and pairs used
+
+    """
+
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+
+    estimator = CoherenceEstimator(data.shape[1], df, **kwargs)
+    lo_starts, lo_coherence = [], []
+    for idx in range(0, len(data), chunksize):
+        starts, coh = estimator.process(data[idx:idx + chunksize])
+        lo_starts.append(starts)
+        lo_coherence.append(coh)
+
+    return (np.concatenate(lo_starts) / estimator.df, 
+            np.concatenate(lo_coherence), estimator)
+
+
+def _iter_aligned_chunks(lo_filenames, chunksize=2**20):
+    """
+    Yield chunks of the data of several (MTpy TS) files as arrays of 
+    shape (n_samples, n_files). The files are aligned at their latest 
+    start time (header 't_min') and reading stops at the end of the 
+    shortest file.
+
+    """
+
+    lo_headers = [MTfh.read_ts_header(fn) for fn in lo_filenames]
+    lo_df = [float(header['samplingrate']) for header in lo_headers]
+    if max(lo_df) - min(lo_df) > 1e-6 * max(lo_df):
+        raise MTex.MTpyError_ts_data('sampling rates of the files differ: '
+                                     '{0}'.format(lo_df))
+    df = lo_df[0]
+
+    lo_tmin = [float(header['t_min']) for header in lo_headers]
+    t_start = max(lo_tmin)
+    lo_skip = [int(round((t_start - t_min) * df)) for t_min in lo_tmin]
+
+    def _samples(filename, n_skip):
+        for chunk in MTfh.iter_ts_data_chunks(filename, chunksize):
+            #at least 2 columns - assume, first is time, second data
+            data = chunk[:, min(1, chunk.shape[1] - 1)]
+            if n_skip >= len(data):
+                n_skip -= len(data)
+                continue
+            yield data[n_skip:]
+            n_skip = 0
+
+    lo_iters = [_samples(fn, n_skip) 
+                for fn, n_skip in zip(lo_filenames, lo_skip)]
+    lo_pending = [np.zeros(0) for fn in lo_filenames]
+    while True:
+        #fill all channels up to at least chunksize samples
+        finished = False
+        for ii, samples in enumerate(lo_iters):
+            while len(lo_pending[ii]) < chunksize:
+                try:
+                    lo_pending[ii] = np.append(lo_pending[ii], samples.next())
+                except StopIteration:
+                    finished = True
+                    break
+
+        n = min([len(pending) for pending in lo_pending])
+        if n > 0:
+            yield t_start, df, np.column_stack([pending[:n] 
+                                                for pending in lo_pending])
+            lo_pending = [pending[n:] for pending in lo_pending]
+        if finished or n == 0:
+            return
+
+
+def coherence_files(lo_filenames, lo_remote_filenames=None, bands=None, 
+                    chunksize=2**20, **kwargs):
+    """
+    Coherence of MTpy TS files (one channel each, ASCII or binary) over 
+    sliding windows, computed chunk by chunk without reading the files 
+    into memory.
+
+    All files must have the same sampling rate, they are aligned at the 
+    latest start time. Without remote files, the coherences of all pairs of
+    files are computed. Remote reference files add the pairs of each local
+    and each remote channel (see get_channel_pairs).
+
+    input:
+    - list of local channel files
+    - list of remote reference channel files (optional)
+    - frequency bands and further keyword arguments of CoherenceEstimator
+    - number of samples read at a time
+
+    output:
+    - array of window start times (epoch seconds)
+    - array of coherences of shape (n_windows, n_bands, n_pairs)
+    - list of the frequency bands
+    - list of pair names 'STATION_channel-STATION_channel'
+
+    """
+
+    if lo_remote_filenames is None:
+        lo_remote_filenames = []
+    lo_all = list(lo_filenames) + list(lo_remote_filenames)
+    for fn in lo_all:
+        if not op.isfile(fn):
+            raise MTex.MTpyError_inputarguments('data file not existing: '
+                                                '{0}'.format(fn))
+
+    lo_names = []
+    for fn in lo_all:
+        header = MTfh.read_ts_header(fn)
+        lo_names.append('{0}_{1}'.format(header.get('station', ''), 
+                                         header.get('channel', '')))
+
+    remote = range(len(lo_filenames), len(lo_all))
+    kwargs.setdefault('pairs', get_channel_pairs(len(lo_all), remote))
+
+    estimator = None
+    t_start = 0.
+    lo_starts, lo_coherence = [], []
+    for t_start, df, chunk in _iter_aligned_chunks(lo_all, chunksize):
+        if estimator is None:
+            estimator = CoherenceEstimator(len(lo_all), df, bands=bands,
+                                           **kwargs)
+        starts, coh = estimator.process(chunk)
+        lo_starts.append(starts)
+        lo_coherence.append(coh)
+
+    if estimator is None or len(lo_starts) == 0:
+        raise MTex.MTpyError_ts_data('no overlapping data in files')
+
+    lo_pair_names = ['{0}-{1}'.format(lo_names[i], lo_names[j]) 
+                     for i, j in estimator.pairs]
+
+    return (t_start + np.concatenate(lo_starts) / estimator.df, 
+            np.concatenate(lo_coherence), estimator.bands, lo_pair_names)
+
+
+def coherence_mask(coherence, threshold, bands=None, pairs=None):
+    """
+    Select windows for transfer function estimation: a window is selected,
+    if the coherence of all given pairs in all given bands (indices, 
+    default: all) is at least 'threshold'.
+
+    output:
+    - boolean array, True for the selected windows
+
+    """
+
+    coherence = np.asarray(coherence)
+    if bands is not None:
+        coherence = coherence[:, bands, :]
+    if pairs is not None:
+        coherence = coherence[:, :, pairs]
+
+    return np.all(coherence.reshape(len(coherence), -1) >= threshold, 
+                  axis=1)
+
+
+def get_gated_intervals(starts, window_length, mask):
+    """
+    Merge the selected (overlapping) windows to time intervals.
+
+    input:
+    - window start times
+    - length of the windows in seconds (window_len/df of the estimator)
+    - boolean mask of the selected windows (see coherence_mask)
+
+    output:
+    - list of (tmin, tmax) tuples
+
+    """
+
+    lo_intervals = []
+    for t0 in np.asarray(starts)[np.asarray(mask)]:
+        if len(lo_intervals) > 0 and t0 <= lo_intervals[-1][1]:
+            lo_intervals[-1] = (lo_intervals[-1][0], t0 + window_length)
+        else:
+            lo_intervals.append((t0, t0 + window_length))
+
+    return lo_intervals
+
+
+def write_coherence_file(fn, starts, coherence, bands, lo_pair_names, 
+                         fmt='%.4f'):
+    """
+    Write coherence time series to an ASCII file: one line per window with
+    the start time followed by the coherences of all pairs, band by band.
+    The bands and pairs are given in the header.
+
+    """
+
+    coherence = np.asarray(coherence)
+    with open(fn, 'w') as F:
+        F.write('# bands: {0}\n'.format(' '.join(['{0:.6g},{1:.6g}'.format(
+                                        fmin, fmax) for fmin, fmax in bands])))
+        F.write('# pairs: {0}\n'.format(' '.join(lo_pair_names)))
+        np.savetxt(F, np.column_stack((starts, 
+                            coherence.reshape(len(coherence), -1))), 
+                   fmt=['%.3f'] + [fmt] * (len(bands) * len(lo_pair_names)))
+
+    return fn
+
+
+def read_coherence_file(fn):
+    """
+    Read a file written by write_coherence_file.
+
+    output:
+    - array of window start times
+    - array of coherences of shape (n_windows, n_bands, n_pairs)
+    - list of the frequency bands
+    - list of pair names
+
+    """
+
+    with open(fn, 'r') as F:
+        bandline = F.readline().split(':', 1)[1].split()
+        lo_pair_names = F.readline().split(':', 1)[1].split()
+    bands = [tuple([float(f) for f in band.split(',')]) for band in bandline]
+
+    data = np.loadtxt(fn, ndmin=2)
+
+    return (data[:, 0], data[:, 1:].reshape(len(data), len(bands), 
+                                            len(lo_pair_names)),
+            bands, lo_pair_names)
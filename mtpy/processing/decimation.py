@@ -5,6 +5,10 @@ mtpy/processing/decimation.py
 
 Functions for the decimation of raw time series. 
 
+Large decimation factors are split into cascaded polyphase FIR stages. The
+Decimator class carries the filter states between chunks of data, so that 
+files of arbitrary length can be decimated in constant memory 
+(decimate_file).
 
 
 For calling a batch decimation rather than just one file, use the appropriate scripts from the mtpy.utils subpackage. 
@@ -24,7 +28,377 @@ import os.path as op
 import time
 import copy
 
+import scipy.signal as sps
 
 import  mtpy.utils.exceptions as MTex
+import mtpy.utils.filehandling as MTfh
 
-#=================================================================
\ No newline at end of file
+#=================================================================
+
+#largest decimation factor carried out by a single filter stage
+max_stage_factor = 8
+
+#number of zero crossings of the anti-alias FIR filter on each side of its 
+#centre - the filter of a stage with factor D has 2*n_zeros*D+1 taps
+n_filter_zeros = 10
+
+#cache for the polyphase filters, keyed by (factor, n_zeros)
+_polyphase_filter_cache = {}
+_max_cached_filters = 64
+
+#=================================================================
+
+
+def get_decimation_stages(factor, max_stage_factor=max_stage_factor):
+    """
+    Split an integer decimation factor into a list of stage factors.
+
+    The prime factors of 'factor' are combined (largest first) into as few 
+    stages as possible, each of them not exceeding 'max_stage_factor' - 
+    unless a prime factor is larger itself. The stages are returned in 
+    descending order, so that the steepest (longest) filter runs at the 
+    highest sampling rate only once.
+
+    input:
+    - integer decimation factor >= 1
+    - maximum factor of a single stage
+
+    output:
+    - list of stage factors (empty for factor 1)
+
+    """
+
+    try:
+        if factor % 1 != 0:
+            raise ValueError
+        factor = int(factor)
+        if factor < 1:
+            raise ValueError
+    except (ValueError, TypeError):
+        raise MTex.MTpyError_inputarguments('decimation factor must be an '
+                                            'integer >= 1')
+
+    primes = []
+    remainder = factor
+    divisor = 2
+    while divisor * divisor <= remainder:
+        while remainder % divisor == 0:
+            primes.append(divisor)
+            remainder /= divisor
+        divisor += 1
+    if remainder > 1:
+        primes.append(remainder)
+
+    stages = []
+    for prime in sorted(primes, reverse=True):
+        for idx, stage in enumerate(stages):
+            if stage * prime <= max_stage_factor:
+                stages[idx] *= prime
+                break
+        else:
+            stages.append(prime)
+
+    return sorted(stages, reverse=True)
+
+
+def get_polyphase_filters(factor, n_zeros=n_filter_zeros):
+    """
+    Return the anti-alias FIR filter for decimation by 'factor', split into 
+    its polyphase components.
+
+    The prototype filter is a Hamming windowed sinc with 2*n_zeros*factor+1 
+    taps and a cut-off at 80% of the new Nyquist frequency. The components 
+    are returned as list of tuples (b, phase): the output of the decimation 
+    is the sum of lfilter(b, 1, x[phase::factor]) over all components. 
+    Filters are designed once per (factor, n_zeros) and cached.
+
+    """
+
+    key = (factor, n_zeros)
+    if key in _polyphase_filter_cache:
+        return _polyphase_filter_cache[key]
+
+    h = sps.firwin(2 * n_zeros * factor + 1, 0.8 / factor)
+
+    #y[m] = sum_r sum_j h[j*D+r] * x[(m-j)*D-r] - for r > 0, the input 
+    #phase is D-r, delayed by one output sample
+    components = [(h[0::factor], 0)]
+    for r in range(1, factor):
+        components.append((np.append(0., h[r::factor]), factor - r))
+
+    if len(_polyphase_filter_cache) >= _max_cached_filters:
+        _polyphase_filter_cache.clear()
+    _polyphase_filter_cache[key] = components
+
+    return components
+
+
+class _PolyphaseStage(object):
+    """
+    One decimation stage: anti-alias FIR filtering and downsampling by an 
+    integer factor, evaluated on the input phases at the output rate. 
+
+    The filter states are carried between calls of process(), so the data 
+    can be fed in chunks of arbitrary length. The first output sample 
+    corresponds to the first input sample (filter delay removed, signal 
+    edges continued with constant values), after flush() the stage has 
+    returned ceil(N/factor) samples for N input samples.
+
+    """
+
+    def __init__(self, factor, n_zeros=n_filter_zeros):
+        self.factor = factor
+        self.n_zeros = n_zeros
+        self.components = get_polyphase_filters(factor, n_zeros)
+        self._zi = None
+        self._pending = np.zeros(0)
+        self._last_value = 0.
+        self._n_skip = n_zeros
+        self.n_in = 0
+        self.n_out = 0
+
+    def _filter(self, data):
+        block = np.append(self._pending, data)
+        n_block = len(block) // self.factor * self.factor
+        if n_block == 0:
+            #not a full output sample yet, keep the samples pending
+            self._pending = block
+            return np.zeros(0)
+
+        self._pending = block[n_block:]
+        phases = block[:n_block].reshape(-1, self.factor)
+
+        out = np.zeros(len(phases))
+        for idx, (b, phase) in enumerate(self.components):
+            y, self._zi[idx] = sps.lfilter(b, 1., phases[:, phase], 
+                                           zi=self._zi[idx])
+            out += y
+
+        return out
+
+    def _emit(self, out):
+        #remove the filter delay and limit the output to ceil(N/factor)
+        n_skip = min(self._n_skip, len(out))
+        self._n_skip -= n_skip
+        n_total = -(-self.n_in // self.factor)
+        out = out[n_skip:n_skip + max(n_total - self.n_out, 0)]
+        self.n_out += len(out)
+
+        return out
+
+    def process(self, data):
+        data = np.asarray(data, dtype=np.float64).ravel()
+        if len(data) == 0:
+            return np.zeros(0)
+
+        if self._zi is None:
+            #start as if the signal had been constant before
+            self._zi = [sps.lfilter_zi(b, 1.) * data[0] 
+                        for b, phase in self.components]
+
+        self.n_in += len(data)
+        self._last_value = data[-1]
+
+        return self._emit(self._filter(data))
+
+    def flush(self):
+        if self._zi is None:
+            return np.zeros(0)
+
+        #continue the signal with its last value to get the delayed tail
+        padding = np.ones((self.n_zeros + 1) * self.factor) * self._last_value
+
+        return self._emit(self._filter(padding))
+
+
+class _Subsampler(object):
+    """
+    Plain downsampling by an integer factor (every factor-th sample, no 
+    filtering), with the same process()/flush() interface as Decimator.
+
+    """
+
+    def __init__(self, factor):
+        self.factor = factor
+        self._offset = 0
+
+    def process(self, data):
+        data = np.asarray(data, dtype=np.float64).ravel()
+        out = data[self._offset::self.factor]
+        self._offset = (self._offset - len(data)) % self.factor
+
+        return out
+
+    def flush(self):
+        return np.zeros(0)
+
+
+class Decimator(object):
+    """
+    Streaming multi-stage decimation of a time series by an integer factor.
+
+    The factor is split into cascaded polyphase FIR stages (see 
+    get_decimation_stages and get_polyphase_filters), so that large ratios 
+    need only short filters, each evaluated at its output rate. Data are 
+    passed in chunks of arbitrary length to process(), which returns the 
+    decimated samples available so far; flush() returns the remaining ones 
+    at the end of the time series.
+
+    Output sample k corresponds to input sample k*factor. In total, 
+    ceil(N/factor) samples are returned for N input samples.
+
+    """
+
+    def __init__(self, factor, n_zeros=n_filter_zeros, 
+                 max_stage_factor=max_stage_factor):
+        self.factor = int(factor)
+        self.stages = [_PolyphaseStage(stage_factor, n_zeros) for 
+                       stage_factor in get_decimation_stages(factor, 
+                                                            max_stage_factor)]
+
+    def process(self, data):
+        data = np.asarray(data, dtype=np.float64).ravel()
+        for stage in self.stages:
+            data = stage.process(data)
+
+        return data
+
+    def flush(self):
+        data = np.zeros(0)
+        for stage in self.stages:
+            data = np.append(stage.process(data), stage.flush())
+
+        return data
+
+
+def decimate(data, factor, n_zeros=n_filter_zeros, 
+             max_stage_factor=max_stage_factor, chunksize=2**20):
+    """
+    Decimate a time series by an integer factor with anti-alias filtering.
+
+    input:
+    - 1D data array
+    - integer decimation factor
+    - number of filter zero crossings per side (filter length)
+    - maximum factor of a single filter stage
+    - number of samples processed at once
+
+    output:
+    - decimated data array of length ceil(len(data)/factor)
+
+    """
+
+    data = np.asarray(data).ravel()
+    decimator = Decimator(factor, n_zeros, max_stage_factor)
+
+    lo_chunks = [decimator.process(data[idx:idx + chunksize]) 
+                 for idx in range(0, len(data), chunksize)]
+    lo_chunks.append(decimator.flush())
+
+    return np.concatenate(lo_chunks)
+
+
+def _write_decimated_header(Fout, header, binary, dtype, headerlength):
+    """
+    Write the (updated) TS header to the beginning of the open output file. 
+    ASCII headers are padded with blanks to 'headerlength' characters, so 
+    that they can be rewritten in place with the final number of samples.
+
+    """
+
+    Fout.seek(0)
+    if binary is True:
+        Fout.write(MTfh.get_ts_binary_header_block(header, dtype))
+        return
+
+    headerline = MTfh.get_ts_header_string(header).rstrip('\n')
+    if len(headerline) >= headerlength:
+        raise MTex.MTpyError_ts_data('header does not fit into reserved space')
+    Fout.write(headerline.ljust(headerlength - 1) + '\n')
+
+
+def decimate_file(infile, outfile, factor, antialias=True, 
+                  n_zeros=n_filter_zeros, max_stage_factor=max_stage_factor,
+                  chunksize=2**20, fmt='%.8g', dtype='float32'):
+    """
+    Decimate a single column data file (raw ASCII or MTpy ASCII/binary TS 
+    file) by an integer factor without holding the whole time series in 
+    memory.
+
+    The data are streamed through a Decimator (or, for 'antialias' False, 
+    simply subsampled). The output has the same format as the input file. 
+    The header, if existing, is updated with the new sampling rate and the 
+    number of samples.
+
+    input:
+    - input file name
+    - output file name
+    - integer decimation factor
+    - apply anti-alias filtering (True) or just take every factor-th sample
+    - filter parameters, see Decimator
+    - number of samples processed at once
+    - output format for ASCII files
+    - data type for binary output files
+
+    output:
+    - number of samples written
+
+    """
+
+    if not op.isfile(infile):
+        raise MTex.MTpyError_inputarguments('data file not existing: '
+                                            '{0}'.format(infile))
+
+    try:
+        header = MTfh.read_ts_header(infile)
+    except MTex.MTpyError_ts_data:
+        header = None
+
+    binary = MTfh.is_binary_ts_file(infile)
+    if binary is True:
+        #keep the data type of the input file
+        file_dtype = MTfh.read_ts_binary_header(infile)[1]
+        dtype = [key for key, value in MTfh.dict_of_ts_binary_dtypes.items()
+                 if value == file_dtype][0]
+
+    if antialias is True:
+        decimator = Decimator(factor, n_zeros, max_stage_factor)
+    else:
+        decimator = _Subsampler(int(factor))
+
+    if header is not None:
+        if 'samplingrate' in header:
+            header['samplingrate'] = float(header['samplingrate']) / factor
+        header['nsamples'] = 0
+        headerlength = len(MTfh.get_ts_header_string(header)) + 24
+
+    nsamples = 0
+    Fout = open(outfile, 'wb')
+    try:
+        if header is not None:
+            _write_decimated_header(Fout, header, binary, dtype, headerlength)
+
+        for chunk in MTfh.iter_ts_data_chunks(infile, chunksize):
+            out = decimator.process(chunk[:, 0])
+            nsamples += len(out)
+            _write_decimated_data(Fout, out, binary, dtype, fmt)
+
+        out = decimator.flush()
+        nsamples += len(out)
+        _write_decimated_data(Fout, out, binary, dtype, fmt)
+
+        if header is not None:
+            header['nsamples'] = nsamples
+            _write_decimated_header(Fout, header, binary, dtype, headerlength)
+    finally:
+        Fout.close()
+
+    return nsamples
+
+
+def _write_decimated_data(Fout, data, binary, dtype, fmt):
+
+    if binary is True:
+        data.astype(MTfh.dict_of_ts_binary_dtypes[dtype]).tofile(Fout)
+    else:
+        np.savetxt(Fout, data, fmt=fmt)
@@ -23,12 +23,14 @@ import sys, os
 import os.path as op
 import time
 import copy
+import multiprocessing
 import scipy.signal as SS
 from scipy.signal import butter, lfilter, buttord
 
 
 
 import  mtpy.utils.exceptions as MTex
+import mtpy.utils.filehandling as MTfh
 
 #=================================================================
 
@@ -133,7 +135,7 @@ def zero_pad(input_array, power=2, pad_fill=0):
     if power == 10:
         npow = np.ceil(np.log10(len_array))
         
-    pad_array = np.zeros(power**npow)
+    pad_array = np.zeros(int(power**npow))
     if pad_fill is not 0:
         pad_array[:] = pad_fill
         
@@ -144,13 +146,18 @@ def zero_pad(input_array, power=2, pad_fill=0):
     
 
 def adaptive_notch_filter(bx, df=100, notches=[50,100], notchradius=.5, 
-                          freqrad=.9, rp=.1, dbstop_limit=5.0):
+                          freqrad=.9, rp=.1, dbstop_limit=5.0, nperseg=None):
     """
     adaptive_notch_filter(bx, df, notches=[50,100], notchradius=.3, freqrad=.9)
     will apply a notch filter to the array bx by finding the nearest peak 
     around the supplied notch locations.  The filter is a zero-phase 
     Chebyshev type 1 bandstop filter with minimal ripples.
     
+    All peaks are found in a single spectrum (see find_notch_peaks), the 
+    bandstop filters of all peaks are combined into one cascade of second
+    order sections (see get_notch_sos) which is applied to the time series 
+    in a single forward-backward pass.
+    
     Arguments:
     -----------
         **bx** : np.ndarray(len_time_series)
@@ -176,6 +183,11 @@ def adaptive_notch_filter(bx, df=100, notches=[50,100], notchradius=.5,
                            notch and surrounding spectra.  Any difference 
                            above dbstop_limit will be filtered, anything
                            less will not
+                           
+        **nperseg** : int
+                      if given the peaks are searched in a Welch averaged
+                      spectrum with segments of nperseg points instead of 
+                      the spectrum of the whole (zero padded) time series
 
     Outputs:
     ---------
@@ -222,53 +234,187 @@ def adaptive_notch_filter(bx, df=100, notches=[50,100], notchradius=.5,
         >>>     bx_filt, filt_lst = rmp.adaptiveNotchFilter(bx, df=100. 
         >>>     ...                                         notches=freq_notches)
         >>>     np.savetxt(os.path.join(save_path, fn), bx_filt)
+        
+        For several channels use adaptive_notch_filter_channels, which can
+        filter the channels in parallel.
          
     """
     
     bx = np.array(bx)
     
-    if type(notches) != list:
-        notches = [notches]
-    
     df = float(df)         #make sure df is a float
-    dt = 1./df             #sampling rate
+
+    filtlst = find_notch_peaks(bx, df=df, notches=notches, freqrad=freqrad,
+                               dbstop_limit=dbstop_limit, nperseg=nperseg)
+    
+    peaks = [filt for filt in filtlst if type(filt) is not str]
+    if len(peaks) > 0:
+        sos = get_notch_sos(df, [peak[0] for peak in peaks], notchradius,
+                            dbstop=[peak[1] for peak in peaks])
+        bx = SS.sosfiltfilt(sos, bx)
+    
+    return bx, filtlst
 
 
-    # transform data into frequency domain to find notches
-    BX = np.fft.fft(zero_pad(bx))
-    n = len(BX)            #length of array
-    dfn = df/n             #frequency step
-    dfnn = freqrad/dfn          #radius of frequency search
-    fn = notchradius               #filter radius
-    freq = np.fft.fftfreq(n,dt)
+def find_notch_peaks(bx, df=100, notches=[50,100], freqrad=.9, 
+                     dbstop_limit=5.0, nperseg=None):
+    """
+    find the peaks nearest to the supplied notch frequencies in a single 
+    spectrum of bx, see adaptive_notch_filter for the arguments.
+    
+    Outputs:
+    ---------
+        **filtlst** : list
+                      [peak frequency, power difference in dB between peak 
+                      and median of surrounding spectra] for each notch that
+                      needs to be filtered, 'No need to filter \\n' otherwise.
+                      Notches above the Nyquist frequency are skipped.
+    """
+    
+    if type(notches) not in [list, np.ndarray]:
+        notches = [notches]
+    
+    df = float(df)
+    
+    # power spectrum of positive frequencies only
+    if nperseg is None:
+        padded = zero_pad(np.asarray(bx, dtype=np.float))
+        power = np.abs(np.fft.rfft(padded))**2
+        dfn = df/len(padded)           #frequency step
+    else:
+        nperseg = min(int(nperseg), len(bx))
+        freq, power = SS.welch(bx, fs=df, nperseg=nperseg)
+        dfn = freq[1]-freq[0]
+    n = len(power)
+    freq = np.arange(n)*dfn
+    dfnn = int(freqrad/dfn)        #radius of frequency search
     
     filtlst = []
     for notch in notches:
         if notch > freq.max():
-            pass
-            #print 'Frequency too high, skipping {0}'.format(notch)
+            continue
+            
+        fspot = int(round(notch/dfn))
+        search = power[max([fspot-dfnn, 0]):min([fspot+dfnn, n])]
+        nspot = max([fspot-dfnn, 0])+np.argmax(search)
+        
+        med_bx = np.median(power[max([nspot-dfnn*10, 0]):
+                                 min([nspot+dfnn*10, n])])
+        
+        #calculate difference between peak and surrounding spectra in dB
+        dbstop = 10*np.log10(power[nspot]/med_bx)
+        if np.nan_to_num(dbstop) == 0.0 or dbstop < dbstop_limit:
+            filtlst.append('No need to filter \n')
         else:
-            fspot = int(round(notch/dfn))
-            nspot = np.where(abs(BX)== max(abs(BX[max([fspot-dfnn, 0]):\
-                                                 min([fspot+dfnn, n])])))[0][0]   
-
-            med_bx =np.median(abs(BX[max([nspot-dfnn*10, 0]):\
-                                     min([nspot+dfnn*10, n])])**2)
+            filtlst.append([freq[nspot], dbstop])
             
-            #calculate difference between peak and surrounding spectra in dB
-            dbstop = 10*np.log10(abs(BX[nspot])**2/med_bx) 
-            if np.nan_to_num(dbstop) == 0.0 or dbstop < dbstop_limit:
-                filtlst.append('No need to filter \n')
-                pass
-            else:
-                filtlst.append([freq[nspot], dbstop])
-                ws = 2*np.array([freq[nspot]-fn, freq[nspot]+fn])/df
-                wp = 2*np.array([freq[nspot]-2*fn, freq[nspot]+2*fn])/df
-                ford, wn = SS.cheb1ord(wp, ws, 1, dbstop)
-                b, a = SS.cheby1(1, .5, wn, btype='bandstop')
-                bx = SS.filtfilt(b, a, bx)
+    return filtlst
+
+
+#designed notch filters, keyed by (df, notch frequencies, notchradius)
+_notch_sos_cache = {}
+_notch_sos_cache_size = 64
+
+def get_notch_sos(df, notch_freqs, notchradius=.5, dbstop=None):
+    """
+    get the second order sections of a cascade of Chebyshev type 1 bandstop 
+    filters, one for each frequency in notch_freqs.
     
-    return bx, filtlst
+    Designed cascades are cached by sampling rate, notch frequencies and 
+    notch radius, so channels and files with the same notches only design
+    the filters once.  The natural frequencies returned by cheb1ord do not 
+    depend on the stop band attenuation, so dbstop is not part of the key.
+    
+    Arguments:
+    -----------
+        **df** : float
+                 sampling frequency in Hz
+                 
+        **notch_freqs** : list of frequencies (Hz) to filter
+        
+        **notchradius** : float
+                          radius of the notch in frequency domain (Hz)
+                          
+        **dbstop** : list of stop band attenuations (dB) for each notch
+        
+    Outputs:
+    ---------
+        **sos** : np.ndarray(n_sections, 6)
+                  second order sections, see scipy.signal.sosfilt
+    """
+    
+    df = float(df)
+    fn = notchradius
+    key = (df, tuple(np.round(notch_freqs, 6)), float(notchradius))
+    
+    try:
+        return _notch_sos_cache[key]
+    except KeyError:
+        pass
+    
+    if dbstop is None:
+        dbstop = [20.]*len(notch_freqs)
+    
+    lo_sos = []
+    for notch, gstop in zip(notch_freqs, dbstop):
+        ws = 2*np.array([notch-fn, notch+fn])/df
+        wp = 2*np.array([notch-2*fn, notch+2*fn])/df
+        ford, wn = SS.cheb1ord(wp, ws, 1, gstop)
+        lo_sos.append(SS.cheby1(1, .5, wn, btype='bandstop', output='sos'))
+    sos = np.vstack(lo_sos)
+    
+    if len(_notch_sos_cache) >= _notch_sos_cache_size:
+        _notch_sos_cache.clear()
+    _notch_sos_cache[key] = sos
+    
+    return sos
+
+
+def _adaptive_notch_filter_channel(args):
+    """
+    apply adaptive_notch_filter to one channel of 
+    adaptive_notch_filter_channels, return (filtered data, filtlst)
+    """
+    
+    bx, kwargs = args
+    
+    return adaptive_notch_filter(bx, **kwargs)
+
+
+def adaptive_notch_filter_channels(lo_bx, n_processes=1, **kwargs):
+    """
+    apply adaptive_notch_filter to several channels.
+    
+    Arguments:
+    -----------
+        **lo_bx** : list of np.ndarray or np.ndarray(n_channels, n_points)
+                    time series to filter
+                    
+        **n_processes** : int
+                          number of processes to filter channels in 
+                          parallel, None uses all cpus. *default* is 1
+                          
+        **kwargs** : keywords of adaptive_notch_filter
+        
+    Outputs:
+    ---------
+        **lo_filtered** : list of (bx, filtlst) for each channel, see 
+                          adaptive_notch_filter
+    """
+    
+    lo_args = [(bx, kwargs) for bx in lo_bx]
+    
+    if n_processes == 1 or len(lo_args) < 2:
+        return [_adaptive_notch_filter_channel(args) for args in lo_args]
+    
+    pool = multiprocessing.Pool(n_processes)
+    try:
+        lo_filtered = pool.map(_adaptive_notch_filter_channel, lo_args)
+    finally:
+        pool.close()
+        pool.join()
+    
+    return lo_filtered
 
 def remove_periodic_noise(filename, dt, noiseperiods, save='n'):
     """
@@ -359,34 +505,11 @@ def remove_periodic_noise(filename, dt, noiseperiods, save='n'):
         #get length of array
         T = len(bx)
         
-        #frequency step
-        dfn = df/T
-        #make a frequency array that describes BX
-        pfreq = np.fft.fftfreq(int(T), dt)
-        
-        #get noise period in points along frequency axis
-        nperiodnn = round((1./nperiod[0])/dfn)
+        #find the exact peak about the noise period
+        peak_freq, nperiod = _find_noise_period(bx, dt, nperiod)
         
-        #get region to look around to find exact peak
-        try:
-            dfnn = nperiodnn*nperiod[1]
-        except IndexError:
-            dfnn = .2*nperiodnn
-        
-        
-        #comput FFT of input to find peak value
-        BX = np.fft.fft(bx)
-        #if dfnn is not 0 then look for max with in region nperiod+-dfnn
-        if dfnn != 0:
-            nspot = np.where(abs(BX)==
-                            max(abs(BX[nperiodnn-dfnn:nperiodnn+dfnn])))[0][0]
-        else:
-            nspot = nperiodnn
         #output the peak frequency found
-        filtlst.append('Found peak at : '+str(pfreq[nspot])+' Hz \n')
-        
-        #make nperiod the peak period in data points
-        nperiod = (1./pfreq[nspot])/dt
+        filtlst.append('Found peak at : '+str(peak_freq)+' Hz \n')
 
         #create list of time instances for windowing
         #nlst=np.arange(start=nperiod,stop=T-nperiod,step=nperiod,dtype='int')
@@ -426,4 +549,360 @@ def remove_periodic_noise(filename, dt, noiseperiods, save='n'):
         print 'Saved filtered file to {0}'.format(os.path.join(savepath, 
                                                                filename))
     else:
-        return bxnf, pn, filtlst
\ No newline at end of file
+        return bxnf, pn, filtlst
+
+def _find_noise_period(bx, dt, nperiod, n_fft=None):
+    """
+    find the exact peak in the spectrum of bx about the noise period 
+    nperiod = [noiseperiod, df1] (see remove_periodic_noise).  If n_fft is
+    given, bx is zero padded to n_fft points to interpolate the spectrum and
+    the peak is located between frequency steps by fitting a parabola to the
+    logarithm of the spectrum about the peak.
+    
+    Returns the peak frequency (Hz) and the corresponding period in points.
+    """
+    
+    T = len(bx)
+    if n_fft is not None:
+        bx = np.append(bx-np.mean(bx), np.zeros(max(n_fft-T, 0)))
+        T = len(bx)
+    #frequency step
+    dfn = 1./(dt*T)
+    #make a frequency array that describes BX
+    pfreq = np.fft.fftfreq(int(T), dt)
+    
+    #get noise period in points along frequency axis
+    nperiodnn = int(round((1./nperiod[0])/dfn))
+    
+    #get region to look around to find exact peak
+    try:
+        dfnn = int(nperiodnn*nperiod[1])
+    except IndexError:
+        dfnn = int(.2*nperiodnn)
+    
+    #if dfnn is not 0 then look for max with in region nperiod+-dfnn
+    if dfnn != 0:
+        BX = np.abs(np.fft.fft(bx))
+        nspot = max([nperiodnn-dfnn, 0])+\
+                np.argmax(BX[max([nperiodnn-dfnn, 0]):nperiodnn+dfnn])
+    else:
+        nspot = nperiodnn
+        
+    peak_freq = pfreq[nspot]
+    if n_fft is not None and dfnn != 0 and 0 < nspot < T/2-1:
+        l_bx = np.log(BX[nspot-1:nspot+2]+np.finfo(np.float).tiny)
+        curvature = l_bx[0]-2*l_bx[1]+l_bx[2]
+        if curvature < 0:
+            peak_freq += .5*(l_bx[0]-l_bx[2])/curvature*dfn
+        
+    return peak_freq, (1./peak_freq)/dt
+
+
+class PeriodicNoiseRemover(object):
+    """
+    remove periodic noise from a time series that comes in consecutive 
+    segments, the streaming counterpart of remove_periodic_noise.
+    
+    The time series is cut into windows one noise period long, window j 
+    starting at sample round(phase+j*period).  For each noise period a 
+    template is maintained as the median of the median windows of the last
+    n_templates segments, and subtracted from every window on the fly, so 
+    memory only depends on the segment length and the noise periods.  
+    Several noise periods are removed one after the other, each from the 
+    residual of the previous one.
+    
+    The noise periods are first estimated from the spectrum of the first 
+    segment.  As this estimate is not exact, the noise would drift against 
+    the windows on long records.  Therefore the median window of each 
+    segment is cross correlated with the template.  The lag found aligns 
+    the template for the segment and gives the position of the noise at 
+    the mean window index of the segment.  Period and phase are refitted 
+    to the positions of all segments (least squares), so that they get 
+    more precise the longer the record, and the windows of the following 
+    segments are placed accordingly.
+    
+    Arguments:
+    ----------
+        **dt** : float
+                 time sample rate (s)
+                 
+        **noiseperiods** : list
+                           [[noiseperiod1, df1], ...], see 
+                           remove_periodic_noise
+                           
+        **n_templates** : int
+                          number of segment templates the noise template
+                          is the median of. *default* is 16
+                          
+        **n_fft** : int
+                    the first segment is zero padded to n_fft points to 
+                    find the noise periods more precisely than its 
+                    frequency resolution. *default* is 2**20
+                          
+    Attributes:
+    -----------
+        **filtlst** : list of peaks found in the first segment
+        
+        **periods** : list of the current noise period estimates in samples
+        
+        **templates** : list of the current noise template for each period
+        
+        **n_processed** : number of samples processed
+        
+    ..Example: ::
+    
+        >>> import mtpy.processing.filter as MTfilt
+        >>> pnr = MTfilt.PeriodicNoiseRemover(0.01, [[12, 0]])
+        >>> for segment in segments:
+        >>> ...    filtered = pnr.process(segment)
+        
+    """
+    
+    def __init__(self, dt, noiseperiods, n_templates=16, n_fft=2**20):
+        if type(noiseperiods) != list:
+            noiseperiods = [noiseperiods]
+        if type(noiseperiods[0]) not in [list, tuple]:
+            noiseperiods = [noiseperiods]
+            
+        self.dt = float(dt)
+        self.noiseperiods = noiseperiods
+        self.n_templates = n_templates
+        self.n_fft = n_fft
+        
+        self.filtlst = []
+        self.periods = None
+        self.templates = [None]*len(noiseperiods)
+        self.n_processed = 0
+        
+        #window lengths are fixed by the first period estimate
+        self._win_lens = []
+        self._phases = [0. for nperiod in noiseperiods]
+        self._segment_templates = [[] for nperiod in noiseperiods]
+        #index of the first window not complete yet and the samples from
+        #(shortly before) its start on
+        self._next_windows = [0 for nperiod in noiseperiods]
+        self._buffers = [np.zeros(0) for nperiod in noiseperiods]
+        #running least squares fit of noise position against window index:
+        #number of segments, means and (co)variance sums
+        self._fits = [[0, 0., 0., 0., 0.] for nperiod in noiseperiods]
+        
+    def _template_lag(self, window, template):
+        """
+        lag (samples) of window with respect to template, i.e. 
+        window[n] ~ template[n-lag], from the maximum of the circular cross
+        correlation, interpolated between samples.
+        """
+        
+        n = len(template)
+        xcorr = np.fft.irfft(np.fft.rfft(window-window.mean())*
+                             np.conj(np.fft.rfft(template-template.mean())), 
+                             n)
+        i_max = np.argmax(xcorr)
+        lag = float(i_max)
+        l_xc = xcorr[[(i_max-1) % n, i_max, (i_max+1) % n]]
+        curvature = l_xc[0]-2*l_xc[1]+l_xc[2]
+        if curvature < 0:
+            lag += .5*(l_xc[0]-l_xc[2])/curvature
+            
+        if lag > n/2.:
+            lag -= n
+            
+        return lag
+        
+    def _update_fit(self, ii, j, x):
+        """
+        add the noise position x at window index j to the fit of noise 
+        period ii and update its period and phase.
+        """
+        
+        fit = self._fits[ii]
+        fit[0] += 1
+        d_j = j-fit[1]
+        fit[1] += d_j/fit[0]
+        fit[2] += (x-fit[2])/fit[0]
+        fit[3] += d_j*(j-fit[1])
+        fit[4] += d_j*(x-fit[2])
+        
+        if fit[3] > 0:
+            self.periods[ii] = fit[4]/fit[3]
+            self._phases[ii] = fit[2]-self.periods[ii]*fit[1]
+        
+    def process(self, segment):
+        """
+        remove the periodic noise from the next segment of the time series
+        
+        Returns:
+        --------
+            **bxnf** : np.ndarray
+                       filtered segment
+        """
+        
+        bxnf = np.array(segment, dtype=np.float)
+        n_start = self.n_processed
+        n_stop = n_start+len(bxnf)
+        
+        if self.periods is None:
+            self.periods = []
+            for nperiod in self.noiseperiods:
+                peak_freq, period = _find_noise_period(bxnf, self.dt, nperiod,
+                                                       n_fft=self.n_fft)
+                self.filtlst.append('Found peak at : '+str(peak_freq)+' Hz \n')
+                self.periods.append(period)
+                self._win_lens.append(int(period))
+                
+        for ii in range(len(self.periods)):
+            period = self.periods[ii]
+            win_len = self._win_lens[ii]
+            
+            b_start = n_start-len(self._buffers[ii])
+            b_data = np.append(self._buffers[ii], bxnf)
+            
+            #windows starting up to the end of the segment
+            first_start = self._phases[ii]+period*self._next_windows[ii]
+            n_win = max(0, int(np.floor((n_stop-1-first_start)/period))+1)
+            lo_j = self._next_windows[ii]+np.arange(n_win)
+            starts = self._phases[ii]+period*lo_j
+            i_starts = np.round(starts).astype(np.int64)
+            complete = i_starts+win_len <= n_stop
+            
+            #align the template to the noise in this segment
+            template = self.templates[ii]
+            shift = 0
+            if np.any(complete):
+                windows = b_data[(i_starts[complete]-b_start)[:, np.newaxis]+
+                                 np.arange(win_len)]
+                median_window = np.median(windows, axis=0)
+                
+                if template is None:
+                    lag = 0.
+                    template = median_window
+                else:
+                    lag = self._template_lag(median_window, template)
+                    shift = int(round(lag))
+                    
+                self._segment_templates[ii].append(np.roll(median_window, 
+                                                           -shift))
+                self._segment_templates[ii] = \
+                            self._segment_templates[ii][-self.n_templates:]
+                self._update_fit(ii, lo_j[complete].mean(), 
+                                 starts[complete].mean()+lag)
+                self._next_windows[ii] = lo_j[complete][-1]+1
+                
+            #subtract the template, samples in the gap between windows of
+            #non integer periods are left as they are
+            if template is not None and n_win > 0:
+                aligned = np.roll(template, shift)
+                n = np.arange(n_start, n_stop)
+                k = np.searchsorted(i_starts, n, side='right')-1
+                pos = n-i_starts[np.maximum(k, 0)]
+                in_window = (k >= 0) & (pos < win_len)
+                bxnf[in_window] -= aligned[pos[in_window]]
+                
+            if np.any(complete):
+                self.templates[ii] = np.median(self._segment_templates[ii],
+                                               axis=0)
+                
+            #keep the samples from the next window start on, the refitted
+            #start may be earlier than the old one
+            next_start = self._phases[ii]+\
+                         self.periods[ii]*self._next_windows[ii]
+            i_next = int(np.floor(min(next_start, starts[complete][-1]+period
+                                      if np.any(complete) else next_start)))
+            self._buffers[ii] = b_data[max(0, i_next-1-b_start):]
+                
+        self.n_processed += len(bxnf)
+        
+        return bxnf
+
+
+def remove_periodic_noise_streaming(filename, dt, noiseperiods, 
+                                    save_fn=None, segment_len=None,
+                                    n_templates=16, fmt='%.7g'):
+    """
+    remove periodic noise from a file segment by segment with 
+    PeriodicNoiseRemover, so that files larger than memory can be filtered.
+    
+    ASCII files (one column, lines starting with '#' are copied, e.g. the 
+    header of MTpy TS files) are read line by line, MTpy binary TS files
+    are memory mapped.  The output is written in the same format.
+    
+    Arguments:
+    ----------
+        **filename** : string
+                       full path to file
+                       
+        **dt** : float
+                 time sample rate (s)
+                 
+        **noiseperiods** : list
+                           [[noiseperiod1, df1], ...], see 
+                           remove_periodic_noise
+                           
+        **save_fn** : string
+                      full path to save the filtered file to.  *default* is
+                      os.path.join(os.path.dirname(filename), 'Filtered', fn)
+                      
+        **segment_len** : int
+                          number of samples filtered at a time.  *default* 
+                          is 2**18 or 64 noise periods if that is longer
+                          
+        **n_templates** : int
+                          see PeriodicNoiseRemover
+                          
+        **fmt** : string format of ASCII output
+        
+    Outputs:
+    --------
+        **save_fn** : full path to filtered file
+        
+        **filtlst** : list of peaks found in time series
+    """
+    
+    if save_fn is None:
+        savepath = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                                'Filtered')
+        if not os.path.exists(savepath):
+            os.mkdir(savepath)
+        save_fn = os.path.join(savepath, os.path.basename(filename))
+        
+    pnr = PeriodicNoiseRemover(dt, noiseperiods, n_templates=n_templates)
+    if segment_len is None:
+        segment_len = max(2**18, 
+                          int(64*max([float(nperiod[0]) for nperiod in 
+                                      pnr.noiseperiods])/float(dt)))
+    
+    if MTfh.is_binary_ts_file(filename):
+        header_dict, dtype = MTfh.read_ts_binary_header(filename)
+        data = np.memmap(filename, dtype=dtype, mode='r', 
+                         offset=MTfh.ts_binary_header_len)
+        with open(filename, 'rb') as fid:
+            header_block = fid.read(MTfh.ts_binary_header_len)
+        with open(save_fn, 'wb') as fid:
+            fid.write(header_block)
+            for s_start in range(0, len(data), segment_len):
+                bxnf = pnr.process(data[s_start:s_start+segment_len])
+                if np.dtype(dtype).kind == 'i':
+                    bxnf = np.round(bxnf)
+                bxnf.astype(dtype).tofile(fid)
+        del data
+    else:
+        with open(filename, 'r') as ifid, open(save_fn, 'w') as ofid:
+            lines = []
+            for line in ifid:
+                if line.strip() == '' or line.strip()[0] == '#':
+                    ofid.write(line)
+                    continue
+                lines.append(line)
+                if len(lines) == segment_len:
+                    np.savetxt(ofid, pnr.process(np.fromstring(''.join(lines),
+                                                               sep=' ')), 
+                               fmt=fmt)
+                    lines = []
+            if len(lines) > 0:
+                np.savetxt(ofid, pnr.process(np.fromstring(''.join(lines),
+                                                           sep=' ')), 
+                           fmt=fmt)
+                           
+    print 'Saved filtered file to {0}'.format(save_fn)
+    
+    return save_fn, pnr.filtlst
@@ -6,7 +6,10 @@ Functions for the removal of instrument response from time series data.
 
 Either working on ASCII data or on miniSeed
 
-
+Besides the correction of a whole time series in one FFT 
+(correct_for_instrument_response), the BlockDeconvolver class corrects 
+arbitrarily long data block by block (overlap-save with a precomputed 
+deconvolution kernel).
 
 @UofA, 2013
 (LK)
@@ -20,6 +23,7 @@ import numpy as np
 import re
 import sys, os
 import os.path as op
+import multiprocessing
 
 import copy
 
@@ -28,21 +32,90 @@ import mtpy.utils.exceptions as MTex
 
 #=================================================================
 
+#interpolated inverse responses and deconvolution kernels, keyed by 
+#(samplingrate, lengths, response table)
+_response_cache = {}
+_response_cache_size = 32
+
+
+def _get_response_key(responsedata):
+    """
+    hashable key of a response table
+    """
+
+    responsedata = np.ascontiguousarray(responsedata, dtype=np.float)
+
+    return (responsedata.shape, hash(responsedata.tostring()))
+
+
+def _cache_response(key, value):
+    """
+    store value in the response cache, the cache is cleared when full
+    """
+
+    if len(_response_cache) >= _response_cache_size:
+        _response_cache.clear()
+    _response_cache[key] = value
+
+    return value
+
+
+def get_inverse_response(samplingrate, nfft, responsedata):
+    """
+    Get the inverse instrument response on the frequency axis of a real FFT 
+    of nfft points.
+
+    The response (3 column array: frequency, real part, imaginary part) is 
+    linearly interpolated, the inverse is set to zero outside the frequency
+    range of the response table and where the response is zero.  Results are cached per (samplingrate, 
+    nfft, response table).
+
+    Return complex array of length nfft/2+1.
+    """
+
+    key = ('inverse', float(samplingrate), int(nfft), 
+           _get_response_key(responsedata))
+    try:
+        return _response_cache[key]
+    except KeyError:
+        pass
+
+    responsedata = np.asarray(responsedata, dtype=np.float)
+    freqmin = responsedata[0,0]
+    freqmax = responsedata[-1,0]
+
+    data_freqs = np.abs(np.fft.fftfreq(int(nfft), 1./samplingrate)[:int(nfft)/2+1])
+    
+    instr_spectrum = np.interp(data_freqs, responsedata[:,0], responsedata[:,1]) +\
+                     np.complex(0,1) * np.interp(data_freqs, responsedata[:,0], 
+                                                 responsedata[:,2])
+
+    #this is effectively a boxcar window - maybe to be replaced by proper windowing function ?
+    inside = (freqmin <= data_freqs) & (data_freqs <= freqmax)
+    #a response of zero (e.g. at 0 Hz) cannot be inverted, leave it at zero
+    inside &= (np.abs(instr_spectrum) > 0) & np.isfinite(instr_spectrum)
+    inverse = np.zeros(len(data_freqs), 'complex')
+    inverse[inside] = 1. / instr_spectrum[inside]
+
+    return _cache_response(key, inverse)
+
+
 def correct_for_instrument_response(data, samplingrate, responsedata):
     """Correct input time series for instrument response.
         Instr.Resp. is given as 3 column array: frequency, real part, imaginary part
 
         The given section is demeaned, window tapered, zero padded, (potentially bandpassed with the extreme frequencies of the response frequency axis), FFT-ed, "deconvolved" (straight division by the array values or interpolated values inbetween - in frequency domain), re-transformed, mean-re-added and returned.
 
+        The interpolated response is cached (see get_inverse_response). For 
+        long time series use BlockDeconvolver or 
+        block_correct_for_instrument_response instead.
+
     """
 
+    data = np.array(data, dtype=np.float)
     datamean = np.mean(data)
     data -= datamean
     
-    freqmin = responsedata[0,0]
-    freqmax = responsedata[-1,0]
-    #print freqmin,freqmax
-    
     N = len(data)
     if N < 1:
         raise MTex.MTpyError_ts_data('Error - Length of TS to correct is zero!')
@@ -63,71 +136,17 @@ def correct_for_instrument_response(data, samplingrate, responsedata):
     padded_data = np.zeros((2**next2power))
     padded_data[:len(tapered_data)] = tapered_data
 
+    #get the spectrum of the data 
+    data_spectrum = np.fft.rfft(padded_data)
 
-    #bandpass data for excluding all frequencies that are not covered by the known instrument response
-    bp_data = padded_data #butter_bandpass_filter(padded_data, freqmin, freqmax, samplingrate)
+    #finally correct the data for the instrument influence by dividing the 
+    #complex data spectral values by the (interpolated) instrument response 
+    #values - frequencies outside the response are set to zero:
+    corrected_spectrum = data_spectrum * get_inverse_response(samplingrate, 
+                                                len(padded_data), responsedata)
 
-    #get the spectrum of the data 
-    data_spectrum = np.fft.rfft(bp_data)
-    data_freqs = np.fft.fftfreq(len(bp_data),1./samplingrate)
-
-    #and the same for the instrument
-    instr_spectrum = responsedata[:,1] + np.complex(0,1) * responsedata[:,2]
-    instr_freqs = responsedata[:,0]
-
-    lo_mags = []
-    lo_freqs = []
-
-    #return data_freqs,data_spectrum,instr_freqs,instr_spectrum
-
-    #now correct for all frequencies on the data_freqs-axis:
-    corrected_spectrum = np.zeros((len(data_spectrum)),'complex')
-    for i in range(len(data_spectrum)):
-        freq = data_freqs[i]
-        spec = data_spectrum[i]
-
-        #this is effectively a boxcar window - maybe to be replaced by proper windowing function ?
-        if not (freqmin <= np.abs(freq) <= freqmax):
-            print 'no instrument response in this frequency range - spectrum set to zero here: ', freq
-            corrected_spectrum[i] = 0#spec
-            #lo_mags.append([np.abs(spec),np.abs(corrected_spectrum[i]), 0 ])
-            #lo_freqs.append([freq,0,0,0,0,0,0])
-            continue
-
-        #find the appropriate frequencies ( since the current freq-value is most likely inbetween two values on the instr_freqs-axis)
-        #get the respective value by linear interpolation
-
-        #find the value closest to the current freq, assume it's lower
-        closest_lower = np.abs(freq-instr_freqs).argmin()
-        
-        #if it coincides with the highest frequency/last entry:
-        if closest_lower == len(instr_freqs)-1:
-            factor = data_spectrum[closest_lower]
-        # or the lowest
-        elif closest_lower == 0:
-            factor = data_spectrum[0]
-        else:
-            #in case the closest frequency value is not lower but higher, take the freq value below as lower bound for the interval:        
-            if instr_freqs[closest_lower] > freq:
-                closest_lower -= 1
-            
-            #define the interval:
-            instrfreq1 = instr_freqs[closest_lower]
-            instrfreq2 = instr_freqs[closest_lower+1]
-            instrfactor1 = instr_spectrum[closest_lower]
-            instrfactor2 = instr_spectrum[closest_lower+1]
-            intervallength = instrfreq2 - instrfreq1
-            weight = (freq-instrfreq1)/intervallength
-
-            factor = weight * instrfactor2 + (1-weight) * instrfactor1
-            #lo_freqs.append([freq,instrfreq1,instrfreq2,weight,instrfactor1,instrfactor2,factor])
-
-        
-        #finally correct the data for the instrument influence by dividing the complex data spectral value by the instrument response value: 
-        corrected_spectrum[i] = spec / factor
-        #lo_mags.append([np.abs(spec),np.abs(corrected_spectrum[i]), factor ])
     #invert into time domain
-    correctedTS = np.fft.irfft(corrected_spectrum)
+    correctedTS = np.fft.irfft(corrected_spectrum, len(padded_data))
 
     #cut the zero padding
     correctedTS = correctedTS[:N]
@@ -135,4 +154,229 @@ def correct_for_instrument_response(data, samplingrate, responsedata):
     #re-attach the mean
     correctedTS += datamean
 
-    return correctedTS#, lo_mags,lo_freqs
\ No newline at end of file
+    return correctedTS
+
+
+def get_deconvolution_kernel(samplingrate, responsedata, kernel_len, nfft):
+    """
+    Get the spectrum (real FFT of nfft points) of the FIR deconvolution 
+    kernel of kernel_len points for the given instrument response.
+
+    The kernel is the inverse response (see get_inverse_response) 
+    transformed into the time domain, centred (delay of kernel_len/2 samples)
+    and tapered.  Results are cached per (samplingrate, kernel_len, nfft, 
+    response table).
+    """
+
+    key = ('kernel', float(samplingrate), int(kernel_len), int(nfft),
+           _get_response_key(responsedata))
+    try:
+        return _response_cache[key]
+    except KeyError:
+        pass
+
+    kernel = np.fft.irfft(get_inverse_response(samplingrate, kernel_len, 
+                                               responsedata), kernel_len)
+    kernel = np.roll(kernel, kernel_len/2) * MTfi.tukey(kernel_len, 0.2)
+
+    return _cache_response(key, np.fft.rfft(kernel, nfft))
+
+
+class BlockDeconvolver(object):
+    """
+    Correct time series for the instrument response block by block 
+    (overlap-save), so that arbitrarily long data can be streamed through
+    with bounded memory.
+
+    The deconvolution kernel is an FIR filter of kernel_len points (see 
+    get_deconvolution_kernel), so response values below 
+    samplingrate/kernel_len are not resolved.  Data are processed in FFTs 
+    of block_len points, each giving block_len-kernel_len+1 corrected
+    samples.  The kernel delay is removed, so output sample i corresponds 
+    to input sample i.  Call flush after the last segment to get the 
+    remaining samples.
+
+    Data can be 1D or 2D (samples x channels), all channels are corrected 
+    in the same FFTs.  The mean of the first segment is removed before and
+    re-attached after the correction, as in correct_for_instrument_response.
+
+    Input:
+    - samplingrate
+    - responsedata : 3 column array: frequency, real part, imaginary part
+    
+    Optional input:
+    - kernel_len : length of the deconvolution kernel (default: next power 
+                   of 2 of 4 periods of the lowest non-zero response 
+                   frequency, but at most 2**20)
+    - block_len : FFT length (default: next power of 2 of 4*kernel_len, 
+                  at least 2**16)
+
+    """
+
+    def __init__(self, samplingrate, responsedata, kernel_len=None, 
+                 block_len=None):
+
+        self.samplingrate = float(samplingrate)
+        self.responsedata = np.asarray(responsedata, dtype=np.float)
+
+        if kernel_len is None:
+            #the response table may start at 0 Hz
+            frequencies = self.responsedata[:,0][self.responsedata[:,0] > 0]
+            if len(frequencies) == 0:
+                kernel_len = 2**20
+            else:
+                kernel_len = 4 * self.samplingrate / frequencies.min()
+                kernel_len = min(2**int(np.ceil(np.log2(kernel_len))), 2**20)
+        self.kernel_len = int(kernel_len)
+
+        if block_len is None:
+            block_len = max(2**int(np.ceil(np.log2(4*self.kernel_len))), 2**16)
+        if block_len < self.kernel_len:
+            raise MTex.MTpyError_inputarguments('ERROR - block length must '
+                                                'not be shorter than kernel')
+        self.block_len = int(block_len)
+        self.step = self.block_len - self.kernel_len + 1
+        self.delay = self.kernel_len/2
+
+        self.kernel_spectrum = get_deconvolution_kernel(self.samplingrate,
+                                                        self.responsedata,
+                                                        self.kernel_len,
+                                                        self.block_len)
+
+        self.datamean = None
+        self.n_in = 0
+        self.n_out = 0
+        self._buffer = None
+        self._to_skip = self.delay
+
+    def _convolve_buffer(self):
+        """
+        correct full blocks of the buffer, return the corrected samples
+        """
+
+        lo_corrected = []
+        while len(self._buffer) >= self.block_len:
+            block = self._buffer[:self.block_len]
+            spectrum = np.fft.rfft(block, axis=0)
+            if spectrum.ndim == 2:
+                spectrum *= self.kernel_spectrum[:, np.newaxis]
+            else:
+                spectrum *= self.kernel_spectrum
+            corrected = np.fft.irfft(spectrum, self.block_len, 
+                                     axis=0)[self.kernel_len-1:]
+
+            #the first samples are delayed by the kernel
+            skip = min(self._to_skip, len(corrected))
+            self._to_skip -= skip
+            lo_corrected.append(corrected[skip:])
+            self._buffer = self._buffer[self.step:]
+
+        if len(lo_corrected) == 0:
+            return np.zeros((0,) + self._buffer.shape[1:])
+
+        return np.concatenate(lo_corrected)
+
+    def process(self, data):
+        """
+        Correct the next segment of the time series. 
+
+        Return the corrected samples that are complete (delayed by up to 
+        block_len samples with respect to the input).
+        """
+
+        data = np.array(data, dtype=np.float)
+        if self.datamean is None:
+            self.datamean = np.mean(data, axis=0)
+            #the samples before the start are taken as zero (after demeaning)
+            self._buffer = np.zeros((self.kernel_len-1,) + data.shape[1:])
+
+        self._buffer = np.concatenate([self._buffer, data - self.datamean])
+        self.n_in += len(data)
+
+        corrected = self._convolve_buffer()
+        self.n_out += len(corrected)
+
+        return corrected + self.datamean
+
+    def flush(self):
+        """
+        Return the remaining corrected samples after the last segment. 
+        """
+
+        if self._buffer is None:
+            return np.zeros(0)
+
+        #feed zeros until the last input sample has left the kernel
+        lo_corrected = []
+        n_missing = self.n_in - self.n_out
+        while n_missing > 0:
+            self._buffer = np.concatenate([self._buffer, 
+                            np.zeros((self.step,) + self._buffer.shape[1:])])
+            corrected = self._convolve_buffer()[:n_missing]
+            lo_corrected.append(corrected)
+            n_missing -= len(corrected)
+
+        if len(lo_corrected) == 0:
+            return np.zeros((0,) + self._buffer.shape[1:])
+
+        corrected = np.concatenate(lo_corrected)
+        self.n_out += len(corrected)
+
+        return corrected + self.datamean
+
+
+def block_correct_for_instrument_response(data, samplingrate, responsedata,
+                                          kernel_len=None, block_len=None):
+    """
+    Correct input time series for instrument response with a 
+    BlockDeconvolver (see there for the optional arguments). 
+
+    Data can be 1D or 2D (samples x channels). Return corrected data of 
+    the same shape.
+    """
+
+    deconvolver = BlockDeconvolver(samplingrate, responsedata, 
+                                   kernel_len=kernel_len, block_len=block_len)
+
+    return np.concatenate([deconvolver.process(data), deconvolver.flush()])
+
+
+def _correct_channel(args):
+    """
+    correct one channel of correct_channels_for_instrument_response with 
+    block_correct_for_instrument_response, return the corrected data
+    """
+
+    data, samplingrate, responsedata, kwargs = args
+
+    return block_correct_for_instrument_response(data, samplingrate, 
+                                                 responsedata, **kwargs)
+
+
+def correct_channels_for_instrument_response(lo_data, samplingrate, 
+                                             responsedata, n_processes=1,
+                                             kernel_len=None, block_len=None):
+    """
+    Correct several time series (e.g. channels or files with the same 
+    instrument response) with block_correct_for_instrument_response. 
+
+    If n_processes is not 1, the time series are corrected in parallel 
+    (None uses all cpus).
+
+    Return list of corrected time series.
+    """
+
+    kwargs = {'kernel_len':kernel_len, 'block_len':block_len}
+    lo_args = [(data, samplingrate, responsedata, kwargs) for data in lo_data]
+
+    if n_processes == 1 or len(lo_args) < 2:
+        return [_correct_channel(args) for args in lo_args]
+
+    pool = multiprocessing.Pool(n_processes)
+    try:
+        lo_corrected = pool.map(_correct_channel, lo_args)
+    finally:
+        pool.close()
+        pool.join()
+
+    return lo_corrected
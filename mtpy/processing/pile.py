@@ -5,6 +5,8 @@ import trace, io, util, config
 import numpy as num
 import os, logging, time, weakref, copy, re, sys, operator, math
 import cPickle as pickle
+import sqlite3, itertools, multiprocessing, collections, threading, Queue
+from multiprocessing.pool import ThreadPool
 
         
 def sl(s):
@@ -242,6 +244,7 @@ class TracesFileCache(object):
             trf.by_mtime = None
             trf.data_use_count = 0
             trf.data_loaded = False
+            trf.residency = None
             trf.traces = [ tr.copy(data=False) for tr in trf.traces ]
             for tr in trf.traces:
                 tr.file = trf
@@ -255,20 +258,270 @@ class TracesFileCache(object):
         os.rename(tmpfn, cachefilename)
 
 
-def get_cache(cachedir):
-    '''Get global TracesFileCache object for given directory.'''
+class SQLiteTracesFileCache(object):
+    '''Manages trace metainformation in a local SQLite index.
+    
+    Alternative to :py:class:`TracesFileCache` for large data sets: the
+    metainformation of all files (codes, time span, sampling interval and
+    modification time of each trace) is kept in a single database file with
+    indexes on time range and codes, instead of one pickled dictionary per
+    directory. Modifications are written in a single transaction. The files 
+    relevant for a time span can be looked up without loading the headers of
+    all other files (see :py:meth:`Pile.set_index`).
+    '''
+
+    caches = {}
+
+    # number of modified entries held in memory before they are written
+    max_modified = 1000
+
+    def __init__(self, cachedir, dbname='traces.sqlite'):
+        '''Create new cache.
+        
+        :param cachedir: directory to hold the database file.
+        :param dbname: name of the database file.
+          
+        '''
+
+        self.cachedir = cachedir
+        self.modified = {}
+        self._tlenmax = None
+        util.ensuredir(self.cachedir)
+
+        self.dbpath = pjoin(self.cachedir, dbname)
+        # also used by the prefetch thread of Pile.chopper, access is 
+        # serialized by the load lock of the pile
+        self._conn = sqlite3.connect(self.dbpath, check_same_thread=False)
+        self._conn.text_factory = str
+        with self._conn:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS files (
+                    file_id INTEGER PRIMARY KEY,
+                    abspath TEXT UNIQUE NOT NULL,
+                    format TEXT,
+                    mtime REAL,
+                    tmin REAL,
+                    tmax REAL);
+
+                CREATE TABLE IF NOT EXISTS traces (
+                    file_id INTEGER NOT NULL,
+                    itrace INTEGER NOT NULL,
+                    network TEXT,
+                    station TEXT,
+                    location TEXT,
+                    channel TEXT,
+                    tmin REAL,
+                    tmax REAL,
+                    deltat REAL,
+                    mtime REAL);
+
+                CREATE INDEX IF NOT EXISTS files_tmin ON files (tmin);
+                CREATE INDEX IF NOT EXISTS traces_file ON traces (file_id);
+                CREATE INDEX IF NOT EXISTS traces_tmin ON traces (tmin);
+                CREATE INDEX IF NOT EXISTS traces_codes 
+                    ON traces (network, station, location, channel);
+                ''')
+
+    def get(self, abspath):
+        '''Try to get an item from the cache.
+        
+        :param abspath: absolute path of the object to retrieve
+          
+        :returns: a :py:class:`TracesFile` object (without data) is returned
+            or None if nothing could be found.
+          
+        '''
+
+        if abspath in self.modified:
+            return self.modified[abspath]
+
+        row = self._conn.execute(
+            'SELECT file_id, format, mtime FROM files WHERE abspath = ?', 
+            (abspath,)).fetchone()
+
+        if row is None:
+            return None
+
+        file_id, format, mtime = row
+        traces = []
+        for (network, station, location, channel, tmin, tmax, deltat, 
+                tr_mtime) in self._conn.execute(
+                    'SELECT network, station, location, channel, tmin, tmax, '
+                    'deltat, mtime FROM traces WHERE file_id = ? '
+                    'ORDER BY itrace', (file_id,)):
+
+            traces.append(trace.Trace(network, station, location, channel,
+                tmin=tmin, tmax=tmax, deltat=deltat, mtime=tr_mtime))
+
+        return TracesFile(None, abspath, format, mtime=mtime, traces=traces)
+
+    def put(self, abspath, tfile):
+        '''Put an item into the cache.
+        
+        :param abspath: absolute path of the object to be stored
+        :param tfile: :py:class:`TracesFile` object to be stored
+        '''
+
+        self.modified[abspath] = tfile
+        if len(self.modified) >= self.max_modified:
+            self.dump_modified()
+
+    def dump_modified(self):
+        '''Save any modifications to disk.'''
+
+        if not self.modified:
+            return
+
+        with self._conn:
+            for abspath, tfile in self.modified.iteritems():
+                self._delete(abspath)
+                cursor = self._conn.execute(
+                    'INSERT INTO files (abspath, format, mtime, tmin, tmax) '
+                    'VALUES (?, ?, ?, ?, ?)', 
+                    (abspath, tfile.format, tfile.mtime, 
+                     _float_or_none(tfile.tmin), _float_or_none(tfile.tmax)))
+
+                file_id = cursor.lastrowid
+                self._conn.executemany(
+                    'INSERT INTO traces VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [ (file_id, itr, tr.network, tr.station, tr.location, 
+                       tr.channel, float(tr.tmin), float(tr.tmax), tr.deltat,
+                       tr.mtime) for (itr, tr) in enumerate(tfile.traces) ])
+
+        self.modified = {}
+        self._tlenmax = None
+
+    def clean(self):
+        '''Weed out missing files from the index.'''
+
+        self.dump_modified()
+
+        missing = [ (abspath,) for (abspath,) in 
+                    self._conn.execute('SELECT abspath FROM files') 
+                    if not os.path.isfile(abspath) ]
+
+        with self._conn:
+            for (abspath,) in missing:
+                self._delete(abspath)
+
+        self._tlenmax = None
+
+    def get_extent(self):
+        '''Get combined time span of all indexed files.
+
+        :returns: tuple ``(tmin, tmax)``, ``(None, None)`` if the index is 
+            empty.
+        '''
+
+        self.dump_modified()
+        return self._conn.execute(
+            'SELECT MIN(tmin), MAX(tmax) FROM files').fetchone()
+
+    def relevant_abspaths(self, tmin, tmax, nslc=None):
+        '''Get paths of the indexed files with traces overlapping a time span.
+
+        :param tmin: start time of the time span
+        :param tmax: end time of the time span
+        :param nslc: optional tuple ``(network, station, location, channel)``
+            restricting the result to files containing such traces. Entries
+            which are ``None`` match any code.
+
+        :returns: sorted list of absolute paths
+        '''
+
+        self.dump_modified()
+
+        if self._tlenmax is None:
+            self._tlenmax = self._conn.execute(
+                'SELECT MAX(tmax - tmin) FROM traces').fetchone()[0]
+            if self._tlenmax is None:
+                return []
+
+        # the tmin index limits the search to [tmin - tlenmax, tmax]
+        query = ('SELECT DISTINCT files.abspath FROM traces '
+                 'JOIN files ON traces.file_id = files.file_id '
+                 'WHERE traces.tmin >= ? AND traces.tmin <= ? '
+                 'AND traces.tmax >= ?')
+        args = [ tmin - self._tlenmax, tmax, tmin ]
+
+        if nslc is not None:
+            for name, code in zip(('network', 'station', 'location', 
+                                   'channel'), nslc):
+                if code is not None:
+                    query += ' AND traces.%s = ?' % name
+                    args.append(code)
+
+        return sorted( abspath for (abspath,) in 
+                       self._conn.execute(query + ' ORDER BY files.abspath', 
+                                          args) )
+
+    def _delete(self, abspath):
+        self._conn.execute('DELETE FROM traces WHERE file_id IN '
+            '(SELECT file_id FROM files WHERE abspath = ?)', (abspath,))
+        self._conn.execute('DELETE FROM files WHERE abspath = ?', (abspath,))
+
+
+def _float_or_none(x):
+    if x is None:
+        return None
+    return float(x)
+
+
+def get_cache(cachedir, backend='pickle'):
+    '''Get global cache object for given directory.
+
+    :param backend: ``'pickle'`` for a :py:class:`TracesFileCache`, 
+        ``'sqlite'`` for a :py:class:`SQLiteTracesFileCache`
+    '''
+
+    if backend == 'sqlite':
+        if cachedir not in SQLiteTracesFileCache.caches:
+            SQLiteTracesFileCache.caches[cachedir] = \
+                SQLiteTracesFileCache(cachedir)
+
+        return SQLiteTracesFileCache.caches[cachedir]
+
     if cachedir not in TracesFileCache.caches:
         TracesFileCache.caches[cachedir] = TracesFileCache(cachedir)
         
     return TracesFileCache.caches[cachedir]
     
-def loader(filenames, fileformat, cache, filename_attributes, show_progress=True, update_progress=None):
+def _load_headers_task(args):
+    '''Read the trace headers of one file (worker of :py:func:`loader`).
+
+    Returns the traces without back reference to their file, so that they
+    can be sent back from a worker process.
+    '''
+
+    abspath, fileformat, substitutions, mtime = args
+    try:
+        tfile = TracesFile(None, abspath, fileformat, substitutions=substitutions, mtime=mtime)
+    except (io.FileLoadError, OSError), xerror:
+        return None, str(xerror)
+
+    for tr in tfile.traces:
+        tr.file = None
+
+    return tfile.traces, None
+
+def loader(filenames, fileformat, cache, filename_attributes, show_progress=True, update_progress=None, n_threads=1, n_processes=1):
+    '''Generate TracesFile objects for the given files, using the cache.
+
+    The headers of new or modified files are read in a pool of *n_processes*
+    worker processes or, if only *n_threads* > 1 is given, of worker threads.
+    The files are generated in the same order as without the pool, and cache
+    updates and failure reports are handled in the calling thread. While
+    scanning, the throughput is added to the label passed to 
+    *update_progress*, e.g. ``'Scanning files (120 files/s)'``, updated 
+    about once per second.
+    '''
 
     class Progress:
         def __init__(self, label, n):
             self._label = label
             self._n = n
             self._bar = None
+            self.rate = None
             if show_progress:
                 self._bar = util.progressbar(label, self._n)
 
@@ -284,7 +537,11 @@ def loader(filenames, fileformat, cache, filename_attributes, show_progress=True
                     self._bar = None
             
             if update_progress:
-                update_progress(self._label, i, self._n)
+                label = self._label
+                if self.rate is not None:
+                    label += ' (%.0f files/s)' % self.rate
+
+                update_progress(label, i, self._n)
 
     if not filenames:
         logger.warn('No files to load from')
@@ -340,28 +597,70 @@ def loader(filenames, fileformat, cache, filename_attributes, show_progress=True
     if to_load:
         progress = Progress('Scanning files', nload)
 
-        for (mustload, mtime, abspath, substitutions, tfile) in to_load:
-            try:
+        tasks = [ (abspath, fileformat, substitutions, mtime) 
+                  for (mustload, mtime, abspath, substitutions, tfile) in to_load if mustload ]
+
+        pool = None
+        if n_processes > 1:
+            pool = multiprocessing.Pool(n_processes)
+        elif n_threads > 1:
+            pool = ThreadPool(n_threads)
+
+        finished = False
+        try:
+            if pool is None:
+                results = itertools.imap(_load_headers_task, tasks)
+            else:
+                nworkers = max(n_processes, n_threads)
+                chunksize = max(1, min(64, len(tasks) // (4*nworkers)))
+                results = pool.imap(_load_headers_task, tasks, chunksize)
+
+            nscanned = 0
+            tstart = tlast = time.time()
+            for (mustload, mtime, abspath, substitutions, tfile) in to_load:
                 if mustload:
-                    tfile = TracesFile(None, abspath, fileformat, substitutions=substitutions, mtime=mtime)
-                    if cache and not substitutions:
-                        cache.put(abspath, tfile)
+                    traces, xerror = results.next()
+                    nscanned += 1
+                    if traces is None:
+                        failures.append(abspath)
+                        logger.warn(xerror)
+                        tfile = None
+                    else:
+                        tfile = TracesFile(None, abspath, fileformat, substitutions=substitutions, mtime=mtime, traces=traces)
+                        if cache and not substitutions:
+                            cache.put(abspath, tfile)
                     
-                    if not count_all:
-                        iload += 1
+                        if not count_all:
+                            iload += 1
 
                 if count_all:
                     iload += 1
-                    
-            except (io.FileLoadError, OSError), xerror:
-                failures.append(abspath)
-                logger.warn(xerror)
-            else:
-                yield tfile
+
+                if tfile is not None:
+                    yield tfile
+                
+                if time.time() - tlast > 1.:
+                    tlast = time.time()
+                    progress.rate = nscanned/(tlast-tstart)
+
+                progress.update(iload+1)
             
-            progress.update(iload+1)
-        
-        progress.update(nload)
+            progress.update(nload)
+            finished = True
+
+        finally:
+            if pool is not None:
+                if finished:
+                    pool.close()
+                else:
+                    # iteration aborted, do not wait for remaining files
+                    pool.terminate()
+                pool.join()
+
+        if nscanned:
+            tscan = time.time() - tstart
+            logger.info('Scanned headers of %i file%s in %.1f s (%.1f files/s)' % 
+                (nscanned, util.plural_s(nscanned), tscan, nscanned/max(tscan, 1e-6)))
 
     if failures:
         logger.warn('The following file%s caused problems and will be ignored:\n' % util.plural_s(len(failures)) + '\n'.join(failures))
@@ -372,6 +671,92 @@ def loader(filenames, fileformat, cache, filename_attributes, show_progress=True
 def tlen(x):
     return x.tmax-x.tmin
 
+class DataResidency(object):
+    
+    '''Pile-wide manager of loaded trace data.
+    
+    Keeps track of the :py:class:`TracesFile` objects with loaded data in
+    least-recently-used order and of the number of bytes they hold. When 
+    *max_bytes* is exceeded, the data of the least recently used files are
+    dropped, unless the files are in use (see :py:meth:`TracesFile.use_data`)
+    or pinned, e.g. during :py:meth:`Pile.chop`. With *max_bytes* ``None``,
+    data are only counted.
+    '''
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._files = collections.OrderedDict()
+        self._pins = Counter()
+        self.nbytes = 0
+        self.nbytes_peak = 0
+        self.nloads = 0
+        self.nhits = 0
+        self.nevictions = 0
+        self.nbytes_evicted = 0
+
+    def loaded(self, file, loaded_now=True):
+        '''Register access to the (possibly just loaded) data of a file.'''
+        
+        if file in self._files:
+            self.nbytes -= self._files.pop(file)
+            if not loaded_now:
+                self.nhits += 1
+
+        if loaded_now:
+            self.nloads += 1
+
+        nbytes = file.get_data_nbytes()
+        self._files[file] = nbytes
+        self.nbytes += nbytes
+        self.nbytes_peak = max(self.nbytes_peak, self.nbytes)
+        self.evict()
+
+    def forget(self, file):
+        '''Stop tracking a file, e.g. when its data has been dropped.'''
+        
+        if file in self._files:
+            self.nbytes -= self._files.pop(file)
+
+    def pin(self, file):
+        self._pins[file] += 1
+
+    def unpin(self, file):
+        self._pins.subtract1(file)
+
+    def evict(self):
+        '''Drop data of least recently used files until within budget.'''
+        
+        if self.max_bytes is None:
+            return
+
+        for file in self._files.keys():
+            if self.nbytes <= self.max_bytes:
+                break
+            
+            if file in self._pins or file.data_use_count > 0:
+                continue
+
+            nbytes = self._files.pop(file)
+            self.nbytes -= nbytes
+            self.nevictions += 1
+            self.nbytes_evicted += nbytes
+            logger.debug('evicting data of file: %s' % file.abspath)
+            file.unload_data()
+
+    def get_stats(self):
+        '''Get counters as dict.'''
+        
+        return dict(
+            max_bytes=self.max_bytes,
+            nbytes=self.nbytes,
+            nbytes_peak=self.nbytes_peak,
+            nfiles=len(self._files),
+            npinned=len(self._pins),
+            nloads=self.nloads,
+            nhits=self.nhits,
+            nevictions=self.nevictions,
+            nbytes_evicted=self.nbytes_evicted)
+
 class TracesGroup(object):
     
     '''Trace container base class.
@@ -595,7 +980,11 @@ class MemTracesFile(TracesGroup):
         return s
 
 class TracesFile(TracesGroup):
-    def __init__(self, parent, abspath, format, substitutions=None, mtime=None):
+    
+    # DataResidency manager of the pile, set by Pile.add_file
+    residency = None
+    
+    def __init__(self, parent, abspath, format, substitutions=None, mtime=None, traces=None):
         TracesGroup.__init__(self, parent)
         self.abspath = abspath
         self.format = format
@@ -603,7 +992,14 @@ class TracesFile(TracesGroup):
         self.data_loaded = False
         self.data_use_count = 0
         self.substitutions = substitutions
-        self.load_headers(mtime=mtime)
+        if traces is None:
+            self.load_headers(mtime=mtime)
+        else:
+            # headers given, e.g. from SQLiteTracesFileCache
+            self.traces = traces
+            for tr in self.traces:
+                tr.file = self
+            self.add(self.traces)
         self.mtime = mtime
         
     def load_headers(self, mtime=None):
@@ -611,6 +1007,9 @@ class TracesFile(TracesGroup):
         if mtime is None:
             self.mtime = os.stat(self.abspath)[8]
         
+        if self.residency is not None:
+            self.residency.forget(self)
+
         self.remove(self.traces)
         for tr in io.load(self.abspath, format=self.format, getdata=False, substitutions=self.substitutions):
             self.traces.append(tr)
@@ -623,7 +1022,8 @@ class TracesFile(TracesGroup):
         
     def load_data(self, force=False):
         file_changed = False
-        if not self.data_loaded or force:
+        loaded_now = not self.data_loaded or force
+        if loaded_now:
             logger.debug('loading data from file: %s' % self.abspath)
             
             for itr, tr in enumerate(io.load(self.abspath, format=self.format, getdata=True, substitutions=self.substitutions)):
@@ -647,6 +1047,10 @@ class TracesFile(TracesGroup):
                     logger.warn('file may have changed since last access (new trace found): %s' % self.abspath)
                     file_changed = True
             self.data_loaded = True
+
+        if self.residency is not None:
+            self.residency.loaded(self, loaded_now)
+
         return file_changed
     
     def use_data(self):
@@ -655,7 +1059,7 @@ class TracesFile(TracesGroup):
         
     def drop_data(self):
         if self.data_loaded:
-            if self.data_use_count == 1:
+            if self.data_use_count == 1 and self.residency is None:
                 logger.debug('forgetting data of file: %s' % self.abspath)
                 for tr in self.traces:
                     tr.drop_data()
@@ -663,8 +1067,29 @@ class TracesFile(TracesGroup):
                 self.data_loaded = False
                     
             self.data_use_count -= 1    
+
+            if self.residency is not None and self.data_use_count <= 0:
+                # data stays resident until evicted by the residency manager
+                self.residency.evict()
         else:
             self.data_use_count = 0
+
+    def unload_data(self):
+        '''Forget data of all traces, regardless of the use count.'''
+        
+        if self.data_loaded:
+            logger.debug('forgetting data of file: %s' % self.abspath)
+            for tr in self.traces:
+                tr.drop_data()
+
+            self.data_loaded = False
+
+        self.data_use_count = 0
+
+    def get_data_nbytes(self):
+        '''Get number of bytes held by the loaded trace data.'''
+        
+        return sum( tr.ydata.nbytes for tr in self.traces if tr.ydata is not None )
             
     def reload_if_modified(self):
         mtime = os.stat(self.abspath)[8]
@@ -787,12 +1212,20 @@ class SubPile(TracesGroup):
 
              
 class Pile(TracesGroup):
-    def __init__(self):
+    def __init__(self, data_budget=None):
         TracesGroup.__init__(self, None)
         self.subpiles = {}
         self.open_files = {}
         self.listeners = []
         self.abspaths = set()
+        self.index = None
+        self.indexed_files = {}
+        self.residency = None
+        if data_budget is not None:
+            self.set_data_budget(data_budget)
+
+        # serializes data loading of chop and the chopper prefetch thread
+        self._load_lock = threading.Lock()
     
     def add_listener(self, obj):
         self.listeners.append(weakref.ref(obj))
@@ -803,8 +1236,9 @@ class Pile(TracesGroup):
             if obj:
                 obj.pile_changed(what)
     
-    def load_files(self, filenames, filename_attributes=None, fileformat='mseed', cache=None, show_progress=True, update_progress=None):
-        l = loader(filenames, fileformat, cache, filename_attributes, show_progress=show_progress, update_progress=update_progress)
+    def load_files(self, filenames, filename_attributes=None, fileformat='mseed', cache=None, show_progress=True, update_progress=None, n_threads=1, n_processes=1):
+        l = loader(filenames, fileformat, cache, filename_attributes, show_progress=show_progress, update_progress=update_progress,
+                   n_threads=n_threads, n_processes=n_processes)
         self.add_files(l)
         
     def add_files(self, files):
@@ -820,12 +1254,19 @@ class Pile(TracesGroup):
         subpile.add_file(file)
         if file.abspath is not None:
             self.abspaths.add(file.abspath)
+
+        if self.residency is not None and isinstance(file, TracesFile):
+            file.residency = self.residency
+            if file.data_loaded:
+                self.residency.loaded(file, False)
     
     def remove_file(self, file):
         subpile = file.get_parent()
         subpile.remove_file(file)
         if file.abspath is not None:
             self.abspaths.remove(file.abspath)
+
+        self._release_residency(file)
         
     def remove_files(self, files):
         subpile_files = {}
@@ -841,6 +1282,43 @@ class Pile(TracesGroup):
             for file in files:
                 if file.abspath is not None:
                     self.abspaths.remove(file.abspath)
+
+                self._release_residency(file)
+
+    def _release_residency(self, file):
+        if self.residency is not None and isinstance(file, TracesFile):
+            self.residency.forget(file)
+            file.residency = None
+
+    def set_data_budget(self, max_bytes):
+        '''Limit the memory held by loaded trace data.
+
+        Data of files which are not in use are kept in memory after 
+        :py:meth:`chop` and :py:meth:`chopper` until the total size of the
+        loaded data exceeds *max_bytes*; the data of the least recently used
+        files are dropped then. With *max_bytes* ``None``, data are kept and 
+        counted but never dropped automatically.
+        '''
+
+        if self.residency is None:
+            self.residency = DataResidency(max_bytes)
+            for file in self.iter_files():
+                if isinstance(file, TracesFile):
+                    file.residency = self.residency
+                    if file.data_loaded:
+                        self.residency.loaded(file, False)
+        else:
+            self.residency.max_bytes = max_bytes
+            self.residency.evict()
+
+    def get_data_stats(self):
+        '''Get statistics of the data residency manager as dict, or ``None``
+        if no data budget has been set.'''
+
+        if self.residency is None:
+            return None
+
+        return self.residency.get_stats()
         
     def dispatch_key(self, file):
         dt = int(math.floor(math.log(file.deltatmin)))
@@ -856,31 +1334,143 @@ class Pile(TracesGroup):
     def get_deltats(self):
         return self.deltats.keys()
 
+    def set_index(self, index):
+        '''Use a :py:class:`SQLiteTracesFileCache` as lazy source of files.
+
+        Instead of holding the headers of all files, the pile then adds the
+        files overlapping the requested time span on demand in :py:meth:`chop`
+        and :py:meth:`chopper`, and forgets files from the index without
+        loaded data which end before the requested time span.
+        '''
+
+        self.index = index
+
+    def _update_from_index(self, tmin, tmax, remove_stale=True):
+        relevant = set(self.index.relevant_abspaths(tmin, tmax))
+        for abspath in relevant:
+            if abspath not in self.abspaths:
+                tfile = self.index.get(abspath)
+                if tfile is not None:
+                    self.add_file(tfile)
+                    self.indexed_files[abspath] = tfile
+
+        if not remove_stale:
+            return
+
+        stale = [ file for (abspath, file) in self.indexed_files.iteritems() 
+                  if abspath not in relevant and file.tmax < tmin and 
+                  not file.data_loaded ]
+
+        if stale:
+            self.remove_files(stale)
+            for file in stale:
+                del self.indexed_files[file.abspath]
+
     def chop(self, tmin, tmax, group_selector=None, trace_selector=None, snap=(round,round), include_last=False, load_data=True):
+        return self._chop(tmin, tmax, group_selector, trace_selector, snap, include_last, load_data)
+
+    def _chop(self, tmin, tmax, group_selector, trace_selector, snap, include_last, load_data, open_files=None):
+        '''Chop the relevant traces, see :py:meth:`chop`.
+
+        With *open_files* given (a set, by :py:meth:`chopper`), the used 
+        files which are not in it yet are marked via 
+        :py:meth:`TracesFile.use_data` and added to it while they are still
+        pinned, so that their data cannot be evicted in between.
+        '''
+
         chopped = []
         used_files = set()
         
-        traces = self.relevant(tmin, tmax, group_selector, trace_selector)
-        if load_data:
-            files_changed = False
+        with self._load_lock:
+            if self.index is not None:
+                self._update_from_index(tmin, tmax)
+
+            traces = self.relevant(tmin, tmax, group_selector, trace_selector)
+
+            # protect the data of all files needed here from eviction
+            pinned = set()
+            if load_data and self.residency is not None:
+                pinned = set([ tr.file for tr in traces ])
+                for file in pinned:
+                    self.residency.pin(file)
+
+        try:
+            if load_data:
+                with self._load_lock:
+                    files_changed = False
+                    for tr in traces:
+                        if tr.file not in used_files:
+                            if tr.file.load_data():
+                                files_changed = True
+
+                            used_files.add(tr.file)
+                    
+                    if files_changed:
+                        traces = self.relevant(tmin, tmax, group_selector, trace_selector)
+
+                    if open_files is not None:
+                        for file in used_files - open_files:
+                            file.use_data()
+
+                        open_files.update(used_files)
+
             for tr in traces:
-                if tr.file not in used_files:
-                    if tr.file.load_data():
-                        files_changed = True
+                try:
+                    chopped.append(tr.chop(tmin,tmax,inplace=False,snap=snap, include_last=include_last))
+                except trace.NoData:
+                    pass
 
-                    used_files.add(tr.file)
-            
-            if files_changed:
-                traces = self.relevant(tmin, tmax, group_selector, trace_selector)
+        finally:
+            if pinned:
+                with self._load_lock:
+                    for file in pinned:
+                        self.residency.unpin(file)
 
-        for tr in traces:
-            try:
-                chopped.append(tr.chop(tmin,tmax,inplace=False,snap=snap, include_last=include_last))
-            except trace.NoData:
-                pass
+                    self.residency.evict()
 
         return chopped, used_files
 
+    def _prefetch(self, tmin, tmax, group_selector, trace_selector, stop):
+        '''Load and use data of the files relevant for a time span (called 
+        from the prefetch thread of chopper).'''
+        
+        with self._load_lock:
+            if self.index is not None:
+                self._update_from_index(tmin, tmax, remove_stale=False)
+
+            files = set([ tr.file for tr in self.relevant(tmin, tmax, group_selector, trace_selector) ])
+
+        used = []
+        try:
+            for file in files:
+                if stop.is_set():
+                    break
+
+                with self._load_lock:
+                    # loading may evict data, but not of the file itself
+                    if self.residency is not None:
+                        self.residency.pin(file)
+
+                    try:
+                        file.load_data()
+                        file.use_data()
+                    finally:
+                        if self.residency is not None:
+                            self.residency.unpin(file)
+
+                used.append(file)
+
+        except:
+            self._release(used)
+            raise
+
+        return used
+
+    def _release(self, files):
+        with self._load_lock:
+            for file in files:
+                file.drop_data()
+
     def _process_chopped(self, chopped, degap, maxgap, maxlap, want_incomplete, wmax, wmin, tpad):
         chopped.sort(lambda a,b: cmp(a.full_id, b.full_id))
         if degap:
@@ -910,53 +1500,85 @@ class Pile(TracesGroup):
         return chopped
             
     def chopper(self, tmin=None, tmax=None, tinc=None, tpad=0., group_selector=None, trace_selector=None,
-                      want_incomplete=True, degap=True, maxgap=5, maxlap=None, keep_current_files_open=False, accessor_id=None, snap=(round,round), include_last=False, load_data=True):
+                      want_incomplete=True, degap=True, maxgap=5, maxlap=None, keep_current_files_open=False, accessor_id=None, snap=(round,round), include_last=False, load_data=True,
+                      prefetch=0):
         
+        '''Iterate over time windows of the pile, yielding lists of chopped traces.
+
+        With *prefetch* > 0, a background thread loads the data of up to 
+        *prefetch* windows ahead of the one currently processed. The 
+        prefetched files are marked as used (see :py:meth:`TracesFile.use_data`)
+        until their window has been processed, so that they are not dropped 
+        in between.
+        '''
+
+        if self.index is not None:
+            ptmin, ptmax = self.index.get_extent()
+            if ptmin is None: return
+        else:
+            ptmin, ptmax = self.tmin, self.tmax
+
         if tmin is None:
-            tmin = self.tmin+tpad
+            tmin = ptmin+tpad
                 
         if tmax is None:
-            tmax = self.tmax-tpad
+            tmax = ptmax-tpad
             
         if tinc is None:
             tinc = tmax-tmin
         
-        if not self.is_relevant(tmin-tpad,tmax+tpad,group_selector): return
+        if self.index is not None:
+            if not (tmax+tpad >= ptmin and ptmax >= tmin-tpad): return
+        elif not self.is_relevant(tmin-tpad,tmax+tpad,group_selector): return
                 
         if accessor_id not in self.open_files:
             self.open_files[accessor_id] = set()
                 
         open_files = self.open_files[accessor_id]
         
-        iwin = 0
-        while True:
-            chopped = []
+        def window(iwin):
             wmin, wmax = tmin+iwin*tinc, min(tmin+(iwin+1)*tinc, tmax)
             eps = tinc*1e-6
-            if wmin >= tmax-eps: break
-            chopped, used_files = self.chop(wmin-tpad, wmax+tpad, group_selector, trace_selector, snap, include_last, load_data) 
-            for file in used_files - open_files:
-                # increment datause counter on newly opened files
-                file.use_data()
+            if wmin >= tmax-eps: return None
+            return wmin, wmax
+
+        prefetcher = None
+        if prefetch > 0 and load_data:
+            prefetcher = _Prefetcher(self, window, tpad, group_selector, trace_selector, prefetch)
+
+        try:
+            iwin = 0
+            while True:
+                chopped = []
+                w = window(iwin)
+                if w is None: break
+                wmin, wmax = w
+                if prefetcher is not None:
+                    prefetcher.wait(iwin)
+
+                # increments the datause counter on newly opened files
+                chopped, used_files = self._chop(wmin-tpad, wmax+tpad, group_selector, trace_selector, snap, include_last, load_data, open_files) 
                 
-            open_files.update(used_files)
-            
-            processed = self._process_chopped(chopped, degap, maxgap, maxlap, want_incomplete, wmax, wmin, tpad)
-            yield processed
-                        
-            unused_files = open_files - used_files
-            
-            while unused_files:
-                file = unused_files.pop()
-                file.drop_data()
-                open_files.remove(file)
+                processed = self._process_chopped(chopped, degap, maxgap, maxlap, want_incomplete, wmax, wmin, tpad)
+                yield processed
+                            
+                unused_files = open_files - used_files
                 
-            iwin += 1
+                self._release(unused_files)
+                open_files -= unused_files
+
+                if prefetcher is not None:
+                    prefetcher.release()
+                    
+                iwin += 1
+
+        finally:
+            if prefetcher is not None:
+                prefetcher.stop()
         
         if not keep_current_files_open:
-            while open_files:
-                file = open_files.pop()
-                file.drop_data()
+            self._release(open_files)
+            open_files.clear()
         
         
     def all(self, *args, **kwargs):
@@ -1074,9 +1696,92 @@ class Pile(TracesGroup):
         from pyrocko.snuffler import snuffle
         snuffle(self, **kwargs)
 
+class _Prefetcher(object):
+    
+    '''Loads the data for the next windows of :py:meth:`Pile.chopper` in a 
+    background thread.
+    
+    At most *depth* windows are loaded ahead. The files of each prefetched 
+    window are held via :py:meth:`TracesFile.use_data` until 
+    :py:meth:`release` is called after the window has been processed.
+    '''
+
+    def __init__(self, pile, window, tpad, group_selector, trace_selector, depth):
+        self._pile = pile
+        self._window = window
+        self._tpad = tpad
+        self._group_selector = group_selector
+        self._trace_selector = trace_selector
+        self._queue = Queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._current = []
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        iwin = 0
+        try:
+            while not self._stop.is_set():
+                w = self._window(iwin)
+                if w is None:
+                    break
+
+                wmin, wmax = w
+                files = self._pile._prefetch(wmin-self._tpad, wmax+self._tpad, 
+                    self._group_selector, self._trace_selector, self._stop)
+
+                self._put((iwin, files, None))
+                iwin += 1
+
+        except Exception, xerror:
+            self._put((iwin, [], xerror))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+        self._pile._release(item[1])
+
+    def wait(self, iwin):
+        '''Wait until the data of window *iwin* has been loaded.'''
+        
+        self.release()
+        jwin, files, xerror = self._queue.get()
+        if xerror is not None:
+            raise xerror
+
+        assert jwin == iwin
+        self._current = files
+
+    def release(self):
+        '''Release the files of the current window.'''
+        
+        self._pile._release(self._current)
+        self._current = []
+
+    def stop(self):
+        '''Stop the thread and release all prefetched files.'''
+        
+        self._stop.set()
+        self._thread.join()
+        self.release()
+        while True:
+            try:
+                jwin, files, xerror = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+
+            self._pile._release(files)
+
 def make_pile( paths=None, selector=None, regex=None,
         fileformat = 'mseed',
-        cachedirname=config.cache_dir, show_progress=True ):
+        cachedirname=config.cache_dir, show_progress=True, index=False,
+        n_threads=1, n_processes=1, data_budget=None ):
     
     '''Create pile from given file and directory names.
     
@@ -1091,6 +1796,15 @@ def make_pile( paths=None, selector=None, regex=None,
     :param cachedirname: loader cache is stored under this directory. It is
         created as neccessary.
     :param show_progress: show progress bar and other progress information
+    :param index: if ``True``, the trace metainformation is stored in a 
+        :py:class:`SQLiteTracesFileCache` under *cachedirname* and the pile 
+        adds files from it on demand when chopping (see 
+        :py:meth:`Pile.set_index`)
+    :param n_threads: number of threads reading file headers
+    :param n_processes: number of processes reading file headers (used 
+        instead of threads if > 1)
+    :param data_budget: maximum number of bytes of trace data to be kept in
+        memory (see :py:meth:`Pile.set_data_budget`)
     '''
     if isinstance(paths, str):
         paths = [ paths ]
@@ -1100,9 +1814,19 @@ def make_pile( paths=None, selector=None, regex=None,
     
     fns = util.select_files(paths, selector, regex, show_progress=show_progress)
 
-    cache = get_cache(cachedirname)
-    p = Pile()
-    p.load_files( sorted(fns), cache=cache, fileformat=fileformat, show_progress=show_progress)
+    p = Pile(data_budget=data_budget)
+    if index:
+        cache = get_cache(cachedirname, backend='sqlite')
+        for tfile in loader(sorted(fns), fileformat, cache, None, show_progress=show_progress,
+                            n_threads=n_threads, n_processes=n_processes):
+            pass
+        
+        p.set_index(cache)
+    else:
+        cache = get_cache(cachedirname)
+        p.load_files( sorted(fns), cache=cache, fileformat=fileformat, show_progress=show_progress,
+                      n_threads=n_threads, n_processes=n_processes)
+
     return p
 
 
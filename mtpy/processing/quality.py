@@ -22,7 +22,464 @@ import sys, os
 import os.path as op
 
 import copy
-
+import time
+import multiprocessing
 
 import  mtpy.utils.exceptions as MTex
+import mtpy.utils.filehandling as MTfh
+#=================================================================
+
+#per-window summary table, one row per window and channel
+quality_dtype = np.dtype([('station', 'S16'), ('channel', 'S8'), 
+                          ('t_start', np.float64), ('n_samples', np.int32),
+                          ('rms', np.float32), ('n_spikes', np.int32), 
+                          ('n_clipped', np.int32), 
+                          ('powerline_ratio', np.float32), 
+                          ('dropout', np.bool_)])
+
 #=================================================================
+
+
+def window_rms(windows):
+    """
+    RMS of the demeaned windows (rows of a 2D array).
+    """
+
+    return np.sqrt(np.var(windows, axis=1))
+
+
+def count_spikes(windows, threshold=10.):
+    """
+    Number of samples per window, which deviate from the window median by 
+    more than 'threshold' times the standard deviation estimated from the 
+    median absolute deviation. Constant windows have no spikes.
+    """
+
+    median = np.median(windows, axis=1)[:, np.newaxis]
+    deviation = np.abs(windows - median)
+    sigma = 1.4826 * np.median(deviation, axis=1)[:, np.newaxis]
+    
+    return np.sum((deviation > threshold * sigma) & (sigma > 0), axis=1)
+
+
+def count_clipped(windows, clip_level=None, clip_run=3):
+    """
+    Number of clipped samples per window.
+
+    With a 'clip_level' (e.g. the full scale of the logger), samples with 
+    an absolute value of at least clip_level are counted. Otherwise a 
+    window is considered clipped, if its maximum (minimum) value occurs at 
+    least 'clip_run' times, and these samples are counted. Constant 
+    windows are reported as dropouts, not as clipped.
+    """
+
+    if clip_level is not None:
+        return np.sum(np.abs(windows) >= clip_level, axis=1)
+
+    wmax = windows.max(axis=1)[:, np.newaxis]
+    wmin = windows.min(axis=1)[:, np.newaxis]
+    n_max = np.sum(windows == wmax, axis=1)
+    n_min = np.sum(windows == wmin, axis=1)
+    n_clipped = n_max * (n_max >= clip_run) + n_min * (n_min >= clip_run)
+    n_clipped[wmax[:, 0] == wmin[:, 0]] = 0
+
+    return n_clipped
+
+
+def powerline_ratio(windows, df, powerline=60., n_harmonics=3, 
+                    bandwidth=2.):
+    """
+    Ratio (dB) of the power at the powerline frequency and its harmonics 
+    to the background power around them, for each window.
+
+    The line power is the (Hann tapered) power spectrum summed over the 
+    three frequency bins around each harmonic, the background is estimated
+    from the median of the spectrum within 'bandwidth' Hz around the 
+    harmonic (without the line itself), scaled to the mean power of three 
+    bins of a noise spectrum, so that white noise gives about 0 dB. 
+    Harmonics above the Nyquist frequency are ignored, if none is left, 
+    NaN is returned.
+    """
+
+    n = windows.shape[1]
+    taper = np.hanning(n + 1)[:-1]
+    spectra = np.fft.rfft((windows - windows.mean(axis=1)[:, np.newaxis]) *
+                          taper, axis=1)
+    power = spectra.real**2 + spectra.imag**2
+    
+    fbin = df / n
+    line = np.zeros(len(windows))
+    background = np.zeros(len(windows))
+    n_lines = 0
+    for k in range(1, n_harmonics + 1):
+        i_line = int(round(k * powerline / fbin))
+        n_band = max(3, int(round(bandwidth / fbin)))
+        if i_line + n_band >= power.shape[1]:
+            break
+        if i_line < 3:
+            continue
+        line += power[:, i_line - 1:i_line + 2].sum(axis=1)
+        side = np.concatenate((power[:, max(0, i_line - n_band):i_line - 2],
+                               power[:, i_line + 3:i_line + n_band + 1]), 
+                              axis=1)
+        #median of exponentially distributed noise power is ln(2)*mean
+        background += 3 * np.median(side, axis=1) / np.log(2)
+        n_lines += 1
+
+    if n_lines == 0:
+        return np.nan * np.ones(len(windows))
+
+    ratio = np.nan * np.ones(len(windows))
+    nonzero = (background > 0) & (line > 0)
+    ratio[nonzero] = 10 * np.log10(line[nonzero] / background[nonzero])
+
+    return ratio
+
+
+def longest_constant_run(windows):
+    """
+    Length of the longest run of identical consecutive samples in each 
+    window (1 if no two consecutive samples are equal).
+    """
+
+    equal = (np.diff(windows, axis=1) == 0).astype(np.int64)
+    count = np.cumsum(equal, axis=1)
+    #count at the last unequal sample before each position
+    reset = np.maximum.accumulate(np.where(equal == 0, count, 0), axis=1)
+    
+    return (count - reset).max(axis=1) + 1
+
+
+class QualityMonitor(object):
+    """
+    Data quality metrics of a time series that comes in consecutive 
+    chunks, computed over non-overlapping windows.
+
+    For every window the RMS, the number of spikes and clipped samples, the
+    powerline-to-background ratio and a dropout flag (a run of at least 
+    'dropout_len' constant samples, or non finite samples) are determined, 
+    see the functions window_rms, count_spikes, count_clipped, 
+    powerline_ratio and longest_constant_run. All complete windows of a 
+    chunk are evaluated at once, the remaining samples are kept for the 
+    next chunk, so memory only depends on the chunk and window lengths.
+
+    Arguments:
+    ----------
+        **df** : float
+                 sampling rate in Hz
+
+        **window_len** : int
+                         number of samples per window. *default* is 60 s
+
+        **t_start** : float
+                      time of the first sample. *default* is 0
+
+        **station**, **channel** : strings for the summary table
+
+        **spike_threshold** : float
+                              see count_spikes. *default* is 10
+
+        **clip_level**, **clip_run** : see count_clipped
+
+        **powerline** : float
+                        powerline frequency in Hz. *default* is 60
+
+        **n_harmonics** : int
+                          number of powerline harmonics. *default* is 3
+
+        **dropout_len** : int
+                          minimum number of constant samples of a dropout.
+                          *default* is 1 s, but at least 10 samples
+
+    ..Example: ::
+
+        >>> import mtpy.processing.quality as MTq
+        >>> qm = MTq.QualityMonitor(256., station='MT01', channel='ex')
+        >>> for chunk in chunks:
+        >>> ...    table = qm.process(chunk)
+        >>> table = qm.flush()
+
+    """
+
+    def __init__(self, df, window_len=None, t_start=0., station='', 
+                 channel='', spike_threshold=10., clip_level=None, 
+                 clip_run=3, powerline=60., n_harmonics=3, dropout_len=None):
+
+        self.df = float(df)
+        if window_len is None:
+            window_len = int(round(60 * self.df))
+        if dropout_len is None:
+            #at low sampling rates a few equal samples are no dropout
+            dropout_len = max(10, int(round(self.df)))
+        self.window_len = int(window_len)
+        self.station = station
+        self.channel = channel
+        self.spike_threshold = spike_threshold
+        self.clip_level = clip_level
+        self.clip_run = clip_run
+        self.powerline = powerline
+        self.n_harmonics = n_harmonics
+        self.dropout_len = int(dropout_len)
+
+        self.reset(t_start)
+
+    def reset(self, t_start):
+        """
+        evaluate the samples left and restart at time t_start (e.g. after a
+        gap in the data).
+
+        Returns:
+        --------
+            **table** : summary table of the last (incomplete) window
+        """
+
+        table = np.zeros(0, dtype=quality_dtype)
+        if hasattr(self, '_buffer'):
+            table = self.flush()
+
+        self.t_start = float(t_start)
+        self.n_processed = 0
+        self._buffer = np.zeros(0)
+        self._n_windows = 0
+
+        return table
+
+    @property
+    def t_next(self):
+        """time of the next sample expected"""
+        return self.t_start + self.n_processed / self.df
+
+    def _evaluate(self, windows):
+        """
+        summary table of the windows (rows of a 2D array).
+        """
+
+        table = np.zeros(len(windows), dtype=quality_dtype)
+        table['station'] = self.station
+        table['channel'] = self.channel
+        table['t_start'] = self.t_start + (self._n_windows + 
+                           np.arange(len(windows))) * self.window_len/self.df
+        table['n_samples'] = windows.shape[1]
+
+        finite = np.all(np.isfinite(windows), axis=1)
+        windows = np.where(finite[:, np.newaxis], windows, 0.)
+        table['rms'] = window_rms(windows)
+        table['n_spikes'] = count_spikes(windows, self.spike_threshold)
+        table['n_clipped'] = count_clipped(windows, self.clip_level, 
+                                           self.clip_run)
+        table['powerline_ratio'] = powerline_ratio(windows, self.df, 
+                                                   self.powerline, 
+                                                   self.n_harmonics)
+        table['dropout'] = (~finite) | (longest_constant_run(windows) >= 
+                            min(self.dropout_len, windows.shape[1]))
+
+        self._n_windows += len(windows)
+
+        return table
+
+    def process(self, chunk):
+        """
+        add the next chunk of the time series.
+
+        Returns:
+        --------
+            **table** : summary table of the windows completed with this 
+                        chunk (array of type quality_dtype)
+        """
+
+        data = np.concatenate((self._buffer, np.asarray(chunk, 
+                                                dtype=np.float).ravel()))
+        self.n_processed += data.size - self._buffer.size
+
+        n_windows = len(data) // self.window_len
+        self._buffer = data[n_windows * self.window_len:].copy()
+        if n_windows == 0:
+            return np.zeros(0, dtype=quality_dtype)
+
+        windows = data[:n_windows * self.window_len].reshape(n_windows, 
+                                                             self.window_len)
+
+        return self._evaluate(windows)
+
+    def flush(self):
+        """
+        evaluate the remaining samples as a last, shorter window.
+
+        Returns:
+        --------
+            **table** : summary table of the last window (may be empty)
+        """
+
+        if len(self._buffer) < 2:
+            self._buffer = np.zeros(0)
+            return np.zeros(0, dtype=quality_dtype)
+
+        table = self._evaluate(self._buffer.reshape(1, -1))
+        self._buffer = np.zeros(0)
+
+        return table
+
+
+def quality_file(filename, df=None, chunksize=2**20, **kwargs):
+    """
+    Summary table of the data quality of one file, computed chunk by chunk
+    with QualityMonitor.
+
+    Supported are MTpy TS files (ASCII or binary), raw ASCII files (e.g. 
+    EDL, 1 column or 2 columns time/data - sampling rate 'df' must be 
+    given, station and channel are taken from the file name) and Zen 
+    .Z3D files (in counts, GPS validated blocks, a gap between blocks ends
+    the current window).
+
+    input:
+    - file name
+    - sampling rate (only needed for raw ASCII files)
+    - number of samples read at a time
+    - keyword arguments of QualityMonitor
+
+    output:
+    - summary table (array of type quality_dtype)
+
+    """
+
+    if not op.isfile(filename):
+        raise MTex.MTpyError_inputarguments('data file not existing: '
+                                            '{0}'.format(filename))
+
+    lo_tables = []
+    if filename.lower().endswith('.z3d'):
+        #zen needs win32api, so it is only imported for Z3D files
+        import mtpy.usgs.zen as MTzen
+
+        z3d = MTzen.Zen3D(filename)
+        z3d.read_header()
+        block_seconds = max(1, chunksize // int(z3d.header.ad_rate))
+        monitor = None
+        for t_block, ts in z3d.iter_blocks(block_seconds=block_seconds):
+            if monitor is None:
+                monitor = QualityMonitor(z3d.header.ad_rate, t_start=t_block,
+                        station=z3d.metadata.rx_xyz0.split(':')[0],
+                        channel=z3d.metadata.ch_cmp.lower(), **kwargs)
+            elif abs(t_block - monitor.t_next) > 0.5 / monitor.df:
+                lo_tables.append(monitor.reset(t_block))
+            lo_tables.append(monitor.process(ts))
+        if monitor is None:
+            raise MTex.MTpyError_ts_data('no valid data in file '
+                                         '{0}'.format(filename))
+    else:
+        try:
+            header = MTfh.read_ts_header(filename)
+        except MTex.MTpyError_ts_data:
+            header = {}
+        if 'samplingrate' in header:
+            df = float(header['samplingrate'])
+        if df is None:
+            raise MTex.MTpyError_inputarguments('sampling rate of file {0} '
+                                                'unknown'.format(filename))
+        basename = op.basename(filename)
+        monitor = QualityMonitor(df, t_start=float(header.get('t_min', 0.)),
+                    station=header.get('station', 
+                                       basename.split('_')[0].split('.')[0]),
+                    channel=header.get('channel', basename[-2:].lower()),
+                    **kwargs)
+        for chunk in MTfh.iter_ts_data_chunks(filename, chunksize):
+            #at least 2 columns - assume, first is time, second data
+            lo_tables.append(monitor.process(chunk[:, min(1, 
+                                                     chunk.shape[1] - 1)]))
+
+    lo_tables.append(monitor.flush())
+
+    return np.concatenate(lo_tables)
+
+
+def _quality_file_task(task):
+    """
+    Evaluate one file for quality_files with quality_file.  Return 
+    (filename, quality table - empty if the file could not be read, time
+    taken in s).
+
+    """
+
+    filename, kwargs = task
+
+    t0 = time.time()
+    try:
+        table = quality_file(filename, **kwargs)
+    except (MTex.MTpyError_inputarguments, MTex.MTpyError_ts_data, 
+            IOError, ValueError) as e:
+        print 'could not evaluate file {0}: {1}'.format(filename, e)
+        table = np.zeros(0, dtype=quality_dtype)
+
+    return filename, table, time.time() - t0
+
+
+def quality_files(lo_filenames, outfile=None, n_processes=1, **kwargs):
+    """
+    Data quality summary of several files (channels), evaluated in 
+    parallel by 'n_processes' worker processes, see quality_file.
+
+    input:
+    - list of data files
+    - name of the summary table file (optional, see write_quality_table)
+    - number of worker processes
+    - keyword arguments of quality_file
+
+    output:
+    - summary table of all files, sorted by station, channel and time
+
+    """
+
+    lo_tasks = [(filename, kwargs) for filename in lo_filenames]
+
+    t0 = time.time()
+    if n_processes > 1:
+        pool = multiprocessing.Pool(n_processes)
+        try:
+            lo_results = pool.map(_quality_file_task, lo_tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        lo_results = [_quality_file_task(task) for task in lo_tasks]
+
+    for filename, table, seconds in lo_results:
+        print 'evaluated file {0} ({1} windows, {2:.2f} s)'.format(filename,
+                                                        len(table), seconds)
+    print '{0} files evaluated in {1:.2f} s'.format(len(lo_tasks), 
+                                                   time.time() - t0)
+
+    table = np.concatenate([np.zeros(0, dtype=quality_dtype)] + 
+                           [result[1] for result in lo_results])
+    table = table[np.argsort(table, order=['station', 'channel', 
+                                           't_start'])]
+
+    if outfile is not None:
+        write_quality_table(outfile, table)
+
+    return table
+
+
+def write_quality_table(fn, table):
+    """
+    Store a summary table as NumPy .npy file (compact and fast to read, 
+    see read_quality_table).
+
+    """
+
+    with open(fn, 'wb') as F:
+        np.save(F, np.asarray(table, dtype=quality_dtype))
+
+    return fn
+
+
+def read_quality_table(fn, mmap=False):
+    """
+    Read a summary table written by write_quality_table, optionally 
+    memory mapped.
+
+    """
+
+    if mmap is True:
+        return np.load(fn, mmap_mode='r')
+
+    return np.load(fn)
@@ -0,0 +1,193 @@
+'''Growable sample storage with shared views and copy-on-write.
+
+A :py:class:`SampleBuffer` holds the samples of a trace in a preallocated
+array with spare room, so that samples can be appended (and prepended by
+:py:meth:`SampleBuffer.extend`) without reallocating the array each time.
+Windows of a buffer (e.g. for chopping) and copies share the underlying
+array. As long as an array is shared, the data views handed out are
+read-only and any modification first copies the buffer's own samples
+(copy-on-write).
+
+The number of sample arrays allocated is counted in
+:py:attr:`SampleBuffer.nallocations`.
+'''
+
+import weakref
+import numpy as num
+
+
+class _Storage(object):
+    '''Sample array together with the buffers using it.'''
+
+    __slots__ = ('array', 'users', '__weakref__')
+
+    def __init__(self, array):
+        self.array = array
+        self.users = weakref.WeakSet()
+
+
+class SampleBuffer(object):
+
+    '''Growable 1D sample storage.
+
+    :param data: initial samples (1D array) or ``None``
+    :param dtype: storage data type, defaults to the type of *data*, or
+        ``float64`` if no data is given
+    :param copy: if ``False`` (the default), a contiguous *data* array of
+        type *dtype* is used as storage without copying it
+
+    The samples are exposed through :py:attr:`data` as a view into the
+    storage array. The view is read-only while the storage is shared with
+    other buffers.
+    '''
+
+    # total number of sample arrays allocated by all buffers
+    nallocations = 0
+
+    def __init__(self, data=None, dtype=None, copy=False):
+        if data is None:
+            if dtype is None:
+                dtype = num.float64
+            data = num.zeros(0, dtype=dtype)
+        else:
+            data = num.asarray(data)
+            if dtype is None:
+                dtype = data.dtype
+
+        dtype = num.dtype(dtype)
+        if (copy or data.dtype != dtype or data.ndim != 1 or
+                not data.flags.c_contiguous or not data.flags.writeable):
+            array = self._allocate(data.size, dtype)
+            array[:] = data.ravel()
+        else:
+            array = data
+
+        self._attach(_Storage(array), 0, array.size)
+
+    @classmethod
+    def _allocate(cls, n, dtype):
+        if n > 0:
+            SampleBuffer.nallocations += 1
+        return num.empty(n, dtype=dtype)
+
+    def _attach(self, storage, ibeg, iend):
+        self._storage = storage
+        self._storage.users.add(self)
+        self._ibeg = ibeg
+        self._iend = iend
+        self._view = None
+
+    def _reallocate(self, capacity, nfront=0):
+        '''Copy own samples into a new array of given capacity, starting at
+        index *nfront*.'''
+
+        n = len(self)
+        array = self._allocate(capacity, self.dtype)
+        array[nfront:nfront+n] = self._storage.array[self._ibeg:self._iend]
+        self._storage.users.discard(self)
+        self._attach(_Storage(array), nfront, nfront+n)
+
+    @property
+    def dtype(self):
+        return self._storage.array.dtype
+
+    @property
+    def capacity(self):
+        return self._storage.array.size
+
+    def __len__(self):
+        return self._iend - self._ibeg
+
+    def is_shared(self):
+        '''Check if the storage array is used by other buffers.'''
+        return len(self._storage.users) > 1
+
+    @property
+    def data(self):
+        '''View of the samples (read-only while the storage is shared).'''
+
+        if self._view is None or (not self._view.flags.writeable and
+                                  not self.is_shared()):
+            self._view = self._storage.array[self._ibeg:self._iend]
+            self._view.flags.writeable = not self.is_shared()
+
+        return self._view
+
+    def is_data(self, array):
+        '''Check if *array* is a view of exactly the buffer's samples.'''
+
+        if array is self._view:
+            return True
+
+        view = self._storage.array[self._ibeg:self._iend]
+        return (isinstance(array, num.ndarray) and
+                array.dtype == view.dtype and
+                array.shape == view.shape and
+                array.strides == view.strides and
+                array.__array_interface__['data'][0] ==
+                view.__array_interface__['data'][0])
+
+    def make_writable(self):
+        '''Get a writable view of the samples, copying them if the storage is
+        shared.'''
+
+        if self.is_shared():
+            self._reallocate(len(self))
+
+        self._view = None
+        return self.data
+
+    def append(self, data):
+        '''Append samples, growing the storage by doubling if necessary.'''
+
+        data = num.asarray(data)
+        n = len(self)
+        newlen = n + data.size
+        if self.is_shared() or self._ibeg + newlen > self.capacity:
+            self._reallocate(max(2*newlen, 16))
+
+        self._storage.array[self._ibeg+n:self._ibeg+newlen] = data
+        self._iend = self._ibeg + newlen
+        self._view = None
+
+    def extend(self, nl, nh):
+        '''Add *nl* samples at the beginning and *nh* samples at the end.
+
+        The new samples are not initialized. Room at the beginning is
+        reserved whenever the storage has to be reallocated, so that
+        repeated extension is cheap in both directions.
+        '''
+
+        n = len(self)
+        newlen = n + nl + nh
+        if self.is_shared() or self._ibeg < nl or \
+                self._iend + nh > self.capacity:
+            nfront = nl + newlen // 2
+            self._reallocate(nfront + n + nh + newlen // 2, nfront)
+
+        self._ibeg -= nl
+        self._iend += nh
+        self._view = None
+
+    def narrow(self, ibeg, iend):
+        '''Restrict the buffer to the samples [ibeg:iend] (no copy).'''
+
+        ibeg, iend, step = slice(ibeg, iend).indices(len(self))
+        self._iend = self._ibeg + max(iend, ibeg)
+        self._ibeg += ibeg
+        self._view = None
+
+    def window(self, ibeg, iend):
+        '''Get a new buffer of the samples [ibeg:iend], sharing the storage.'''
+
+        other = SampleBuffer.__new__(SampleBuffer)
+        other._attach(self._storage, self._ibeg, self._iend)
+        other.narrow(ibeg, iend)
+        self._view = None
+
+        return other
+
+    def copy(self):
+        '''Get a copy of the buffer, sharing the storage until written to.'''
+
+        return self.window(0, len(self))
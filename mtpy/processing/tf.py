@@ -12,8 +12,13 @@ JP, 2013
 
 #=================================================================
 
+import time
+import multiprocessing
+
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import scipy.signal as sps
+from multiprocessing.pool import ThreadPool
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MultipleLocator
 
@@ -21,6 +26,12 @@ import  mtpy.utils.exceptions as MTexceptions
 
 #=================================================================
 
+#upper limit for the memory of the arrays computed at once by the windowed
+#transforms, if no chunk size is given (in bytes)
+max_chunk_bytes = 2**26
+
+#=================================================================
+
 
 def padzeros(f, npad=None, pad_pattern=None):
     """
@@ -300,7 +311,99 @@ def wvd_analytic_signal(fx):
     
     return fxa
 
-def stft(fx, nh=2**8, tstep=2**7, ng=1, df=1.0, nfbins=2**10):
+def get_frames(fx, nh, tstep, nframes=None):
+    """
+    Returns all windows of length nh of fx with a spacing of tstep samples
+    as rows of a 2D array, without copying the data.  The array is a 
+    read-only strided view of fx, i.e. row kk is fx[kk*tstep:kk*tstep+nh].
+    
+    Arguments:
+    ----------
+        **fx** : np.ndarray
+                 time series 
+                 
+        **nh** : int
+                 window length
+                 
+        **tstep** : int
+                    number of samples between windows
+                    
+        **nframes** : int
+                      number of windows, if None all complete windows of fx
+                      
+    Returns:
+    --------
+        **frames** : np.ndarray(nframes, nh)
+                     windows of fx
+    """
+    
+    fx = np.ascontiguousarray(fx)
+    if nframes is None:
+        nframes = max([(len(fx)-nh)/tstep+1, 0])
+    if nframes > 0 and (nframes-1)*tstep+nh > len(fx):
+        raise MTexceptions.MTpyError_inputarguments('time series too short '
+                                        'for {0} windows'.format(nframes))
+    
+    stride = fx.strides[0]
+    frames = as_strided(fx, shape=(nframes, nh), 
+                        strides=(tstep*stride, stride))
+    frames.flags.writeable = False
+    
+    return frames
+    
+def _get_chunk_size(bytes_per_frame, chunk_size=None):
+    """
+    Returns the number of windows to process at once, so that the arrays of
+    one chunk stay below max_chunk_bytes, unless chunk_size is given.
+    """
+    
+    if chunk_size is not None:
+        return max([int(chunk_size), 1])
+    
+    return max([int(max_chunk_bytes/bytes_per_frame), 1])
+    
+def _chunks(nframes, chunk_size):
+    """
+    Yields slices of consecutive windows of length chunk_size.
+    """
+    
+    for ii in range(0, nframes, chunk_size):
+        yield slice(ii, min([ii+chunk_size, nframes]))
+    
+def _block_evaluate(block_function, ntimes, chunk_size, n_threads=1):
+    """
+    Calls block_function(tslice) for consecutive chunks of chunk_size time 
+    instances, block_function stores the results for these time instances.
+    If n_threads > 1 the chunks are evaluated by a pool of threads, so 
+    block_function must only write to the columns of its own chunk.
+    """
+    
+    lo_slices = list(_chunks(ntimes, chunk_size))
+    
+    if n_threads > 1 and len(lo_slices) > 1:
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(block_function, lo_slices)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for tslice in lo_slices:
+            block_function(tslice)
+    
+def _lag_mask(taulst, tau_start, tau_stop):
+    """
+    Returns the row and column indices of the entries of a (len(tau_start),
+    len(taulst)) array, for which tau_start[ii] <= taulst <= tau_stop[ii].
+    """
+    
+    valid = (taulst >= tau_start[:, np.newaxis])&\
+            (taulst <= tau_stop[:, np.newaxis])
+    
+    return np.nonzero(valid)
+    
+def stft(fx, nh=2**8, tstep=2**7, ng=1, df=1.0, nfbins=2**10,
+         chunk_size=None):
     """
     calculate the spectrogam of the given function by calculating the fft of
     a window of length nh at each time instance with an interval of tstep. 
@@ -330,6 +433,10 @@ def stft(fx, nh=2**8, tstep=2**7, ng=1, df=1.0, nfbins=2**10):
         
         **nfbins** : int (should be power of 2 and equal or larger than nh)
                      number of frequency bins
+                     
+        **chunk_size** : int
+                         number of windows transformed at once, if None it 
+                         is set to keep the memory below max_chunk_bytes
     
     Returns:
     --------
@@ -389,27 +496,44 @@ def stft(fx, nh=2**8, tstep=2**7, ng=1, df=1.0, nfbins=2**10):
     #positive ones
     fa = sps.hilbert(dctrend(fx))
     
-    #compute the fft at each window instance
-    for place, ii in enumerate(tlst):
-        fxwin = fa[ii:ii+nh]*h
-        
+    #compute the fft of all windows, chunk by chunk
+    frames = get_frames(fa, nh, tstep, nframes=len(tlst))
+    chunk_size = _get_chunk_size(3*16*nfbins, chunk_size)
+    for tslice in _chunks(len(tlst), chunk_size):
         #get only positive frequencies
-        FXwin = np.fft.fft(padzeros(fxwin, npad=nfbins))[:nfbins/2]
+        FXwin = np.fft.fft(frames[tslice]*h, n=nfbins, axis=1)[:, :nfbins/2]
 
         #smooth in frequency plane
         if ng != 1:
-            FXwin = np.convolve(padzeros(FXwin, npad=len(FXwin)+ng-1), g, 
-                                'valid')
+            FXwin = _convolve_frequency(FXwin, g)
         else:
             pass
         
         #pull out only positive quadrant, flip array for plotting
-        tfarray[:, place] = FXwin[::-1]
+        tfarray[:, tslice] = FXwin[:, ::-1].T
         
     return tfarray, tlst, flst
     
+def _convolve_frequency(FX, g):
+    """
+    Convolves every row of FX with the window g, padding zeros at the end 
+    of the rows (same as np.convolve(padzeros(row, len(row)+ng-1), g, 
+    'valid') for each row).
+    """
+    
+    nf = FX.shape[1]
+    ng = len(g)
+    FXpad = np.zeros((FX.shape[0], nf+ng-1), dtype=FX.dtype)
+    FXpad[:, :nf] = FX
+    
+    FXconv = np.zeros_like(FX)
+    for jj in range(ng):
+        FXconv += g[ng-1-jj]*FXpad[:, jj:jj+nf]
+    
+    return FXconv
+    
 def reassigned_stft(fx, nh=2**6-1, tstep=2**5, nfbins=2**10, df=1.0, alpha=4,
-                   threshold=None):
+                   threshold=None, chunk_size=None, n_threads=1):
     """ 
     Computes the reassigned spectrogram by estimating the center of gravity of 
     the signal and condensing dispersed energy back to that location.  Works 
@@ -445,7 +569,15 @@ def reassigned_stft(fx, nh=2**6-1, tstep=2**5, nfbins=2**10, df=1.0, alpha=4,
                         threshold value for reassignment
                         If None the threshold is automatically calculated
                         *default* is None
-        
+                     
+        **chunk_size** : int
+                         number of time instances computed at once, if None
+                         it is set to keep the memory below max_chunk_bytes
+                         
+        **n_threads** : int
+                        number of threads evaluating the chunks
+                        *default* is 1
+    
     Returns:
         **rtfarray** : np.ndarray(nfbins/2, len(fx)/tstep)
                        reassigned spectrogram in units of amplitude
@@ -461,7 +593,6 @@ def reassigned_stft(fx, nh=2**6-1, tstep=2**5, nfbins=2**10, df=1.0, alpha=4,
                    standard spectrogram calculated from stft 
                    in units of amplitude
     """
-    
     #make sure fx is type array
     fx = np.array(fx)
     
@@ -471,7 +602,7 @@ def reassigned_stft(fx, nh=2**6-1, tstep=2**5, nfbins=2**10, df=1.0, alpha=4,
     #make sure window length is odd
     if np.remainder(nh, 2) == 0:
         nh = nh+1
-    
+        
     #compute gaussian window
     h = gausswin(nh, alpha=alpha)
     lh = (nh-1)/2
@@ -490,34 +621,40 @@ def reassigned_stft(fx, nh=2**6-1, tstep=2**5, nfbins=2**10, df=1.0, alpha=4,
     flst = np.fft.fftfreq(nfbins, 1./df)[nfbins/2:]
     return_flst = np.fft.fftfreq(nfbins, 1./df)[0:nfbins/2]
     
-    #initialize some time-frequency arrays
-    tfr = np.zeros((nfbins, nt), dtype='complex')
-    tf2 = np.zeros((nfbins, nt), dtype='complex')
-    tf3 = np.zeros((nfbins, nt), dtype='complex')
+    #initialize some time-frequency arrays, only the positive frequencies
+    #are kept
+    spec = np.zeros((nfbins/2, nt), dtype='complex')
+    spect = np.zeros((nfbins/2, nt), dtype='complex')
+    specd = np.zeros((nfbins/2, nt), dtype='complex')
     
-    #compute components for reassignment
-    for ii, tt in enumerate(tlst):
-    	#create a time shift list
-        tau = np.arange(start=-min([np.round(nx/2.), lh, tt-1]),
-                        stop=min([np.round(nx/2.), lh, nx-tt-1])+1)
-    	#compute the frequency spots to be calculated
-        ff = np.remainder(nfbins+tau,nfbins)
-        xlst = tt+tau
-        hlst = lh+tau
-        normh = np.sqrt(np.sum(abs(h[hlst])**2))
-        tfr[ff, ii] = fx[xlst]*h[hlst].conj()/normh
-        tf2[ff, ii] = fx[xlst]*th[hlst].conj()/normh
-        tf3[ff, ii] = fx[xlst]*dh[hlst].conj()/normh
-    
-    #compute Fourier Transform
-    spec = np.fft.fft(tfr, axis=0)
-    spect = np.fft.fft(tf2, axis=0)
-    specd = np.fft.fft(tf3, axis=0)
+    #all time shifts of the full window
+    tau_all = np.arange(start=-lh, stop=lh+1, step=1)
     
-    #get only positive frequencies
-    spec = spec[nfbins/2:, :]
-    spect = spect[nfbins/2:, :]
-    specd = specd[nfbins/2:, :]
+    #compute components for reassignment for a block of time instances
+    def _reassigned_stft_block(tslice):
+        tt = tlst[tslice]
+        #create a time shift list
+        rows, lags = _lag_mask(tau_all, 
+                               -np.minimum(min(np.round(nx/2.), lh), tt-1),
+                               np.minimum(min(np.round(nx/2.), lh), nx-tt-1))
+        tau = tau_all[lags]
+        #compute the frequency spots to be calculated
+        ff = np.remainder(nfbins+tau, nfbins)
+        xlst = tt[rows]+tau
+        hlst = lh+tau
+        hsquare = np.zeros((len(tt), nh))
+        hsquare[rows, lags] = abs(h[hlst])**2
+        normh = np.sqrt(hsquare.sum(axis=1))[rows]
+        
+        for window, tfspec in [(h, spec), (th, spect), (dh, specd)]:
+            tfr = np.zeros((len(tt), nfbins), dtype='complex')
+            tfr[rows, ff] = fx[xlst]*window[hlst].conj()/normh
+            #compute Fourier Transform, get only positive frequencies
+            tfspec[:, tslice] = np.fft.fft(tfr, axis=1)[:, nfbins/2:].T
+            
+    chunk_size = _get_chunk_size(3*16*nfbins, chunk_size)
+    _block_evaluate(_reassigned_stft_block, nt, chunk_size, 
+                    n_threads=n_threads)
     
     #check to make sure no spurious zeros floating around
     spec[np.where(abs(spec)<1.E-6)] = 0.0
@@ -533,28 +670,30 @@ def reassigned_stft(fx, nh=2**6-1, tstep=2**5, nfbins=2**10, df=1.0, alpha=4,
     
     if threshold == None:
         threshold = 1.E-4*np.mean(fx[tlst])
-
-    for nn in range(nt):
-        for kk in range(nfbins/2):
-            if abs(spec[kk, nn]) > threshold:
-                #get center of gravity index in time direction
-                nhat = int(nn+twspec[kk, nn])
-                nhat = int(min([max([nhat, 1]),nt-1]))
-                #get center of gravity index in frequency direction
-                khat = int(kk-dwspec[kk, nn])
-                khat = int(np.remainder(np.remainder(khat-1, nfbins/2)+nfbins/2,
-                                        nfbins/2))
-                #reassign energy
-                rtfarray[khat, nhat] = rtfarray[khat, nhat]+spec[kk, nn]
-                spect[kk, nn] = khat+1j*nhat
-            else:
-                spect[kk,nn] = np.inf*(1+1j)
-                rtfarray[kk, nn] = rtfarray[kk, nn]+spec[kk, nn]
+        
+    #reassign energy block by block, in the order time, frequency
+    for tslice in _chunks(nt, chunk_size):
+        kk, nn = np.meshgrid(np.arange(nfbins/2), np.arange(nt)[tslice])
+        kk = kk.ravel()
+        nn = nn.ravel()
+        specpoint = spec[kk, nn]
+        reassign = abs(specpoint) > threshold
+        
+        #get center of gravity index in time direction
+        nhat = (nn+twspec[kk, nn]).astype('int')
+        nhat = np.minimum(np.maximum(nhat, 1), nt-1)
+        #get center of gravity index in frequency direction
+        khat = (kk-dwspec[kk, nn]).astype('int')
+        khat = np.remainder(np.remainder(khat-1, nfbins/2)+nfbins/2, 
+                            nfbins/2)
+        
+        np.add.at(rtfarray, (np.where(reassign, khat, kk), 
+                             np.where(reassign, nhat, nn)), specpoint)
         
     return rtfarray, tlst, return_flst, spec
     
-    
-def wvd(fx, nh=2**8-1, tstep=2**5, nfbins=2**10, df=1.0):
+def wvd(fx, nh=2**8-1, tstep=2**5, nfbins=2**10, df=1.0, chunk_size=None,
+        n_threads=1):
     """
     calculates the Wigner-Ville distribution of f. 
     
@@ -579,6 +718,14 @@ def wvd(fx, nh=2**8-1, tstep=2**5, nfbins=2**10, df=1.0):
         
         **nfbins** : int (should be power of 2 and equal or larger than nh)
                      number of frequency bins
+                     
+        **chunk_size** : int
+                         number of time instances computed at once, if None
+                         it is set to keep the memory below max_chunk_bytes
+                         
+        **n_threads** : int
+                        number of threads evaluating the chunks
+                        *default* is 1
     
     Returns:
     --------
@@ -603,19 +750,18 @@ def wvd(fx, nh=2**8-1, tstep=2**5, nfbins=2**10, df=1.0):
     except ValueError:
         fn = len(fx)
         fm = 1
-    
     if fm > 1:
-        fn = fn[0]
         print 'computing cross spectra'
         #compute the analytic signal of function f and dctrend
         fa = wvd_analytic_signal(fx[0])
         fb = wvd_analytic_signal(fx[1])
+        
     else:
         #compute the analytic signal of function f and dctrend
         fa = wvd_analytic_signal(fx)        
         fa = sps.hilbert(dctrend(fx))
         fb = fa.copy()
-    
+        
     fn = len(fa)
     #sampling period
     df = float(df)
@@ -625,35 +771,40 @@ def wvd(fx, nh=2**8-1, tstep=2**5, nfbins=2**10, df=1.0):
     
     #create a time array such that the first point is centered on time window
     tlst = np.arange(start=0, stop=fn-1, step=tstep, dtype='int')
-      
+    
     #create an empty array to put the tf in 
     tfarray = np.zeros((nfbins, len(tlst)), dtype='complex')
     
     #create a frequency array with just positive frequencies
     flst = np.fft.fftfreq(nfbins, dt)[0:nfbins/2]
     
-    #calculate pseudo WV
-    for point, nn in enumerate(tlst):
+    #all time shifts of the full window
+    tau_all = np.arange(start=-tau, stop=tau+1, step=1, dtype='int')
+    
+    #calculate pseudo WV for a block of time instances
+    def _wvd_block(tslice):
+        nn = tlst[tslice]
         #calculate the smallest timeshift possible
-        tau_min = min(nn, tau, fn-nn-1)
-        #make a timeshift array
-        tau_lst = np.arange(start=-tau_min, stop=tau_min+1, step=1, 
-                            dtype='int')
-        #calculate rectangular windowed correlation function of analytic signal
-        Rnn = 4*np.conjugate(fa[nn-tau_lst])*fb[nn+tau_lst]  
-        #calculate fft of windowed correlation function
-        #put into tfarray
-        tfarray[:, point] = padzeros(Rnn, npad=nfbins)[::-1]
+        tau_min = np.minimum(np.minimum(nn, tau), fn-nn-1)
+        rows, lags = _lag_mask(tau_all, -tau_min, tau_min)
+        tau_lst = tau_all[lags]
         
-    #compute Fourier Transform of array along the time axis
-    tfarray = np.fft.fft(tfarray,axis=0)
-    #normalize
-    tfarray=tfarray/nh
+        #calculate rectangular windowed correlation function of analytic 
+        #signal, zero padded to nfbins and flipped like for a single window
+        Rnn = np.zeros((len(nn), nfbins), dtype='complex')
+        Rnn[rows, nfbins-1-tau_min[rows]-tau_lst] = \
+                4*np.conjugate(fa[nn[rows]-tau_lst])*fb[nn[rows]+tau_lst]
+                
+        #compute Fourier Transform along the time shifts and normalize
+        tfarray[:, tslice] = np.fft.fft(Rnn, axis=1).T/nh
+        
+    chunk_size = _get_chunk_size(4*16*(nfbins+nh), chunk_size)
+    _block_evaluate(_wvd_block, len(tlst), chunk_size, n_threads=n_threads)
     
     return tfarray, tlst, flst
-
+    
 def spwvd(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=None, ng=None, sigmat=None,
-          sigmaf=None):
+          sigmaf=None, chunk_size=None, n_threads=1):
     """
     Calculates the smoothed pseudo Wigner-Ville distribution for an array
     fx. Smoothed with Gaussians windows to get best localization.
@@ -690,6 +841,14 @@ def spwvd(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=None, ng=None, sigmat=None,
         **sigmaf** : float
                      std of window g, ie full width half max of gaussian
                      *default* is None and sigmaf is calculate automatically
+                     
+        **chunk_size** : int
+                         number of time instances computed at once, if None
+                         it is set to keep the memory below max_chunk_bytes
+                         
+        **n_threads** : int
+                        number of threads evaluating the chunks
+                        *default* is 1
     
     Returns:
     --------
@@ -706,7 +865,6 @@ def spwvd(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=None, ng=None, sigmat=None,
     #check to see if calculating the auto or cross spectra
     if type(fx) is list:
         fx = np.array(fx)
-    
     try:
         fn, fm = fx.shape
         if fm > fn:
@@ -719,14 +877,14 @@ def spwvd(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=None, ng=None, sigmat=None,
         #compute the analytic signal of function f and dctrend
         fa = wvd_analytic_signal(fx[0])
         fb = wvd_analytic_signal(fx[1])
-
+        
     else:
         #compute the analytic signal of function f and dctrend
         fa = wvd_analytic_signal(fx)        
         fa = sps.hilbert(dctrend(fx))
         fb = fa.copy()
         print 'Computed Analytic signal'
-    
+
     #sampling period
     df = float(df)
     dt = 1/df
@@ -748,7 +906,6 @@ def spwvd(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=None, ng=None, sigmat=None,
         sigmah = nh/(6*np.sqrt(2*np.log(2)))
     else:
         sigmah = sigmat
-    
     if sigmaf == None:
         sigmag = ng/(6*np.sqrt(2*np.log(2)))
     else:
@@ -759,7 +916,6 @@ def spwvd(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=None, ng=None, sigmat=None,
     #calculate windows and normalize
     h = sps.gaussian(nh,sigmah)
     h /= sum(h)
-    
     g=sps.gaussian(ng,sigmag)
     g /= sum(g)
     
@@ -776,51 +932,84 @@ def spwvd(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=None, ng=None, sigmat=None,
     #create a frequency array with just positive frequencies
     flst = np.fft.fftfreq(nfbins, dt)[0:nfbins/2]
     
-    #calculate pseudo WV
-    for point, t in enumerate(tlst):
+    #calculate pseudo WV for a block of time instances
+    def _spwvd_block(tslice):
+        t = tlst[tslice]
+        tfblock = np.zeros((nfbins, len(t)), dtype='complex')
+        
         #find the smallest possible time shift
-        tau_max = min(t+Lg-1, fn-t+Lg, round(nfbins/2), Lh)
-        #create time lag list
-        taulst=np.arange(start=-min(Lg,fn-t), stop=min(Lg,t-1)+1, step=1,
-                         dtype='int')
+        tau_max = np.minimum(np.minimum(t+Lg-1, fn-t+Lg), min(nfbins/2, Lh))
+        
         #calculate windowed correlation function of analytic function for
         #zero frequency 
-        tfarray[0, point] = sum(2*(g[Lg+taulst]/sum(g[Lg+taulst]))*
-                                   fa[t-taulst-1]*np.conjugate(fb[t-taulst-1]))
+        tfblock[0] = _spwvd_lag_sum(fa, fb, g, t-1, t-1, 
+                                    -np.minimum(Lg, fn-t), 
+                                    np.minimum(Lg, t-1), 2.)
+                                    
         #calculate tfd by calculating convolution of window and correlation 
-        #function as sum of correlation function over the lag period times the
-        #window at that point. Calculate symmetrical segments for FFT later
-        for mm in range(tau_max):
-            taulst = np.arange(start=-min(Lg,fn-t-mm-1), stop=min(Lg,t-mm-1)+1,
-                             step=1,dtype='int')
+        #function as sum of correlation function over the lag period times 
+        #the window at that point. Calculate symmetrical segments for FFT 
+        #later
+        for mm in range(max(tau_max.max(), 0)):
+            active = np.nonzero(mm < tau_max)[0]
+            ta = t[active]
+            tau_start = -np.minimum(Lg, fn-ta-mm-1)
+            tau_stop = np.minimum(Lg, ta-mm-1)
             #compute positive half
-            gm = 2*(g[Lg+taulst]/sum(g[Lg+taulst]))
-            Rmm = sum(gm*fa[t+mm-taulst-1]*np.conjugate(fb[t-mm-taulst]))
-            tfarray[mm,point] = h[Lh+mm-1]*Rmm
+            Rmm = _spwvd_lag_sum(fa, fb, g, ta+mm-1, ta-mm, tau_start, 
+                                 tau_stop, 2.)
+            tfblock[mm, active] = h[Lh+mm-1]*Rmm
             #compute negative half 
-            Rmm = sum(gm*fa[t-mm-taulst]*np.conjugate(fb[t+mm-taulst-1]))
-            tfarray[nfbins-mm-1,point] = h[Lh-mm]*Rmm
-        mm = round(nfbins/2)
-        
-        if t <= fn-mm and t >= mm and mm <= Lh:
-            print 'doing weird thing'
-            taulst = np.arange(start=-min(Lg,fn-t-mm), stop=min(Lg,fn-t,mm)+1,
-                               step=1, dtype='int')
-            gm = g[Lg+taulst]/sum(g[Lg+taulst])
-            tfarray[mm-1, point] = .5*\
-                                  (sum(h[Lh+mm]*(gm*fa[t+mm-taulst-1]*
-                                    np.conjugate(fb[t-mm-taulst])))+\
-                                   sum(h[Lh-mm]*(gm*fa[t-mm-taulst]*
-                                    np.conjugate(fb[t+mm-taulst-1]))))
-    
-    tfarray = np.fft.fft(tfarray, axis=0)
-    #rotate for plotting purposes so that (t=0,f=0) is at the lower left
-    tfarray = np.rot90(tfarray.T, 1)
+            Rmm = _spwvd_lag_sum(fa, fb, g, ta-mm, ta+mm-1, tau_start, 
+                                 tau_stop, 2.)
+            tfblock[nfbins-mm-1, active] = h[Lh-mm]*Rmm
+            
+        mm = nfbins/2
+        if mm <= Lh:
+            active = np.nonzero((t <= fn-mm) & (t >= mm))[0]
+            ta = t[active]
+            tau_start = -np.minimum(Lg, fn-ta-mm)
+            tau_stop = np.minimum(np.minimum(Lg, fn-ta), mm)
+            tfblock[mm-1, active] = .5*\
+                (h[Lh+mm]*_spwvd_lag_sum(fa, fb, g, ta+mm-1, ta-mm, 
+                                         tau_start, tau_stop, 1.)+\
+                 h[Lh-mm]*_spwvd_lag_sum(fa, fb, g, ta-mm, ta+mm-1, 
+                                         tau_start, tau_stop, 1.))
+        
+        #rotate for plotting purposes so that (t=0,f=0) is at the lower left
+        tfarray[:, tslice] = np.fft.fft(tfblock, axis=0)[::-1]
+        
+    chunk_size = _get_chunk_size(6*16*(nfbins+ng), chunk_size)
+    _block_evaluate(_spwvd_block, len(tlst), chunk_size, n_threads=n_threads)
     
     return tfarray, tlst, flst
     
+def _spwvd_lag_sum(fa, fb, g, ia, ib, tau_start, tau_stop, factor):
+    """
+    Returns for each time instance ii the sum over the time lags 
+    tau_start[ii] <= tau <= tau_stop[ii] of
+    factor*g[Lg+tau]/sum(g[Lg+tau])*fa[ia[ii]-tau]*conj(fb[ib[ii]-tau]),
+    which is the time smoothed correlation function of spwvd.
+    """
+    
+    Lg = (len(g)-1)/2
+    taulst = np.arange(start=-Lg, stop=Lg+1, step=1, dtype='int')
+    rows, lags = _lag_mask(taulst, tau_start, tau_stop)
+    tau = taulst[lags]
+    
+    gm = np.zeros((len(ia), len(g)))
+    gm[rows, lags] = g[Lg+tau]
+    gsum = gm.sum(axis=1)
+    gsum[np.where(gsum == 0)] = 1.
+    gm = factor*(gm/gsum[:, np.newaxis])
+    
+    Rmm = np.zeros((len(ia), len(g)), dtype='complex')
+    Rmm[rows, lags] = fa[ia[rows]-tau]*np.conjugate(fb[ib[rows]-tau])
+    
+    return np.sum(gm*Rmm, axis=1)
+    
 def robust_wvd(fx, nh=2**7-1, ng=2**4-1, tstep=2**4, nfbins=2**8, df=1.0,
-              sigmat=None, sigmaf=None):
+              sigmat=None, sigmaf=None, chunk_size=None, n_threads=1):
     """
     Calculate the robust Wigner-Ville distribution for an array 
     fx. Smoothed with Gaussians windows to get best localization. 
@@ -856,6 +1045,14 @@ def robust_wvd(fx, nh=2**7-1, ng=2**4-1, tstep=2**4, nfbins=2**8, df=1.0,
         **sigmaf** : float
                      std of window g, ie full width half max of gaussian
                      *default* is None and sigmaf is calculate automatically
+                     
+        **chunk_size** : int
+                         number of time instances computed at once, if None
+                         it is set to keep the memory below max_chunk_bytes
+                         
+        **n_threads** : int
+                        number of threads evaluating the chunks
+                        *default* is 1
     
     Returns:
     --------
@@ -872,7 +1069,6 @@ def robust_wvd(fx, nh=2**7-1, ng=2**4-1, tstep=2**4, nfbins=2**8, df=1.0,
     #check to see if computing the auto or cross spectra
     if type(fx) is list:
         fx = np.array(fx)
-    
     try:
         fn, fm=fx.shape
         if fm > fn:
@@ -885,7 +1081,7 @@ def robust_wvd(fx, nh=2**7-1, ng=2**4-1, tstep=2**4, nfbins=2**8, df=1.0,
         #compute the analytic signal of function f and dctrend
         fa = wvd_analytic_signal(fx[0])
         fb = wvd_analytic_signal(fx[1])
-
+        
     else:
         #compute the analytic signal of function f and dctrend
         fa = wvd_analytic_signal(fx)        
@@ -925,9 +1121,11 @@ def robust_wvd(fx, nh=2**7-1, ng=2**4-1, tstep=2**4, nfbins=2**8, df=1.0,
         sigmaf = ng/(5*np.sqrt(2*np.log(2)))
     g = sps.gaussian(ng, sigmaf)
     g /= sum(g)
+    Lg = (ng-1)/2
     
     mlst = np.arange(start=-nh/2+1, stop=nh/2+1, step=1, dtype='int')
     tlst = np.arange(start=nh/2, stop=nfx-nh/2, step=tstep)
+    
     #make a frequency list for plotting exporting only positive frequencies
     flst = np.fft.fftfreq(nfbins,dt)[nfbins/2:]#get only positive frequencies
     flst[-1] = 0
@@ -935,26 +1133,41 @@ def robust_wvd(fx, nh=2**7-1, ng=2**4-1, tstep=2**4, nfbins=2**8, df=1.0,
     
     #create an empty array to put the tf in 
     tfarray = np.zeros((nfbins/2, len(tlst)), dtype='complex')
-
     
-    for tpoint, nn in enumerate(tlst):
+    #frequency shifts for all frequencies and time shifts
+    fshift = np.exp(1j*4*np.pi*np.outer(flst, mlst)*dt)
+    
+    #calculate the robust WVD for a block of time instances
+    def _robust_wvd_block(tslice):
+        nn = tlst[tslice][:, np.newaxis]
         #calculate windowed correlation function of analytic function
         fxwin = h*fa[nn+mlst]*fb[nn-mlst].conj()
-        for fpoint, mm in enumerate(flst):
-            fxmed = np.convolve(g, fxwin*np.exp(1j*4*np.pi*mlst*mm*dt),
-                                mode='same')/(nh*ng)
-            fxmedpoint = np.median(fxmed.real)
-            if fxmedpoint == 0.0:
-                tfarray[fpoint, tpoint] = 1E-10
-            else:
-                tfarray[fpoint, tpoint] = fxmedpoint
+        
+        #shift to all frequencies, only the real part is needed, zero padded
+        #for the convolution
+        fxshift = np.zeros((len(nn), len(flst), nh+2*Lg))
+        fxshift[:, :, Lg:Lg+nh] = np.real(fxwin[:, np.newaxis, :]*fshift)
+        
+        #convolve with the time smoothing window (mode 'same')
+        fxmed = np.zeros((len(nn), len(flst), nh))
+        for jj in range(ng):
+            fxmed += g[jj]*fxshift[:, :, 2*Lg-jj:2*Lg-jj+nh]
+        fxmed /= (nh*ng)
+        
+        fxmedpoint = np.median(fxmed, axis=2)
+        fxmedpoint[np.where(fxmedpoint == 0.0)] = 1E-10
+        tfarray[:, tslice] = fxmedpoint.T
+        
+    chunk_size = _get_chunk_size(4*8*(nh+2*Lg)*nfbins/2, chunk_size)
+    _block_evaluate(_robust_wvd_block, len(tlst), chunk_size, 
+                    n_threads=n_threads)
     
     tfarray = (4.*nh/dt)*tfarray
-
+        
     return tfarray, tlst, flstp
-
+    
 def specwv(fx, tstep=2**5, nfbins=2**10, nhs=2**8, nhwv=2**9-1, ngwv=2**3-1,
-           df=1.0):
+           df=1.0, chunk_size=None, n_threads=1):
     """
     Calculates the Wigner-Ville distribution mulitplied by the STFT windowed
     by the common gaussian window h for an array f.  Handy for removing cross
@@ -988,6 +1201,14 @@ def specwv(fx, tstep=2**5, nfbins=2**10, nhs=2**8, nhwv=2**9-1, ngwv=2**3-1,
         **nfbins** : int (should be power of 2 and equal or larger than nh)
                      number of frequency bins
                      
+                     
+        **chunk_size** : int
+                         number of time instances computed at once, if None
+                         it is set to keep the memory below max_chunk_bytes
+                         
+        **n_threads** : int
+                        number of threads evaluating the chunks
+                        *default* is 1
     
     Returns:
     --------
@@ -1003,21 +1224,24 @@ def specwv(fx, tstep=2**5, nfbins=2**10, nhs=2**8, nhwv=2**9-1, ngwv=2**3-1,
     """
     
     #calculate stft
-    pst, tlst, flst = stft(fx, nh=nhs, tstep=tstep, nfbins=nfbins, df=df)
+    pst, tlst, flst = stft(fx, nh=nhs, tstep=tstep, nfbins=nfbins, df=df,
+                           chunk_size=chunk_size)
     
     #calculate new time step so WVD and STFT will align
     ntstep = len(fx)/(len(tlst)*2.)
     
     #calculate spwvd
     pwv, twv, fwv = spwvd(fx, tstep=ntstep, nfbins=nfbins, df=df,
-                          nh=nhwv, ng=ngwv)
+                          nh=nhwv, ng=ngwv, chunk_size=chunk_size, 
+                          n_threads=n_threads)
     
     #multiply the two together normalize
     tfarray = pst/pst.max()*pwv/pwv.max()
-        
+    
     return tfarray, tlst, flst
     
-def modifiedb(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=2**8-1, beta=.2):
+def modifiedb(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=2**8-1, beta=.2,
+              chunk_size=None, n_threads=1):
     """
     Calculates the modified b distribution as defined by cosh(n)^-2 beta 
     for an array fx.  Supposed to remove cross terms in the WVD. 
@@ -1043,7 +1267,15 @@ def modifiedb(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=2**8-1, beta=.2):
                      number of frequency bins
         **beta** : float
                    smoothing coefficient ussully between [0, 1]
-        
+                     
+        **chunk_size** : int
+                         number of time instances computed at once, if None
+                         it is set to keep the memory below max_chunk_bytes
+                         
+        **n_threads** : int
+                        number of threads evaluating the chunks
+                        *default* is 1
+    
     Returns:
     --------
         **tfarray** : np.ndarray(nfbins/2, len(fx)/tstep)
@@ -1066,13 +1298,12 @@ def modifiedb(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=2**8-1, beta=.2):
     except ValueError:
         fn = len(fx)
         fm = 1
-    
     if fm > 1:
-        fn = fn[0]
         print 'computing cross spectra'
         #compute the analytic signal of function f and dctrend
         fa = wvd_analytic_signal(fx[0])
         fb = wvd_analytic_signal(fx[1])
+        
     else:
         #compute the analytic signal of function f and dctrend
         fa = wvd_analytic_signal(fx)        
@@ -1087,37 +1318,55 @@ def modifiedb(fx, tstep=2**5, nfbins=2**10, df=1.0, nh=2**8-1, beta=.2):
     
     #create a time array such that the first point is centered on time window
     tlst = np.arange(start=0, stop=fn-1, step=tstep, dtype='int')
-	
+    
     #create an empty array to put the tf in 
     tfarray = np.zeros((nfbins, len(tlst)), dtype='complex')
     
     #create a frequency array with just positive frequencies
     flst = np.fft.fftfreq(nfbins, dt)[0:nfbins/2]
     
-    #calculate pseudo WV
-    for point, nn in enumerate(tlst):
+    #all time shifts of the full window
+    tau_all = np.arange(start=-tau, stop=tau+1, step=1, dtype='int')
+    
+    #calculate pseudo WV for a block of time instances
+    def _modifiedb_block(tslice):
+        nn = tlst[tslice]
         #calculate the smallest timeshift possible
-        tau_min = min(nn, tau, fn-nn-1)
-        #make a timeshift array
-        taulst = np.arange(start=-tau_min, stop=tau_min+1, step=1, dtype='int')
-        #create modified b window
-        mbwin = np.cosh(taulst)**(-2*beta)
-        mbwin = mbwin/sum(mbwin)
-        MBwin = np.fft.fft(padzeros(mbwin,npad=nfbins))
+        tau_min = np.minimum(np.minimum(nn, tau), fn-nn-1)
+        rows, lags = _lag_mask(tau_all, -tau_min, tau_min)
+        taulst = tau_all[lags]
+        #position in the zero padded arrays
+        position = tau_min[rows]+taulst
+        
+        #create modified b windows
+        mbwin = np.zeros((len(nn), nfbins))
+        mbwin[rows, position] = np.cosh(taulst)**(-2*beta)
+        mbwin /= mbwin.sum(axis=1)[:, np.newaxis]
+        MBwin = np.fft.fft(mbwin, axis=1)
+        
         #calculate windowed correlation function of analytic function
-        Rnn = np.conjugate(fa[nn-taulst])*fb[nn+taulst]  
+        Rnn = np.zeros((len(nn), nfbins), dtype='complex')
+        Rnn[rows, position] = np.conjugate(fa[nn[rows]-taulst])*\
+                              fb[nn[rows]+taulst]
+        
         #calculate fft of windowed correlation function
-        FTRnn = MBwin*np.fft.fft(padzeros(Rnn, npad=nfbins))
+        FTRnn = MBwin*np.fft.fft(Rnn, axis=1)
+        
         #put into tfarray
-        tfarray[:, point] = FTRnn[::-1]
+        tfarray[:, tslice] = FTRnn[:, ::-1].T
         
+    chunk_size = _get_chunk_size(6*16*nfbins, chunk_size)
+    _block_evaluate(_modifiedb_block, len(tlst), chunk_size, 
+                    n_threads=n_threads)
+    
     #need to cut the time frequency array in half due to the WVD assuming 
     #time series sampled at twice nyquist.
     #tfarray = tfarray
         
     return tfarray, tlst, flst
-
-def robust_stft_median(fx, nh=2**8, tstep=2**5, df=1.0, nfbins=2**10):
+    
+def robust_stft_median(fx, nh=2**8, tstep=2**5, df=1.0, nfbins=2**10,
+                       chunk_size=None):
     """
     Calculates the robust spectrogram using the vector median simplification.
      
@@ -1140,6 +1389,10 @@ def robust_stft_median(fx, nh=2**8, tstep=2**5, df=1.0, nfbins=2**10):
         
         **nfbins** : int (should be power of 2 and equal or larger than nh)
                      number of frequency bins
+                     
+        **chunk_size** : int
+                         number of windows computed at once, if None it 
+                         is set to keep the memory below max_chunk_bytes
     
     Returns:
     --------
@@ -1185,23 +1438,26 @@ def robust_stft_median(fx, nh=2**8, tstep=2**5, df=1.0, nfbins=2**10):
     #make a frequency list for plotting exporting only positive frequencies
     flst = np.fft.fftfreq(nfbins, 1/df)[nfbins/2:]#get only positive frequencies
     
-    for tpoint, nn in enumerate(tlst):
+    #frequency shifts for all frequencies and time shifts
+    fshift = np.exp(1j*2*np.pi*np.outer(flstc, mlst)/df)
+    
+    frames = get_frames(fa, nh, tstep, nframes=len(tlst))
+    chunk_size = _get_chunk_size(4*16*nh*nfbins/2, chunk_size)
+    for tslice in _chunks(len(tlst), chunk_size):
         #calculate windowed correlation function of analytic function
-        fxwin = h*fa[nn:nn+nh]
-        for fpoint, mm in enumerate(flstc):
-            fxmed = fxwin*np.exp(1j*2*np.pi*mlst*mm/df)
-            fxmedreal = np.median(fxmed.real)
-            fxmedimag = np.median(fxmed.imag)
-            if fxmedreal+1j*fxmedimag == 0.0:
-                tfarray[fpoint, tpoint] = 1E-10
-            else:
-                tfarray[fpoint, tpoint] = fxmedreal+1j*fxmedimag
+        fxwin = h*frames[tslice]
+        fxmed = fxwin[:, np.newaxis, :]*fshift
+        tfpoint = np.median(fxmed.real, axis=2)+\
+                  1j*np.median(fxmed.imag, axis=2)
+        tfpoint[np.where(tfpoint == 0.0)] = 1E-10
+        tfarray[:, tslice] = tfpoint.T
     #normalize tfarray
     tfarray = (4.*nh*df)*tfarray
         
     return tfarray, tlst, flstp
 
-def robust_stft_L(fx, alpha=.325, nh=2**8, tstep=2**5, df=1.0, nfbins=2**10):
+def robust_stft_L(fx, alpha=.325, nh=2**8, tstep=2**5, df=1.0, nfbins=2**10,
+                  chunk_size=None):
     """
     Calculates the robust spectrogram by estimating the vector median and 
     summing terms estimated by alpha coefficients.
@@ -1230,6 +1486,10 @@ def robust_stft_L(fx, alpha=.325, nh=2**8, tstep=2**5, df=1.0, nfbins=2**10):
         
         **nfbins** : int (should be power of 2 and equal or larger than nh)
                      number of frequency bins
+                     
+        **chunk_size** : int
+                         number of windows computed at once, if None it 
+                         is set to keep the memory below max_chunk_bytes
     
     Returns:
     --------
@@ -1278,27 +1538,29 @@ def robust_stft_L(fx, alpha=.325, nh=2**8, tstep=2**5, df=1.0, nfbins=2**10):
     
     #create list of coefficients
     a = np.zeros(nh)
-    a[(nh-2)*alpha:alpha*(2-nh)+nh-1] = 1./(nh*(1-2*alpha)+4*alpha)
+    a[int((nh-2)*alpha):int(alpha*(2-nh)+nh-1)] = 1./(nh*(1-2*alpha)+4*alpha)
     
-    for tpoint, nn in enumerate(tlst):
+    #frequency shifts for all frequencies and time shifts
+    fshift = np.exp(1j*2*np.pi*np.outer(flstc, mlst)/df)
+    
+    frames = get_frames(fa, nh, tstep, nframes=len(tlst))
+    chunk_size = _get_chunk_size(4*16*nh*nfbins/2, chunk_size)
+    for tslice in _chunks(len(tlst), chunk_size):
         #calculate windowed correlation function of analytic function
-        fxwin = h*fa[nn:nn+nh]
-        for fpoint, mm in enumerate(flstc):
-            fxelement = fxwin*np.exp(1j*2*np.pi*mlst*mm/df)
-            fxreal = np.sort(fxelement.real)[::-1]
-            fximag = np.sort(fxelement.imag)[::-1]
-            tfpoint = sum(a*(fxreal+1j*fximag))
-            if tfpoint == 0.0:
-                tfarray[fpoint, tpoint] = 1E-10
-            else:
-                tfarray[fpoint, tpoint] = tfpoint
+        fxwin = h*frames[tslice]
+        fxelement = fxwin[:, np.newaxis, :]*fshift
+        fxreal = np.sort(fxelement.real, axis=2)[:, :, ::-1]
+        fximag = np.sort(fxelement.imag, axis=2)[:, :, ::-1]
+        tfpoint = np.dot(fxreal, a)+1j*np.dot(fximag, a)
+        tfpoint[np.where(tfpoint == 0.0)] = 1E-10
+        tfarray[:, tslice] = tfpoint.T
     #normalize tfarray
     tfarray = (4.*nh*df)*tfarray
         
     return tfarray, tlst, flstp
 
 def smethod(fx, L=11, nh=2**8, tstep=2**7, ng=1, df=1.0, nfbins=2**10,
-            sigmaL=None):
+            sigmaL=None, chunk_size=None):
     """
     Calculates the smethod by estimating the STFT first and computing the WV
     of window length L in the frequency domain. 
@@ -1331,6 +1593,10 @@ def smethod(fx, L=11, nh=2**8, tstep=2**7, ng=1, df=1.0, nfbins=2**10,
         
         **nfbins** : int (should be power of 2 and equal or larger than nh)
                      number of frequency bins
+                     
+        **chunk_size** : int
+                         number of windows computed at once for the 
+                         spectrogram, see stft
     
     Returns:
     --------
@@ -1371,9 +1637,9 @@ def smethod(fx, L=11, nh=2**8, tstep=2**7, ng=1, df=1.0, nfbins=2**10,
         fa = fa.reshape(fn)
         fb = fb.reshape(fn)
         pxa, tlst, flst = stft(fa, nh=nh, tstep=tstep, ng=ng, df=df, 
-                               nfbins=nfbins)
+                               nfbins=nfbins, chunk_size=chunk_size)
         pxb, tlst, flst = stft(fb, nh=nh, tstep=tstep, ng=ng, df=df,
-                               nfbins=nfbins)
+                               nfbins=nfbins, chunk_size=chunk_size)
         pxx = pxa*pxb.conj()
     else:
         #compute the analytic signal of function f and dctrend
@@ -1382,7 +1648,7 @@ def smethod(fx, L=11, nh=2**8, tstep=2**7, ng=1, df=1.0, nfbins=2**10,
         fa = fa.reshape(fn)
         fb = fa
         pxx, tlst, flst = stft(fa, nh=nh, tstep=tstep, ng=ng, df=df,
-                               nfbins=nfbins)
+                               nfbins=nfbins, chunk_size=chunk_size)
 
     #make an new array to put the new tfd in
     tfarray = abs(pxx)**2
@@ -1394,22 +1660,17 @@ def smethod(fx, L=11, nh=2**8, tstep=2**7, ng=1, df=1.0, nfbins=2**10,
     if sigmaL == None:
         sigmaL = L/(1*np.sqrt(2*np.log(2)))
     p = sps.gaussian(L,sigmaL)
-    #make a matrix of windows
-    pm = np.zeros((L,nt))
-    for kk in range(nt):
-        pm[:, kk] = p
-    
-    #loop over frequency and calculate the s-method    
-    for ff in range(L/2,nf-L/2):
-        tfarray[ff, :] = tfarray[ff, :]+2*np.real(np.sum(pm*pxx[ff+Llst, :]*
-                                               pxx[ff-Llst, :].conj(), axis=0))
+    
+    #calculate the s-method for all frequencies at once
+    tfarray[L/2:nf-L/2] += _smethod_sum(pxx, p, Llst, L)
     #normalize
     tfarray[L/2:-L/2] /= L
     
     return tfarray, tlst, flst, pxx
     
 def robust_smethod(fx, L=5, nh=2**7, tstep=2**5, nfbins=2**10, df=1.0,
-                   robusttype='median', sigmaL=None, alpha=.325):
+                   robusttype='median', sigmaL=None, alpha=.325, 
+                   chunk_size=None):
     """
     Computes the robust Smethod via the robust spectrogram.
     
@@ -1445,6 +1706,10 @@ def robust_smethod(fx, L=5, nh=2**7, tstep=2**5, nfbins=2**10, df=1.0,
                          
         **simgaL** : float
                     full-width half max of gaussian window applied in frequency
+                    
+        **chunk_size** : int
+                         number of windows computed at once for the robust
+                         spectrogram, see robust_stft_median
     
     Returns:
     --------
@@ -1478,14 +1743,18 @@ def robust_smethod(fx, L=5, nh=2**7, tstep=2**5, nfbins=2**10, df=1.0,
         fb = fx[1].reshape(fn)
         if robusttype == 'median':
             pxa, tlst, flst = robust_stft_median(fa, nh=nh, tstep=tstep, df=df,
-                                               nfbins=nfbins)
+                                               nfbins=nfbins,
+                                               chunk_size=chunk_size)
             pxb, tlst, flst = robust_stft_median(fb, nh=nh, tstep=tstep, df=df,
-                                               nfbins=nfbins)
+                                               nfbins=nfbins,
+                                               chunk_size=chunk_size)
         elif robusttype == 'L':
             pxa, tlst, flst = robust_stft_L(fa, nh=nh, tstep=tstep, df=df,
-                                          nfbins=nfbins, alpha=alpha)
+                                          nfbins=nfbins, alpha=alpha,
+                                          chunk_size=chunk_size)
             pxb, tlst, flst = robust_stft_L(fb, nh=nh, tstep=tstep, df=df,
-                                          nfbins=nfbins, alpha=alpha)
+                                          nfbins=nfbins, alpha=alpha,
+                                          chunk_size=chunk_size)
         else:
             raise NameError('robusttype {0} undefined'.format(robusttype))
         pxx = pxa*pxb.conj()
@@ -1493,10 +1762,12 @@ def robust_smethod(fx, L=5, nh=2**7, tstep=2**5, nfbins=2**10, df=1.0,
         fa = fx.reshape(fn)
         if robusttype == 'median':
             pxx, tlst, flst = robust_stft_median(fa, nh=nh, tstep=tstep, df=df,
-                                               nfbins=nfbins)
+                                               nfbins=nfbins,
+                                               chunk_size=chunk_size)
         elif robusttype == 'L':
             pxx, tlst, flst = robust_stft_L(fa, nh=nh, tstep=tstep, df=df,
-                                          nfbins=nfbins, alpha=alpha)
+                                          nfbins=nfbins, alpha=alpha,
+                                          chunk_size=chunk_size)
         else:
             raise NameError('robusttype {0} undefined'.format(robusttype))
     
@@ -1504,25 +1775,35 @@ def robust_smethod(fx, L=5, nh=2**7, tstep=2**5, nfbins=2**10, df=1.0,
     Llst=np.arange(start=-L/2+1,stop=L/2+1,step=1,dtype='int')
 
     #compute the frequency window of length L
-    if sigmal == None:    
-        sigmal = L/3*(np.sqrt(2*np.log(2)))        
+    if sigmaL == None:    
+        sigmaL = L/3*(np.sqrt(2*np.log(2)))        
     lwin = gausswin(L,sigmaL)
     lwin /= sum(lwin)
-    pm = np.zeros((L, len(tlst)))
-    for kk in range(len(tlst)):
-        pm[:, kk] = lwin
     
     smarray = pxx.copy()
     #compute S-method
-    for ff in range(L/2, nfbins/2-L/2):
-        smarray[ff, :] = smarray[ff, :]+2*np.real(np.sum(pm*pxx[ff+Llst, :]*
-                                                         pxx[ff-Llst,:].conj(),
-                                                         axis=0))
+    smarray[L/2:nfbins/2-L/2] += _smethod_sum(pxx, lwin, Llst, L)
     #normalize
     smarray = (2./(L*nh))*smarray
     
     return smarray, tlst, flst, pxx
     
+def _smethod_sum(pxx, p, Llst, L):
+    """
+    Returns the S-method correction 
+    2*Re(sum_l p[l]*pxx[f+l]*conj(pxx[f-l])) for the frequencies 
+    L/2 <= f < nf-L/2 of the spectrogram pxx, summing over the L frequency
+    shifts instead of looping over the frequencies.
+    """
+    
+    nf = pxx.shape[0]
+    smsum = np.zeros((nf-2*(L/2), pxx.shape[1]), dtype=pxx.dtype)
+    for ll, shift in enumerate(Llst):
+        smsum += p[ll]*pxx[L/2+shift:nf-L/2+shift]*\
+                 pxx[L/2-shift:nf-L/2-shift].conj()
+    
+    return 2*np.real(smsum)
+    
 def reassigned_smethod(fx, nh=2**7-1, tstep=2**4, nfbins=2**9, df=1.0, alpha=4,
                        thresh=.01, L=5):
     """ 
@@ -1710,8 +1991,40 @@ def reassigned_smethod(fx, nh=2**7-1, tstep=2**4, nfbins=2**9, df=1.0, alpha=4,
     return rtfarray, tlst, flst, sm
         
 
+def _cross_stfd(task):
+    """
+    Computes the spatial time-frequency distribution of a pair of whitened 
+    time series for stfbss, the auto term for jj == kk.
+    
+    Arguments:
+    ----------
+        **task** : tuple
+                   (jj, kk, tftype, za, zb, tfkwargs)
+    
+    Returns:
+    --------
+        **jj, kk** : indices of the pair
+        
+        **tfarray** : cross time-frequency distribution of za and zb
+    """
+    
+    jj, kk, tftype, za, zb, tfkwargs = task
+    
+    if tftype == 'spwvd':
+        tfarray = spwvd([za, zb], **tfkwargs)[0]
+    elif tftype == 'smethod':
+        tfarray = smethod([za, zb], **tfkwargs)[0]
+    elif tftype == 'Lestimate':
+        tfarray = robust_smethod([za, zb], **tfkwargs)[0]
+    else:
+        raise NameError('tftype {0} undefined'.format(tftype))
+    
+    return jj, kk, tfarray
+    
 def stfbss(X,nsources=5,ng=2**5-1,nh=2**9-1,tstep=2**6-1,df=1.0,nfbins=2**10,
-          tftol=1.E-8,L=7,normalize=True,tftype='spwvd',alpha=.38):
+          tftol=1.E-8,L=7,normalize=True,tftype='spwvd',alpha=.38,
+          n_processes=1,update_progress=None,return_timings=False,
+          max_sweeps=100):
     """
     btfssX,nsources=5,ng=2**5-1,nh=2**9-1,tstep=2**6-1,df=1.0,nfbins=2**10,
           tftol=1.E-8,normalize=True) 
@@ -1733,11 +2046,23 @@ def stfbss(X,nsources=5,ng=2**5-1,nh=2**9-1,tstep=2**6-1,df=1.0,nfbins=2**10,
                 terms.
         normalization = True or False, True to normalize, False if already 
                         normalized
+        n_processes = number of processes computing the time-frequency 
+                      distributions of the channel pairs
+        update_progress = function called as update_progress(label, i, n) 
+                          after each computed channel pair and each sweep of 
+                          the joint diagonalization (n is max_sweeps there, 
+                          the sweeps usually stop earlier)
+        return_timings = True to also return the time spent (s) on the STFDs,
+                         on the cross term criteria and on the joint 
+                         diagonalization
+        max_sweeps = maximum number of sweeps of the joint diagonalization
     
     Returns:
         
         Se = estimated individual signals up to a permutation and scale
         Ae = estimated mixing matrix as X=A*S
+        timings = {'stfd': s, 'criteria': s, 'joint diagonalization': s}, 
+                  only if return_timings is True
     """
     
     
@@ -1800,84 +2125,66 @@ def stfbss(X,nsources=5,ng=2**5-1,nh=2**9-1,tstep=2**6-1,df=1.0,nfbins=2**10,
     #  Compute Spatial Time Frequency Distribution
     #===============================================================================
     
-    
+    t0=time.time()
     Za=np.array(Z.copy())
     
     if tftype=='spwvd':
         stfd=np.zeros((n,n,nfbins,ntbins+1),dtype='complex128')
-        #compute auto terms
-        for ii in range(n):
-            pswvd,tswvd,fswvd=spwvd(Za[ii].reshape(maxn),**tfkwargs)
-            stfd[ii,ii,:,:]=pswvd
-        
-        #compute cross terms
-        for jj in range(n):
-            for kk in range(jj,n):
-                pswvd,tswvd,fswvd=spwvd([Za[jj].reshape(maxn),
-                                         Za[kk].reshape(maxn)],
-                                         **tfkwargs)
-                stfd[jj,kk,:,:]=pswvd
-                stfd[kk,jj,:,:]=pswvd.conj()
-    
-    elif tftype=='smethod':
+    elif tftype in ['smethod','Lestimate']:
         nfbins=nfbins/2
         stfd=np.zeros((n,n,nfbins,ntbins),dtype='complex128')
-        #compute auto terms
-        for ii in range(n):
-            psm,tsm,fsm,pst=smethod(Za[ii].reshape(maxn),**tfkwargs)
-            stfd[ii,ii,:,:]=psm
-        
-        #compute cross terms
-        for jj in range(n):
-            for kk in range(jj,n):
-                psm,tsm,fsm,pst=smethod([Za[jj].reshape(maxn),
-                                         Za[kk].reshape(maxn)],
-                                        **tfkwargs)
-                stfd[jj,kk,:,:]=psm
-                stfd[kk,jj,:,:]=psm.conj()
-                
-    elif tftype=='Lestimate':
-        nfbins=nfbins/2
-        stfd=np.zeros((n,n,nfbins,ntbins),dtype='complex128')
-        #compute auto terms
-        for ii in range(n):
-            psm,tsm,fsm,pst=robust_smethod(Za[ii].reshape(maxn),**tfkwargs)
-            stfd[ii,ii,:,:psm.shape[1]]=psm
-        
-        #compute cross terms
-        for jj in range(n):
-            for kk in range(jj,n):
-                psm,tsm,fsm,pst=robust_smethod([Za[jj].reshape(maxn),
-                                               Za[kk].reshape(maxn)],
-                                                **tfkwargs)
+    
+    #compute the distributions of all pairs of channels, the auto terms are
+    #the distributions of the pairs (jj,jj)
+    lo_tasks=[(jj,kk,tftype,Za[jj].reshape(maxn),Za[kk].reshape(maxn),
+               tfkwargs) for jj in range(n) for kk in range(jj,n)]
+    
+    if n_processes>1:
+        pool=multiprocessing.Pool(n_processes)
+        try:
+            lo_results=pool.imap_unordered(_cross_stfd,lo_tasks)
+            for ii,(jj,kk,psm) in enumerate(lo_results):
                 stfd[jj,kk,:,:psm.shape[1]]=psm
                 stfd[kk,jj,:,:psm.shape[1]]=psm.conj()
+                if update_progress:
+                    update_progress('Computing STFDs',ii+1,len(lo_tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for ii,task in enumerate(lo_tasks):
+            jj,kk,psm=_cross_stfd(task)
+            stfd[jj,kk,:,:psm.shape[1]]=psm
+            stfd[kk,jj,:,:psm.shape[1]]=psm.conj()
+            if update_progress:
+                update_progress('Computing STFDs',ii+1,len(lo_tasks))
+    
+    timings={'stfd':time.time()-t0}
     
     #===============================================================================
     # Compute criteria for cross terms 
     #===============================================================================
     
-    stfdTr=np.zeros((nfbins,ntbins))
+    t0=time.time()
     C=np.zeros((nfbins,ntbins))
     
-    for ff in range(nfbins):
-        for tt in range(ntbins):
-            #compensate for noise
-            stfd[:,:,ff,tt]=stfd[:,:,ff,tt]-sigman*np.matrix(W)*np.matrix(W.T)
-            #compute the trace
-            stfdTr[ff,tt]=abs(np.trace(stfd[:,:,ff,tt]))
+    #compensate for noise
+    stfd[:,:,:,:ntbins]-=sigman*np.dot(W,W.T)[:,:,np.newaxis,np.newaxis]
+    #compute the trace
+    stfdTr=abs(np.einsum('iijk->jk',stfd[:,:,:,:ntbins]))
+        
     #compute mean over entire t-f plane
     trmean=stfdTr.mean()
     
     #find t-f points that meet the criteria
     fspot,tspot=np.nonzero(stfdTr>trmean)
     
-    for ll in range(len(fspot)):
-        treig=abs(np.linalg.eig(stfd[:,:,fspot[ll],tspot[ll]])[0])
-        if sum(treig)!=0 and sum(treig)>tftol:
-            C[fspot[ll],tspot[ll]]=max(treig)/sum(treig)
-        else:
-            C[fspot[ll],tspot[ll]]=0
+    if len(fspot)>0:
+        treig=abs(np.linalg.eigvals(stfd[:,:,fspot,tspot].transpose(2,0,1)))
+        trsum=treig.sum(axis=1)
+        criterion=(trsum!=0)&(trsum>tftol)
+        C[fspot[criterion],tspot[criterion]]=treig[criterion].max(axis=1)/\
+                                             trsum[criterion]
     
     #compute gradients and jacobi matrices
     negjacobi=np.zeros((nfbins,ntbins))
@@ -1906,20 +2213,19 @@ def stfbss(X,nsources=5,ng=2**5-1,nh=2**9-1,tstep=2**6-1,df=1.0,nfbins=2**10,
     else:
         print 'Found '+str(ntfpoints)+' t-f points'
     
-    for rr in range(ntfpoints):
-        if rr==0:
-            Rjd=stfd[:,:,gfspot[rr],gtspot[rr]]
-        else:
-            Rjd=np.concatenate((Rjd,stfd[:,:,gfspot[rr],gtspot[rr]]),axis=1)
-    Rjd=np.array(Rjd)
-    
     #===============================================================================
     # Calculate Joint Diagonalization
     #===============================================================================
-    #get size of array of matrices to be diagonalized
-    mtf,nm=Rjd.shape #mtf is number of t-f points, nm is number of matrices
+    #stack of the matrices to be diagonalized, Rjd[:,:,rr] is the matrix of 
+    #t-f point rr
+    Rjd=np.array(stfd[:,:,gfspot,gtspot])
+    #mtf is the size of the matrices, nm is number of matrices
+    mtf=Rjd.shape[0]
+    nm=Rjd.shape[2]
     #set up some initial parameters
     V=np.eye(mtf)
+    timings['criteria']=time.time()-t0
+    t0=time.time()
     
     #update boolean
     encore=True 
@@ -1929,43 +2235,41 @@ def stfbss(X,nsources=5,ng=2**5-1,nh=2**9-1,tstep=2**6-1,df=1.0,nfbins=2**10,
     #print 'Computing Joint Diagonalization'
     # Joint diagonalization proper
     # ============================
-    while encore:
+    while encore and sweep<max_sweeps:
         #reset some parameters
         encore=False
         sweep+=1 
         upds=0
-        Vkeep=V
         for p in range(mtf):
             
             for q in range(p+1,mtf):
-                #set up indices
-                qi=np.arange(start=q,stop=nm,step=mtf)
-                pi=np.arange(start=p,stop=nm,step=mtf)
-                # computation of Givens angle
-                g=np.array([Rjd[p,pi]-Rjd[q,qi],Rjd[p,qi],Rjd[q,pi]])
+                # computation of Givens angle from all matrices at once
+                g=np.array([Rjd[p,p]-Rjd[q,q],Rjd[p,q],Rjd[q,p]])
                 gg=np.real(np.dot(g,g.T))
                 ton=gg[0,0]-gg[1,1] 
                 toff=gg[0,1]+gg[1,0]
                 theta=0.5*np.arctan2(toff,ton+np.sqrt(ton**2+toff**2))
-                # Givens update
+                # Givens update of rows and columns p and q of all matrices
                 if abs(theta) > tftol:
                     encore=True
                     upds+=1
                     c=np.cos(theta) 
                     s=np.sin(theta)
-                    G=np.matrix([[c,-s],[s,c]])
-                    pair =np.array([p,q])
-                    V[:,pair]=V[:,pair]*G
-                    Rjd[pair,:]=G.T*Rjd[pair,:]
-                    Rjd[:,np.concatenate([pi,qi])]=np.append(
-                                                c*Rjd[:,pi]+s*Rjd[:,qi],
-                                                -s*Rjd[:,pi]+c*Rjd[:,qi],axis=1)
+                    V[:,p],V[:,q]=c*V[:,p]+s*V[:,q],-s*V[:,p]+c*V[:,q]
+                    Rjd[p],Rjd[q]=c*Rjd[p]+s*Rjd[q],-s*Rjd[p]+c*Rjd[q]
+                    Rjd[:,p],Rjd[:,q]=c*Rjd[:,p]+s*Rjd[:,q],\
+                                      -s*Rjd[:,p]+c*Rjd[:,q]
         updates+=upds
+        if update_progress:
+            update_progress('Joint diagonalization',sweep,max_sweeps)
     print 'Updated '+str(updates)+' times.'
+    timings['joint diagonalization']=time.time()-t0
     
     #compute estimated signal matrix
     Se=np.dot(V.T,Z)
     #compute estimated mixing matrix
     Ae=np.dot(np.linalg.pinv(W),V)
     
+    if return_timings:
+        return Se,Ae,timings
     return Se,Ae
@@ -7,6 +7,7 @@ import util, evalresp
 import time, math, copy, logging, sys
 import numpy as num
 from util import reuse, hpfloat
+from samplebuffer import SampleBuffer
 from scipy import signal
 from pyrocko import model, orthodrome
 
@@ -45,6 +46,7 @@ class Trace(object):
                  tmin=0., tmax=None, deltat=1., ydata=None, mtime=None, meta=None):
     
         self._growbuffer = None
+        self._buffer = None
         
         if deltat < 0.001:
             tmin = hpfloat(tmin)
@@ -89,6 +91,7 @@ class Trace(object):
         self.ydata = None
         self.meta = None
         self._growbuffer = None
+        self._buffer = None
         self._update_ids()
 
     def name(self):
@@ -151,6 +154,7 @@ class Trace(object):
         match.
         '''
         
+        self.make_writable()
         if interpolate:
             assert self.deltat <= other.deltat or same_sampling_rate(self,other)
             other_xdata = other.get_xdata()
@@ -177,6 +181,7 @@ class Trace(object):
         match.
         '''
 
+        self.make_writable()
         if interpolate:
             assert self.deltat <= other.deltat or same_sampling_rate(self,other)
             other_xdata = other.get_xdata()
@@ -289,18 +294,90 @@ class Trace(object):
     def drop_data(self):
         '''Forget data, make dataless trace.'''
         self.drop_growbuffer()
+        if self._buffer is not None:
+            self._buffer = SampleBuffer(dtype=self._buffer.dtype)
         self.ydata = None
    
     def drop_growbuffer(self):
         '''Detach the traces grow buffer.'''
         self._growbuffer = None
 
+    def set_buffered(self, buffered=True, dtype=None):
+        '''Switch between plain and buffered storage of the data samples.
+
+        In buffered mode, the samples are held in a
+        :py:class:`samplebuffer.SampleBuffer`: :py:meth:`append` and
+        :py:meth:`extend` grow the storage in place, and :py:meth:`chop` and
+        :py:meth:`copy` return traces sharing the samples instead of copies.
+        Shared samples are copied only when one of the traces is modified
+        (copy-on-write). While shared, *ydata* is a read-only view; call
+        :py:meth:`make_writable` before modifying it directly.
+
+        :param buffered: whether to use buffered storage
+        :param dtype: storage data type in buffered mode, e.g. ``num.float32``
+            to halve the memory use; defaults to the type of the current data
+        '''
+
+        if buffered:
+            self._buffer = SampleBuffer(self.ydata, dtype=dtype)
+            if self.ydata is not None:
+                self._set_buffer(self._buffer)
+        else:
+            if self._buffer is not None and self.ydata is not None:
+                self.ydata = self.make_writable()
+            self._buffer = None
+
+    def is_buffered(self):
+        '''Check whether the trace uses buffered storage.'''
+        return self._buffer is not None
+
+    def _set_buffer(self, buf):
+        self._buffer = buf
+        self.ydata = buf.data
+    
+    def _sync_buffer(self):
+        '''Get sample buffer (``None`` if not in buffered mode), adopting data
+        arrays which have been set by other methods.'''
+
+        buf = self._buffer
+        if buf is None or self.ydata is None:
+            return None
+
+        if not buf.is_data(self.ydata):
+            buf = SampleBuffer(self.ydata, dtype=buf.dtype)
+            self._set_buffer(buf)
+
+        return buf
+
+    def make_writable(self):
+        '''Make sure that the data array may be modified in place.
+
+        In buffered mode, samples shared with other traces are copied first.
+        Returns the data array.
+        '''
+
+        buf = self._sync_buffer()
+        if buf is not None:
+            buf.make_writable()
+            self.ydata = buf.data
+
+        return self.ydata
+
     def copy(self, data=True):
-        '''Make a deep copy of the trace.'''
+        '''Make a deep copy of the trace.
+
+        In buffered mode, the copy shares the samples until either trace is
+        modified.'''
         tracecopy = copy.copy(self)
         self.drop_growbuffer()
+        buf = self._sync_buffer()
+        tracecopy._buffer = None
         if data:
-            tracecopy.ydata = self.ydata.copy()
+            if buf is not None:
+                tracecopy._set_buffer(buf.copy())
+                self.ydata = buf.data
+            else:
+                tracecopy.ydata = self.ydata.copy()
         tracecopy.meta = copy.deepcopy(self.meta)
         return tracecopy
     
@@ -327,8 +404,16 @@ class Trace(object):
         
         To make this method efficient when successively very few or even single samples are appended,
         a larger grow buffer is allocated upon first invocation. The traces data is then changed to
-        be a view into the currently filled portion of the grow buffer array.'''
-        
+        be a view into the currently filled portion of the grow buffer array.
+        In buffered mode, the trace's sample buffer is grown instead.'''
+        
+        buf = self._sync_buffer()
+        if buf is not None:
+            buf.append(data)
+            self._set_buffer(buf)
+            self.tmax = self.tmin + (buf.data.size-1)*self.deltat
+            return
+
         assert self.ydata.dtype == data.dtype
         newlen = data.size + self.ydata.size
         if self._growbuffer is None or self._growbuffer.size < newlen:
@@ -376,7 +461,15 @@ class Trace(object):
             obj = self.copy(data=False)
        
         self.drop_growbuffer()
-        if self.ydata is not None:
+        buf = self._sync_buffer()
+        if buf is not None:
+            # share the samples instead of copying them
+            if inplace:
+                buf.narrow(ibeg, iend)
+            else:
+                obj._set_buffer(buf.window(ibeg, iend))
+            self._set_buffer(buf)
+        elif self.ydata is not None:
             obj.ydata = self.ydata[ibeg:iend].copy()
         else:
             obj.ydata = None
@@ -417,6 +510,10 @@ class Trace(object):
             self.ydata, finals = result, None
         else:
             self.ydata, finals = result
+
+        if self._buffer is not None:
+            # store in the buffer's data type
+            self._set_buffer(SampleBuffer(self.ydata, dtype=self._buffer.dtype))
             
         self.deltat = reuse(self.deltat*ndecimate)
         self.tmax = self.tmin+(len(self.ydata)-1)*self.deltat
@@ -625,7 +722,7 @@ class Trace(object):
         self.ydata = num.sqrt(self.ydata**2 + hilbert(self.ydata)**2)
 
     def taper(self, taperer):
-        taperer(self.ydata, self.tmin, self.deltat)
+        taperer(self.make_writable(), self.tmin, self.deltat)
     
     def whiten(self, order=6):
         '''Whiten signal in time domain using autoregression and recursive filter.
@@ -874,14 +971,26 @@ class Trace(object):
         self.tmax += nh*self.deltat
         n = nl+self.ydata.size+nh
 
-        data = num.zeros(n, dtype=self.ydata.dtype)
-        data[nl:n-nh] = self.ydata
-        if fillmethod == 'repeat' and self.ydata.size >= 1:
+        buf = self._sync_buffer()
+        if buf is not None:
+            # grow in place where the buffer has room
+            buf.extend(nl, nh)
+            data = buf.make_writable()
+            data[:nl] = 0
+            data[n-nh:] = 0
+        else:
+            data = num.zeros(n, dtype=self.ydata.dtype)
+            data[nl:n-nh] = self.ydata
+
+        if fillmethod == 'repeat' and n-nh-nl >= 1:
             data[:nl] = data[nl]
             data[n-nh:] = data[n-nh-1]
             
         self.drop_growbuffer()
-        self.ydata = data
+        if buf is not None:
+            self._set_buffer(buf)
+        else:
+            self.ydata = data
         
         self._update_ids()
      
@@ -1164,6 +1273,10 @@ def degapper(traces, maxgap=5, fillmethod='interpolate', deoverlap='use_second',
     This method will combine adjacent traces, which match in their network, 
     station, location and channel attributes. Overlapping parts are handled
     according to the `deoverlap` argument.
+
+    The layout of all merged traces is determined first, then the samples of
+    each input trace are copied once into a preallocated array per merged 
+    trace, so that the cost grows linearly with the number of pieces.
     
     :param traces:      input traces, must be sorted by their full_id attribute.
     :param maxgap:      maximum number of samples to interpolate.
@@ -1179,73 +1292,111 @@ def degapper(traces, maxgap=5, fillmethod='interpolate', deoverlap='use_second',
     in_traces = traces 
     out_traces = []
     if not in_traces: return out_traces
-    out_traces.append(in_traces.pop(0))
-    while in_traces:
+
+    # first pass: merge the meta information and record for each output trace
+    # the pieces to be joined as (method, trace, offset, n), as well as the
+    # final and the maximum intermediate number of samples
+    layouts = [ [] ]
+    nsamples = [ in_traces[0].data_len() ]
+    nsamples_max = [ nsamples[0] ]
+    out_traces.append(in_traces[0])
+    for b in in_traces[1:]:
         
         a = out_traces[-1]
-        b = in_traces.pop(0)
         
         avirt, bvirt = a.ydata is None, b.ydata is None
         assert avirt == bvirt, 'traces given to degapper() must either all have data or have no data.'
         virtual = avirt and bvirt
 
+        if virtual:
+            na = a.data_len()
+        else:
+            na = nsamples[-1]
+
+        nb = b.data_len()
+
         if (a.nslc_id == b.nslc_id and a.deltat == b.deltat and 
-            a.data_len() >= 1 and b.data_len() >= 1 and 
+            na >= 1 and nb >= 1 and 
             (virtual or a.ydata.dtype == b.ydata.dtype)):
             
-            dist = (b.tmin-(a.tmin+(a.data_len()-1)*a.deltat))/a.deltat
+            dist = (b.tmin-(a.tmin+(na-1)*a.deltat))/a.deltat
             idist = int(round(dist))
             if abs(dist - idist) > 0.05 and idist <= maxgap:
                 pass #logger.warn('Cannot degap traces with displaced sampling (%s,%s,%s,%s)' % a.nslc_id)
             else:
+                piece = None
                 if 1 < idist <= maxgap:
-                    if not virtual:
-                        if fillmethod == 'interpolate':
-                            filler = a.ydata[-1] + (((1.+num.arange(idist-1,dtype=num.float))/idist)*(b.ydata[0]-a.ydata[-1])).astype(a.ydata.dtype)
-                        elif fillmethod == 'zeros':
-                            filler = num.zeros(idist-1,dtype=a.ydist.dtype)
-                        a.ydata = num.concatenate((a.ydata,filler,b.ydata))
-                    a.tmax = b.tmax
-                    if a.mtime and b.mtime:
-                        a.mtime = max(a.mtime, b.mtime)
-                    continue
+                    piece = ('fill', b, na, idist-1)
+                    n = na + idist-1 + nb
 
                 elif idist == 1:
-                    if not virtual:
-                        a.ydata = num.concatenate((a.ydata,b.ydata))
-                    a.tmax = b.tmax
-                    if a.mtime and b.mtime:
-                        a.mtime = max(a.mtime, b.mtime)
-                    continue
+                    piece = ('append', b, na, 0)
+                    n = na + nb
                     
                 elif idist <= 0 and (maxlap is None or -maxlap < idist):
                     if b.tmax > a.tmax:
-                        if not virtual:
-                            na = a.ydata.size
-                            n = -idist+1
-                            if deoverlap == 'use_second':
-                                a.ydata = num.concatenate((a.ydata[:-n], b.ydata))
-                            elif deoverlap in ('use_first', 'crossfade_cos'):
-                                a.ydata = num.concatenate((a.ydata, b.ydata[n:]))
-                            else:
-                                assert False, 'unknown deoverlap method'
-
-                            if deoverlap == 'crossfade_cos':
-                                n = -idist+1
-                                taper = 0.5-0.5*num.cos((1.+num.arange(n))/(1.+n)*num.pi)
-                                a.ydata[na-n:na] *= 1.-taper
-                                a.ydata[na-n:na] += b.ydata[:n] * taper
-
-                        a.tmax = b.tmax
-                        if a.mtime and b.mtime:
-                            a.mtime = max(a.mtime, b.mtime)
-                        continue
+                        nlap = -idist+1
+                        if deoverlap == 'use_second':
+                            piece = ('use_second', b, max(na-nlap, 0), nlap)
+                            n = max(na-nlap, 0) + nb
+                        elif deoverlap in ('use_first', 'crossfade_cos'):
+                            piece = (deoverlap, b, na, nlap)
+                            n = na + max(nb-nlap, 0)
+                        else:
+                            assert False, 'unknown deoverlap method'
+
                     else:
                         # make short second trace vanish
                         continue
+
+                if piece is not None:
+                    layouts[-1].append(piece)
+                    nsamples[-1] = n
+                    nsamples_max[-1] = max(nsamples_max[-1], n)
+                    a.tmax = b.tmax
+                    if a.mtime and b.mtime:
+                        a.mtime = max(a.mtime, b.mtime)
+                    continue
                     
-        if b.data_len() >= 1:
+        if nb >= 1:
             out_traces.append(b)
+            layouts.append([])
+            nsamples.append(nb)
+            nsamples_max.append(nb)
+
+    # second pass: copy the pieces into the output arrays
+    for a, layout, n, nmax in zip(out_traces, layouts, nsamples, nsamples_max):
+        if not layout or a.ydata is None:
+            continue
+
+        ydata = num.empty(nmax, dtype=a.ydata.dtype)
+        ydata[:a.ydata.size] = a.ydata
+        for (method, b, offset, nlap) in layout:
+            if method == 'fill':
+                if fillmethod == 'interpolate':
+                    ydata[offset:offset+nlap] = ydata[offset-1] + (((1.+num.arange(nlap,dtype=num.float))/(nlap+1))*(b.ydata[0]-ydata[offset-1])).astype(ydata.dtype)
+                elif fillmethod == 'zeros':
+                    ydata[offset:offset+nlap] = 0
+                else:
+                    assert False, 'unknown fillmethod'
+
+                ydata[offset+nlap:offset+nlap+b.ydata.size] = b.ydata
+
+            elif method in ('append', 'use_second'):
+                ydata[offset:offset+b.ydata.size] = b.ydata
+
+            else:
+                ydata[offset:offset+max(b.ydata.size-nlap, 0)] = b.ydata[nlap:]
+                if method == 'crossfade_cos':
+                    taper = 0.5-0.5*num.cos((1.+num.arange(nlap))/(1.+nlap)*num.pi)
+                    ydata[offset-nlap:offset] *= 1.-taper
+                    ydata[offset-nlap:offset] += b.ydata[:nlap] * taper
+
+        a.drop_growbuffer()
+        a.ydata = ydata[:n]
+
+    # the input list is consumed, as before
+    del in_traces[:]
             
     for tr in out_traces:
         tr._update_ids()
@@ -1580,28 +1731,8 @@ def correlate(a, b, mode='valid', normalization=None, use_fft=False):
     yc = numpy_correlate_fixed(yb, ya, mode=mode, use_fft=use_fft) # need reversed order here
     kmin, kmax = numpy_correlate_lag_range(yb, ya, mode=mode, use_fft=use_fft)
 
-    if normalization == 'normal':
-        normfac = num.sqrt(num.sum(ya**2))*num.sqrt(num.sum(yb**2))
-        yc /= normfac
-
-    elif normalization == 'gliding':
-        if mode != 'valid':
-            assert False, 'gliding normalization currently only available with "valid" mode.'
-
-        if ya.size < yb.size:
-            yshort, ylong = ya, yb
-        else:
-            yshort, ylong = yb, ya
-        
-        epsilon = 0.00001
-        normfac_short = num.sqrt(num.sum(yshort**2)) 
-        normfac = normfac_short * num.sqrt(moving_sum(ylong**2,yshort.size, mode='valid')) + normfac_short*epsilon
-        
-        if yb.size <= ya.size:
-            normfac = normfac[::-1]
+    _correlate_normalize(yc, ya, yb, mode, normalization)
 
-        yc /= normfac
-    
     c = a.copy()
     c.set_ydata(yc)
     c.set_codes(*merge_codes(a,b,'~'))
@@ -1644,6 +1775,200 @@ def deconvolve(a, b, waterlevel, tshift=0., pad=0.5, fd_taper=None, pad_to_pow2=
     c.set_codes(*merge_codes(a,b,'/'))
     return c
 
+def _correlate_normalize(yc, ya, yb, mode, normalization):
+    '''Normalize cross correlation *yc* of *ya* and *yb* in place.'''
+
+    if normalization == 'normal':
+        normfac = num.sqrt(num.sum(ya**2))*num.sqrt(num.sum(yb**2))
+        yc /= normfac
+
+    elif normalization == 'gliding':
+        if mode != 'valid':
+            assert False, 'gliding normalization currently only available with "valid" mode.'
+
+        if ya.size < yb.size:
+            yshort, ylong = ya, yb
+        else:
+            yshort, ylong = yb, ya
+        
+        epsilon = 0.00001
+        normfac_short = num.sqrt(num.sum(yshort**2)) 
+        normfac = normfac_short * num.sqrt(moving_sum(ylong**2,yshort.size, mode='valid')) + normfac_short*epsilon
+        
+        if yb.size <= ya.size:
+            normfac = normfac[::-1]
+
+        yc /= normfac
+
+def _group_pairs(traces, pairs, ntrans_func):
+    '''Group index pairs by transform length.'''
+
+    groups = {}
+    for ipair, (ia, ib) in enumerate(pairs):
+        ntrans = ntrans_func(traces[ia], traces[ib])
+        groups.setdefault(ntrans, []).append(ipair)
+
+    return groups
+
+def _batch_spectra(traces, pairs, ntrans, real=True):
+    '''Spectra of all traces used in *pairs* at common transform length.
+
+    Returns a dict mapping trace index to row and a 2D array with one
+    spectrum per row.
+    '''
+
+    indices = sorted(set([ i for pair in pairs for i in pair ]))
+    rows = dict( (itr, irow) for (irow, itr) in enumerate(indices) )
+    
+    if real:
+        y = num.zeros((len(indices), ntrans), dtype=num.float)
+    else:
+        y = num.zeros((len(indices), ntrans), dtype=num.complex)
+
+    for irow, itr in enumerate(indices):
+        ydata = traces[itr].ydata[:ntrans]
+        y[irow,:ydata.size] = ydata
+
+    if real:
+        return rows, num.fft.rfft(y, axis=1)
+    else:
+        return rows, num.fft.fft(y, axis=1)
+
+def correlate_many(traces, pairs=None, mode='valid', normalization=None):
+    '''Cross correlation of many pairs of traces.
+
+    :param traces: list of input traces
+    :param pairs: list of index pairs ``(ia, ib)`` into *traces*, defaults
+        to all pairs with ``ia < ib``
+    :param mode: ``'valid'``, ``'full'``, or ``'same'``
+    :param normalization: ``'normal'``, ``'gliding'``, or ``None``
+
+    :returns: list of traces containing the cross correlation coefficients,
+        one for each pair
+
+    For real data, each output trace is the same as from
+    ``correlate(traces[ia], traces[ib], mode, normalization, use_fft=True)``
+    (except for mode ``'same'`` with ``traces[ia]`` longer than 
+    ``traces[ib]``, where the output always covers the lag range given by
+    :py:func:`numpy_correlate_lag_range`). For complex data, it is the same
+    as with ``use_fft=False``, as the ``use_fft=True`` path of 
+    :py:func:`correlate` does not conjugate the first trace.
+    The spectrum of each trace is computed only once, the cross spectra of
+    all pairs are formed as one array product and transformed back with a
+    single inverse FFT. Pairs are grouped by transform length, so for
+    traces of equal length (e.g. the channels of one time window) there is
+    just one group. Transform lengths are taken from :py:func:`fft_size`,
+    so that repeated calls with the same window lengths reuse them, as well
+    as NumPy's cached FFT setup.
+    '''
+
+    if pairs is None:
+        pairs = [ (ia, ib) for ia in xrange(len(traces)) 
+                  for ib in xrange(ia+1, len(traces)) ]
+
+    pairs = list(pairs)
+    for (ia, ib) in pairs:
+        assert_same_sampling_rate(traces[ia], traces[ib])
+    
+    real = not any(num.iscomplexobj(tr.ydata) for tr in traces)
+
+    def ntrans_func(a, b):
+        return fft_size(a.data_len() + b.data_len() - 1)
+
+    correlations = [ None ] * len(pairs)
+    groups = _group_pairs(traces, pairs, ntrans_func)
+    for ntrans, ipairs in groups.iteritems():
+        group = [ pairs[ipair] for ipair in ipairs ]
+        rows, spec = _batch_spectra(traces, group, ntrans, real)
+        ia = num.array([ rows[pair[0]] for pair in group ])
+        ib = num.array([ rows[pair[1]] for pair in group ])
+
+        cross = spec[ib] * num.conj(spec[ia])
+        if real:
+            ycs = num.fft.irfft(cross, ntrans, axis=1)
+        else:
+            ycs = num.fft.ifft(cross, ntrans, axis=1)
+
+        del cross
+
+        for ipair, yc_circular in zip(ipairs, ycs):
+            a, b = traces[pairs[ipair][0]], traces[pairs[ipair][1]]
+            ya, yb = a.ydata, b.ydata
+            kmin, kmax = numpy_correlate_lag_range(yb, ya, mode=mode, use_fft=True)
+            yc = yc_circular[num.arange(kmin, kmax+1) % ntrans]
+            _correlate_normalize(yc, ya, yb, mode, normalization)
+
+            c = a.copy(data=False)
+            c.set_ydata(yc)
+            c.set_codes(*merge_codes(a,b,'~'))
+            c.shift(-c.tmin + b.tmin-a.tmin + kmin * c.deltat)
+            correlations[ipair] = c
+
+    return correlations
+
+def deconvolve_many(traces, pairs, waterlevel, tshift=0., pad=0.5, fd_taper=None, pad_to_pow2=True):
+    '''Deconvolution of many pairs of traces.
+
+    :param traces: list of input traces
+    :param pairs: list of index pairs ``(ia, ib)`` into *traces*,
+        ``traces[ib]`` is deconvolved from ``traces[ia]``
+
+    The remaining arguments are as in :py:func:`deconvolve`, which gives
+    the same result for every single pair. As in :py:func:`correlate_many`,
+    the spectrum of each trace is computed once for all pairs it is used in.
+
+    :returns: list of traces, one for each pair
+    '''
+
+    pairs = list(pairs)
+    for (ia, ib) in pairs:
+        a, b = traces[ia], traces[ib]
+        assert_same_sampling_rate(a,b)
+        assert abs(a.tmin - b.tmin) < a.deltat * 0.001
+
+    def ntrans_func(a, b):
+        ndata = max(a.data_len(), b.data_len())
+        if pad_to_pow2:
+            npad = int(round(a.data_len()*pad + tshift / a.deltat))
+            return fft_size(ndata + npad, pow2=True)
+        else:
+            return ndata
+
+    deconvolved = [ None ] * len(pairs)
+    groups = _group_pairs(traces, pairs, ntrans_func)
+    for ntrans, ipairs in groups.iteritems():
+        group = [ pairs[ipair] for ipair in ipairs ]
+        rows, spec = _batch_spectra(traces, group, ntrans)
+        ia = num.array([ rows[pair[0]] for pair in group ])
+        ib = num.array([ rows[pair[1]] for pair in group ])
+
+        bspec = spec[ib]
+        out = spec[ia] * num.conj(bspec)
+        bautocorr = bspec*num.conj(bspec)
+        del bspec
+        
+        out /= num.maximum( bautocorr, 
+                waterlevel * bautocorr.max(axis=1)[:,num.newaxis] )
+
+        del bautocorr
+
+        if fd_taper is not None:
+            for ipair, row in zip(ipairs, out):
+                df = 1/(ntrans*traces[pairs[ipair][0]].deltat)
+                fd_taper( row, 0.0, df )
+
+        ydatas = num.fft.irfft(out, axis=1)
+        for ipair, ydata in zip(ipairs, ydatas):
+            a, b = traces[pairs[ipair][0]], traces[pairs[ipair][1]]
+            ndata = max(a.data_len(), b.data_len())
+            ydata = num.roll(ydata, int(round(tshift/a.deltat)))
+            c = a.copy(data=False)
+            c.set_ydata(ydata[:ndata])
+            c.set_codes(*merge_codes(a,b,'/'))
+            deconvolved[ipair] = c
+
+    return deconvolved
+
 def assert_same_sampling_rate(a,b, eps=1.0e-6):
     assert same_sampling_rate(a,b,eps), 'Sampling rates differ: %g != %g' % (a.deltat, b.deltat)
 
@@ -2048,6 +2373,37 @@ def moving_sum(x,n, mode='valid'):
 
 def nextpow2(i):
     return 2**int(math.ceil(math.log(i)/math.log(2.)))
+
+_fft_sizes = {}
+def fft_size(n, pow2=False):
+    '''Get a fast FFT length of at least *n* samples.
+
+    This is the next power of two if *pow2* is ``True``, otherwise the
+    smallest number not less than *n* without prime factors other than 2, 3
+    and 5. Results are cached.
+    '''
+
+    k = (n, pow2)
+    if k not in _fft_sizes:
+        if len(_fft_sizes) > 10000:
+            _fft_sizes.clear()
+
+        if pow2:
+            m = nextpow2(max(n, 1))
+        else:
+            m = max(n, 1)
+            while True:
+                r = m
+                for p in (2, 3, 5):
+                    while r % p == 0:
+                        r //= p
+                if r == 1:
+                    break
+                m += 1
+
+        _fft_sizes[k] = m
+
+    return _fft_sizes[k]
     
 def snapper_w_offset(nmax, offset, delta, snapfun=math.ceil):
     def snap(x):
@@ -0,0 +1,42 @@
+import unittest
+import numpy as np
+
+import mtpy.analysis.pt as MTpt
+import mtpy.analysis.uncertainty as MTunc
+
+class TestMonteCarloUncertainty(unittest.TestCase):
+
+    def setUp(self):
+        self.z = np.random.normal(0, 1, (6, 2, 2)) + \
+                 1j * np.random.normal(0, 1, (6, 2, 2))
+        self.zerr = 0.05 * np.abs(self.z)
+        self.freq = np.logspace(-2, 2, 6)
+
+    def test_vectorised_pt(self):
+        #vectorised kernels must agree with the PhaseTensor class
+        pt = MTpt.PhaseTensor(z_array=self.z, freq=self.freq)
+        pt_array = MTunc.z2pt_array(self.z)
+        self.assertTrue(np.allclose(pt_array, pt.pt))
+
+        params = MTunc.pt_parameters(pt_array)
+        self.assertTrue(np.allclose(params['phimin'], pt.phimin[0]))
+        self.assertTrue(np.allclose(params['phimax'], pt.phimax[0]))
+        self.assertTrue(np.allclose(params['alpha'], pt.alpha[0]))
+        self.assertTrue(np.allclose(params['beta'], pt.beta[0]))
+
+    def test_chunking_and_processes(self):
+        #results must not depend on the number of processes
+        summary1 = MTunc.monte_carlo_z(self.z, self.zerr, self.freq, 500,
+                                       chunk_size=128, seed=3)
+        summary2 = MTunc.monte_carlo_z(self.z, self.zerr, self.freq, 500,
+                                       chunk_size=128, seed=3, n_processes=2)
+
+        for key in MTunc.lo_parameters:
+            self.assertEqual(summary1[key]['percentiles'].shape, (5, 6))
+            self.assertTrue(np.allclose(summary1[key]['median'],
+                                        summary2[key]['median']))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
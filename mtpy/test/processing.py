@@ -0,0 +1,611 @@
+import unittest
+import tempfile
+import shutil
+import os
+import logging
+import numpy as np
+
+import mtpy.processing.calibration as MTcb
+import mtpy.processing.coherence as MTcoh
+import mtpy.processing.decimation as MTdc
+import mtpy.processing.filter as MTfilt
+import mtpy.processing.instrument as MTin
+import mtpy.processing.quality as MTq
+import mtpy.processing.samplebuffer as MTsb
+import mtpy.processing.tf as MTtf
+import mtpy.utils.filehandling as MTfh
+
+try:
+    import mtpy.processing.trace as MTtr
+except ImportError:
+    #trace needs the pyrocko modules
+    MTtr = None
+
+try:
+    import mtpy.processing.pile as MTpile
+except (ImportError, AttributeError):
+    #pile needs the pyrocko modules
+    MTpile = None
+
+class TestNotchFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.df = 256.
+        t = np.arange(2**16)/self.df
+        self.ts = np.random.normal(0, 1, t.size)+\
+                  10*np.sin(2*np.pi*60*t)+10*np.sin(2*np.pi*120*t)
+
+    def test_notches_removed(self):
+        ts, filtlst = MTfilt.adaptive_notch_filter(self.ts, df=self.df, 
+                                                   notches=[60, 120], 
+                                                   freqrad=.5)
+        self.assertEqual(len(filtlst), 2)
+        self.assertTrue(np.std(ts) < 1.5)
+
+        #a single pass with the cascade equals filtering notch by notch
+        ts2 = self.ts.copy()
+        for peak in filtlst:
+            sos = MTfilt.get_notch_sos(self.df, [peak[0]], dbstop=[peak[1]])
+            ts2 = MTfilt.SS.sosfiltfilt(sos, ts2)
+        self.assertTrue(np.allclose(ts[1000:-1000], ts2[1000:-1000], 
+                                    atol=1e-3))
+
+    def test_channels(self):
+        lo_filtered = MTfilt.adaptive_notch_filter_channels(
+                                [self.ts, 2*self.ts], n_processes=2,
+                                df=self.df, notches=[60, 120], freqrad=.5)
+        self.assertTrue(np.allclose(2*lo_filtered[0][0], lo_filtered[1][0]))
+
+
+class TestPeriodicNoise(unittest.TestCase):
+
+    def test_streaming(self):
+        dt = 0.01
+        t = np.arange(2**18)*dt
+        noise = np.where(t%12.37 < 1., 5., 0.)
+        ts = np.random.normal(0, 1, t.size)+noise
+
+        pnr = MTfilt.PeriodicNoiseRemover(dt, [[12.37, .1]])
+        filtered = np.concatenate([pnr.process(ts[ii:ii+100003]) 
+                                   for ii in range(0, t.size, 100003)])
+        self.assertEqual(pnr.n_processed, t.size)
+        self.assertTrue(np.std(filtered-(ts-noise)) < 0.5*np.std(noise))
+
+    def test_long_record(self):
+        #short segments on a long record, the period estimated from the 
+        #first segment is off and must not let the template drift away
+        dt = 0.01
+        t = np.arange(2**21)*dt
+        noise = np.where(t%12.37 < 1., 5., 0.)
+        ts = np.random.normal(0, 1, t.size)+noise
+
+        pnr = MTfilt.PeriodicNoiseRemover(dt, [[12.37, .1]])
+        filtered = np.concatenate([pnr.process(ts[ii:ii+20011]) 
+                                   for ii in range(0, t.size, 20011)])
+        self.assertAlmostEqual(pnr.periods[0], 1237., places=1)
+        residual = filtered-(ts-noise)
+        self.assertTrue(np.std(residual) < 0.2*np.std(noise))
+        self.assertTrue(np.std(residual[-20011:]) < 0.2*np.std(noise))
+
+
+class TestCalibration(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_streaming_calibration(self):
+        #raw file with time axis and data column
+        fn = os.path.join(self.tmpdir, 'BP02.ex')
+        data = np.column_stack([np.arange(10000)*0.1, 
+                                np.random.normal(0, 100., 10000)])
+        with open(fn, 'w') as F:
+            F.write('# BP02 ex 10.0 1000000000.0 10000\n')
+            np.savetxt(F, data, fmt='%.8e')
+
+        args = ('electrodes', 10., 'edl', 'high', 50., 'BP02', 'ex', -34.9, 
+                138.6, 24.)
+        MTcb.calibrate_file(fn, os.path.join(self.tmpdir, 'old'), *args)
+        old = np.loadtxt(os.path.join(self.tmpdir, 'old', 
+                                      'BP02_microvoltpermeter.ex'))
+
+        for binary in [False, True]:
+            outfile, nsamples = MTcb.calibrate_file_streaming(fn, 
+                                        os.path.join(self.tmpdir, 'new'), 
+                                        *args, binary=binary, chunksize=999)
+            self.assertEqual(nsamples, 10000)
+            self.assertEqual(MTfh.read_ts_header(outfile)['unit'], 
+                             'microvoltpermeter')
+            if binary is True:
+                ts_tuple = MTfh.read_ts_file(outfile)
+                self.assertEqual(ts_tuple[4], 10000)
+                self.assertTrue(np.allclose(ts_tuple[-1], old[:, 1], 
+                                            rtol=1e-6))
+            else:
+                self.assertTrue(np.allclose(np.loadtxt(outfile), old))
+
+
+class TestCoherence(unittest.TestCase):
+
+    def test_streaming_coherence(self):
+        s = np.random.normal(0, 1, 2**15)
+        x = np.column_stack((s + 0.1*np.random.normal(0, 1, s.size),
+                             s + 0.1*np.random.normal(0, 1, s.size),
+                             np.random.normal(0, 1, s.size)))
+        starts, coh, est = MTcoh.coherence(x, 256., nfft=128)
+        self.assertEqual(coh.shape, (len(starts), len(est.bands), 3))
+        self.assertEqual(est.pairs, [(0, 1), (0, 2), (1, 2)])
+        self.assertTrue(np.all(coh[:, :, 0] > 0.9))
+        self.assertTrue(np.mean(coh[:, :, 1:]) < 0.2)
+        mask = MTcoh.coherence_mask(coh, 0.9, pairs=[0])
+        self.assertTrue(np.all(mask))
+        #result must not depend on the chunk size
+        starts2, coh2, est2 = MTcoh.coherence(x, 256., nfft=128, 
+                                              chunksize=1001)
+        self.assertTrue(np.allclose(starts2, starts))
+        self.assertTrue(np.allclose(coh2, coh))
+
+
+class TestDecimation(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stages(self):
+        self.assertEqual(MTdc.get_decimation_stages(1000), [8, 5, 5, 5])
+        self.assertEqual(MTdc.get_decimation_stages(1), [])
+        self.assertRaises(MTdc.MTex.MTpyError_inputarguments, 
+                          MTdc.get_decimation_stages, 2.5)
+
+    def test_streaming_decimation(self):
+        #slow sine must pass the anti-alias filters unchanged
+        x = np.sin(2*np.pi*0.0002*np.arange(20001)) + 2.
+        y = MTdc.decimate(x, 40)
+        self.assertEqual(len(y), 501)
+        self.assertTrue(np.allclose(y[20:-20], x[::40][20:-20], atol=1e-3))
+        #result must not depend on the chunk size
+        self.assertTrue(np.allclose(MTdc.decimate(x, 40, chunksize=333), y))
+        #chunks shorter than the stage factors, also of ragged lengths
+        self.assertTrue(np.allclose(MTdc.decimate(x, 40, chunksize=3), y))
+        decimator = MTdc.Decimator(40)
+        lo_chunks, idx = [], 0
+        for ii in range(len(x)):
+            chunk = x[idx:idx + [1, 7, 2, 13, 0][ii % 5]]
+            lo_chunks.append(decimator.process(chunk))
+            idx += len(chunk)
+            if idx == len(x):
+                break
+        lo_chunks.append(decimator.flush())
+        self.assertTrue(np.allclose(np.concatenate(lo_chunks), y))
+
+        fn = os.path.join(self.tmpdir, 'BP02.ex')
+        MTfh.write_ts_binary_file_from_tuple(fn, ('BP02', 'ex', 100., 0., 
+                            len(x), 'mV', -34.9, 138.6, 24., x))
+        nsamples = MTdc.decimate_file(fn, fn + '.dec', 40, chunksize=999)
+        ts_tuple = MTfh.read_ts_file(fn + '.dec')
+        self.assertEqual(nsamples, 501)
+        self.assertEqual(ts_tuple[2], 2.5)
+        self.assertEqual(ts_tuple[4], 501)
+        self.assertTrue(np.allclose(ts_tuple[-1], y, rtol=1e-6))
+
+
+class TestQuality(unittest.TestCase):
+
+    def test_streaming_metrics(self):
+        df = 64.
+        x = np.random.normal(0, 1, 6*3840 + 100)
+        x[3840 + 10] = 100.
+        x[2*3840:2*3840 + 500] = 0.
+        x[3*3840:4*3840] = np.clip(x[3*3840:4*3840], -1., 1.)
+        x[4*3840:5*3840] += 10*np.sin(2*np.pi*20*np.arange(3840)/df)
+
+        qm = MTq.QualityMonitor(df, powerline=20., station='MT01', 
+                                channel='ex')
+        table = np.concatenate([qm.process(x[i:i + 1000]) 
+                                for i in range(0, len(x), 1000)] + 
+                               [qm.flush()])
+        self.assertEqual(len(table), 7)
+        self.assertEqual(list(table['n_samples']), [3840]*6 + [100])
+        self.assertTrue(np.allclose(table['t_start'], 60*np.arange(7)))
+        self.assertEqual(table['n_spikes'][1], 1)
+        self.assertEqual(list(table['dropout']), [False, False, True] + 
+                                                 [False]*4)
+        self.assertTrue(table['n_clipped'][3] > 100)
+        self.assertEqual(table['n_clipped'][0], 0)
+        self.assertEqual(np.argmax(table['powerline_ratio'][:6]), 4)
+        #result must not depend on the chunk size
+        qm = MTq.QualityMonitor(df, powerline=20.)
+        table2 = np.concatenate((qm.process(x), qm.flush()))
+        self.assertTrue(np.allclose(table2['rms'], table['rms']))
+
+    def test_low_sampling_rate(self):
+        #quantised 1 Hz data repeat values for a few samples
+        x = np.repeat(np.arange(60.), 3)
+        x[90:115] = 0.
+        qm = MTq.QualityMonitor(1.)
+        table = np.concatenate((qm.process(x), qm.flush()))
+        self.assertEqual(list(table['dropout']), [False, True, False])
+
+
+class TestSampleBuffer(unittest.TestCase):
+
+    def test_allocations(self):
+        MTsb.SampleBuffer.nallocations = 0
+        buf = MTsb.SampleBuffer(np.arange(10.), dtype=np.float32)
+        for i in range(10000):
+            buf.append(np.array([i], dtype=np.float32))
+        self.assertEqual(len(buf), 10010)
+        self.assertEqual(buf.data.dtype, np.float32)
+        #storage grows by doubling
+        self.assertTrue(MTsb.SampleBuffer.nallocations <= 12)
+
+        #windows and copies share the samples
+        MTsb.SampleBuffer.nallocations = 0
+        window = buf.window(100, 200)
+        duplicate = buf.copy()
+        self.assertEqual(MTsb.SampleBuffer.nallocations, 0)
+        self.assertTrue(np.all(window.data == buf.data[100:200]))
+        self.assertFalse(window.data.flags.writeable)
+
+        #copy on write
+        window.make_writable()[:] = -1.
+        self.assertEqual(MTsb.SampleBuffer.nallocations, 1)
+        self.assertEqual(buf.data[100], 90.)
+
+        #in place growth to both sides, once no longer shared
+        del duplicate
+        buf.narrow(50, 9000)
+        buf.extend(10, 10)
+        self.assertEqual(len(buf), 8970)
+        self.assertEqual(buf.data[10], 40.)
+        self.assertEqual(MTsb.SampleBuffer.nallocations, 1)
+
+
+@unittest.skipIf(MTtr is None, 'mtpy.processing.trace cannot be imported')
+class TestBufferedTrace(unittest.TestCase):
+
+    def test_copy_on_write(self):
+        tr = MTtr.Trace('', 'BP02', '', 'ex', tmin=0., deltat=0.1, 
+                        ydata=np.ones(1000))
+        tr.set_buffered()
+        window = tr.chop(10., 20., inplace=False)
+        duplicate = tr.copy()
+
+        #in place modifications only change the modified trace
+        tr.taper(MTtr.GaussTaper(1.))
+        window.add(duplicate)
+        duplicate.extend(-1., 100., fillmethod='repeat')
+        self.assertTrue(tr.ydata[500] < 1.)
+        self.assertTrue(np.all(window.ydata == 2.))
+        self.assertTrue(np.all(duplicate.ydata == 1.))
+        self.assertTrue(np.all(tr.chop(10., 20., inplace=False).ydata < 1.))
+
+
+@unittest.skipIf(MTtr is None, 'mtpy.processing.trace cannot be imported')
+class TestDegapper(unittest.TestCase):
+
+    def _degap(self, pieces, **kwargs):
+        traces = [MTtr.Trace('', 'BP02', '', 'ex', tmin=tmin, deltat=1., 
+                             ydata=np.array(ydata, dtype=np.float)) 
+                  for tmin, ydata in pieces]
+
+        return [list(tr.ydata) for tr in MTtr.degapper(traces, **kwargs)]
+
+    def test_gaps(self):
+        pieces = [(0., [1., 2., 3.]), (5., [7., 8.])]
+        ydata = self._degap(pieces)
+        self.assertEqual(len(ydata), 1)
+        self.assertTrue(np.allclose(ydata[0], [1., 2., 3., 13./3, 17./3, 
+                                               7., 8.]))
+        self.assertEqual(self._degap(pieces, fillmethod='zeros'), 
+                         [[1., 2., 3., 0., 0., 7., 8.]])
+        self.assertEqual(self._degap(pieces, maxgap=2), 
+                         [[1., 2., 3.], [7., 8.]])
+        self.assertEqual(self._degap([(0., [1., 2., 3.]), (3., [7., 8.])]), 
+                         [[1., 2., 3., 7., 8.]])
+
+    def test_overlaps(self):
+        pieces = [(0., [1., 2., 3., 4.]), (2., [10., 20., 30.])]
+        self.assertEqual(self._degap(pieces), [[1., 2., 10., 20., 30.]])
+        self.assertEqual(self._degap(pieces, deoverlap='use_first'), 
+                         [[1., 2., 3., 4., 30.]])
+        ydata = self._degap(pieces, deoverlap='crossfade_cos')
+        self.assertTrue(np.allclose(ydata, [[1., 2., 4.75, 16., 30.]]))
+        self.assertEqual(self._degap(pieces, maxlap=2), 
+                         [[1., 2., 10., 20., 30.]])
+        self.assertEqual(self._degap(pieces, maxlap=1), 
+                         [[1., 2., 3., 4.], [10., 20., 30.]])
+        #a second trace inside the first one vanishes
+        self.assertEqual(self._degap([(0., [1., 2., 3., 4.]), (1., [5.])]), 
+                         [[1., 2., 3., 4.]])
+
+
+@unittest.skipIf(MTtr is None, 'mtpy.processing.trace cannot be imported')
+class TestBatchCorrelation(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        #traces in order of increasing length, with two of equal length
+        self.traces = [MTtr.Trace('', 'ST{0}'.format(ii), '', 'ex', 
+                                  tmin=0., deltat=.5, 
+                                  ydata=random.normal(0, 1, n))
+                       for ii, n in enumerate([50, 50, 73, 120])]
+        self.complex_traces = [MTtr.Trace('', 'ST{0}'.format(ii), '', 'ex', 
+                                          tmin=0., deltat=.5, 
+                                          ydata=random.normal(0, 1, n)+
+                                                1j*random.normal(0, 1, n))
+                               for ii, n in enumerate([50, 73])]
+
+    def assertSameTrace(self, tr1, tr2):
+        self.assertEqual(tr1.ydata.size, tr2.ydata.size)
+        self.assertTrue(np.allclose(tr1.ydata, tr2.ydata))
+        self.assertAlmostEqual(tr1.tmin, tr2.tmin)
+
+    def test_correlate_many(self):
+        pairs = [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)]
+        for mode, normalization in [('valid', None), ('valid', 'normal'), 
+                                    ('valid', 'gliding'), ('full', None), 
+                                    ('full', 'normal'), ('same', None), 
+                                    ('same', 'normal')]:
+            correlations = MTtr.correlate_many(self.traces, mode=mode, 
+                                               normalization=normalization)
+            self.assertEqual(len(correlations), len(pairs))
+            for (ia, ib), correlation in zip(pairs, correlations):
+                self.assertSameTrace(correlation, 
+                    MTtr.correlate(self.traces[ia], self.traces[ib], 
+                                   mode=mode, normalization=normalization, 
+                                   use_fft=True))
+
+        #complex data as in the time domain
+        for mode in ['valid', 'full']:
+            self.assertSameTrace(
+                MTtr.correlate_many(self.complex_traces, mode=mode)[0], 
+                MTtr.correlate(self.complex_traces[0], 
+                               self.complex_traces[1], mode=mode))
+
+    def test_deconvolve_many(self):
+        pairs = [(0, 1), (2, 3), (3, 0)]
+        for pad_to_pow2 in [True, False]:
+            lo_deconvolved = MTtr.deconvolve_many(self.traces, pairs, 0.01, 
+                                                  pad_to_pow2=pad_to_pow2)
+            for (ia, ib), deconvolved in zip(pairs, lo_deconvolved):
+                self.assertSameTrace(deconvolved, 
+                    MTtr.deconvolve(self.traces[ia], self.traces[ib], 0.01,
+                                    pad_to_pow2=pad_to_pow2))
+
+    def test_fft_size(self):
+        self.assertEqual([MTtr.fft_size(n) for n in [1, 7, 11, 97, 121]], 
+                         [1, 8, 12, 100, 125])
+        self.assertEqual(MTtr.fft_size(97, pow2=True), 128)
+
+
+@unittest.skipIf(MTpile is None, 'mtpy.processing.pile cannot be imported')
+class TestPileDataBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        #6 files of 100 samples (800 bytes) each, read by a replaced io.load
+        self.data = dict(('/data/BP02_{0}.ex'.format(ii), 
+                          np.arange(100.)+100*ii) for ii in range(6))
+        self._io_load = MTpile.io.load
+        MTpile.io.load = self._load
+
+    def tearDown(self):
+        MTpile.io.load = self._io_load
+        shutil.rmtree(self.tmpdir)
+
+    def _load(self, abspath, format='mseed', getdata=True, 
+              substitutions=None):
+        data = self.data[abspath]
+        return [MTtr.Trace('', 'BP02', '', 'ex', tmin=data[0], deltat=1., 
+                           ydata=data.copy(), mtime=0.)]
+
+    def _files(self):
+        return [MTpile.TracesFile(None, abspath, 'mseed', 
+                    traces=[MTtr.Trace('', 'BP02', '', 'ex', tmin=data[0], 
+                                       tmax=data[-1], deltat=1., mtime=0.)])
+                for abspath, data in sorted(self.data.items())]
+
+    def _chop_all(self, pile, **kwargs):
+        lo_windows = [[tr.ydata for tr in traces if len(tr.ydata)] 
+                      for traces in pile.chopper(tinc=100., **kwargs)]
+        self.assertEqual(len(lo_windows), 6)
+        #without the last sample, as include_last is False
+        self.assertTrue(np.all(np.concatenate(sum(lo_windows, [])) == 
+                               np.arange(599.)))
+
+    def test_chopper(self):
+        for data_budget in [1, 800, 2000]:
+            for prefetch in [0, 1, 2]:
+                pile = MTpile.Pile(data_budget=data_budget)
+                pile.add_files(self._files())
+                self._chop_all(pile, prefetch=prefetch)
+                stats = pile.get_data_stats()
+                self.assertTrue(stats['nbytes'] <= data_budget)
+
+    def test_chopper_index(self):
+        index = MTpile.SQLiteTracesFileCache(self.tmpdir)
+        for tfile in self._files():
+            index.put(tfile.abspath, tfile)
+
+        pile = MTpile.Pile(data_budget=1)
+        pile.set_index(index)
+        #the prefetch thread uses the index too
+        self._chop_all(pile, prefetch=1)
+        self.assertEqual(pile.get_data_stats()['nbytes'], 0)
+
+
+@unittest.skipIf(MTpile is None, 'mtpy.processing.pile cannot be imported')
+class TestPileLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filenames = []
+        for ii in range(20):
+            fn = os.path.join(self.tmpdir, 'BP{0:02}.ex'.format(ii))
+            if ii == 7:
+                fn = os.path.join(self.tmpdir, 'broken.ex')
+            open(fn, 'w').close()
+            self.filenames.append(fn)
+
+        self._io_load = MTpile.io.load
+        MTpile.io.load = self._load
+        self.warnings = []
+        self._handler = logging.Handler()
+        self._handler.emit = lambda record: self.warnings.append(
+                                                        record.getMessage())
+        logging.getLogger('pyrocko.pile').addHandler(self._handler)
+
+    def tearDown(self):
+        logging.getLogger('pyrocko.pile').removeHandler(self._handler)
+        MTpile.io.load = self._io_load
+        shutil.rmtree(self.tmpdir)
+
+    def _load(self, abspath, format='mseed', getdata=True, 
+              substitutions=None):
+        if 'broken' in abspath:
+            raise MTpile.io.FileLoadError('cannot read ' + abspath)
+        return [MTtr.Trace('', os.path.basename(abspath)[:4], '', 'ex', 
+                           tmin=0., tmax=99., deltat=1., mtime=0.)]
+
+    def _scan(self, **kwargs):
+        progress = []
+        lo_tfiles = list(MTpile.loader(self.filenames, 'mseed', None, None, 
+                                       show_progress=False, 
+                                       update_progress=lambda *args: 
+                                                    progress.append(args), 
+                                       **kwargs))
+        self.assertTrue(all(type(n) is int for label, i, n in progress))
+
+        return [tfile.abspath for tfile in lo_tfiles]
+
+    def test_pool(self):
+        sequential = self._scan()
+        self.assertEqual(len(sequential), 19)
+        self.assertFalse(os.path.join(self.tmpdir, 'broken.ex') in sequential)
+
+        for kwargs in [dict(n_threads=4), dict(n_processes=2)]:
+            self.warnings = []
+            self.assertEqual(self._scan(**kwargs), sequential)
+            self.assertTrue(any('broken.ex' in message 
+                                for message in self.warnings))
+
+
+class TestTimeFrequency(unittest.TestCase):
+
+    def test_stft_chunks(self):
+        fx = np.random.normal(0, 1, 5000)+np.sin(np.arange(5000)*.3)
+        nh, tstep, nfbins = 100, 33, 256
+
+        tfarray, tlst, flst = MTtf.stft(fx, nh=nh, tstep=tstep, ng=5, 
+                                        nfbins=nfbins, chunk_size=7)
+        self.assertEqual(tfarray.shape, (nfbins/2, len(tlst)))
+        self.assertTrue(np.allclose(tfarray, MTtf.stft(fx, nh=nh, 
+                                        tstep=tstep, ng=5, nfbins=nfbins)[0]))
+
+        #compare one window with the explicit computation
+        fa = MTtf.sps.hilbert(MTtf.dctrend(fx))
+        h = MTtf.normalize_L2(np.hanning(nh))
+        g = MTtf.normalize_L2(np.hanning(5))
+        FX = np.fft.fft(fa[tlst[10]:tlst[10]+nh]*h, nfbins)[:nfbins/2]
+        FX = np.convolve(np.append(FX, np.zeros(4)), g, 'valid')
+        self.assertTrue(np.allclose(tfarray[:, 10], FX[::-1]))
+
+    def test_wvd_blocks(self):
+        fx = np.random.normal(0, 1, 3000)+np.sin(np.arange(3000)*.3)
+
+        #compare one time instance with the explicit computation
+        tfarray, tlst, flst = MTtf.wvd(fx, nh=63, nfbins=256, chunk_size=7)
+        fa = MTtf.sps.hilbert(MTtf.dctrend(fx))
+        nn = tlst[20]
+        Rnn = 4*np.conjugate(fa[nn-np.arange(-31, 32)])*\
+              fa[nn+np.arange(-31, 32)]
+        Rnn = np.append(Rnn, np.zeros(256-63))[::-1]
+        self.assertTrue(np.allclose(tfarray[:, 20], np.fft.fft(Rnn)/63))
+
+        #results must not depend on chunks and threads
+        for function, kwargs in [(MTtf.spwvd, dict(nh=63, ng=15)),
+                                 (MTtf.robust_wvd, dict(nh=31, ng=7)),
+                                 (MTtf.reassigned_stft, {})]:
+            tf1 = function(fx, nfbins=128, tstep=32, **kwargs)
+            tf2 = function(fx, nfbins=128, tstep=32, chunk_size=9, 
+                           n_threads=3, **kwargs)
+            self.assertTrue(np.allclose(tf1[0], tf2[0]))
+
+    def test_stfbss_processes(self):
+        t = np.arange(2048)
+        sources = np.array([np.sin(2*np.pi*.05*t), 
+                            np.sign(np.sin(2*np.pi*.011*t)),
+                            np.sin(2*np.pi*(.1+1E-4*t)*t)])
+        random = np.random.RandomState(3)
+        X = np.dot(random.normal(0, 1, (4, 3)), sources)+\
+            .01*random.normal(0, 1, (4, 2048))
+        kwargs = dict(nsources=3, ng=15, nh=63, tstep=32, nfbins=128, 
+                      tftol=1E-3)
+
+        progress = []
+        Se1, Ae1 = MTtf.stfbss(X.copy(), **kwargs)
+        Se2, Ae2, timings = MTtf.stfbss(X.copy(), n_processes=2, 
+                                        update_progress=lambda *args: 
+                                                        progress.append(args), 
+                                        return_timings=True, **kwargs)
+        self.assertTrue(np.allclose(Se1, Se2))
+        self.assertTrue(np.allclose(Ae1, Ae2))
+        self.assertEqual(progress[5], ('Computing STFDs', 6, 6))
+        self.assertEqual(sorted(timings.keys()), 
+                         ['criteria', 'joint diagonalization', 'stfd'])
+        #progress of the sweeps is reported against max_sweeps
+        self.assertTrue(all(n == 100 for label, i, n in progress[6:]))
+
+
+class TestInstrumentResponse(unittest.TestCase):
+
+    def test_block_deconvolution(self):
+        samplingrate = 100.
+        freq = np.logspace(-1, np.log10(50), 100)
+        response = (1j*freq)/(1+1j*freq)
+        responsedata = np.column_stack([freq, response.real, response.imag])
+
+        #apply the instrument response to band limited noise
+        nfft = 2**17
+        spectrum = np.fft.rfft(np.random.normal(0, 1, 100000), nfft)
+        rfreq = np.fft.fftfreq(nfft, 1./samplingrate)[:nfft/2+1]
+        spectrum[np.abs(rfreq) < freq[0]] = 0
+        data = np.fft.irfft(spectrum, nfft)[:100000]
+        instrument = np.interp(np.abs(rfreq), freq, response.real)+\
+                     1j*np.interp(np.abs(rfreq), freq, response.imag)
+        recorded = np.fft.irfft(spectrum*instrument, nfft)[:100000]
+
+        deconvolver = MTin.BlockDeconvolver(samplingrate, responsedata, 
+                                            kernel_len=2**12, block_len=2**14)
+        corrected = np.concatenate([deconvolver.process(recorded[ii:ii+7777])
+                                    for ii in range(0, 100000, 7777)]+
+                                   [deconvolver.flush()])
+        self.assertEqual(len(corrected), 100000)
+        error = (corrected-np.mean(corrected))-(data-np.mean(data))
+        self.assertTrue(np.std(error[5000:-5000]) < 0.05*np.std(data))
+
+    def test_default_kernel_length(self):
+        #response tables may start at 0 Hz
+        responsedata = np.array([[0., 0., 0.], [0.1, 0.1, 0.], 
+                                 [50., 1., 0.]])
+        deconvolver = MTin.BlockDeconvolver(100., responsedata)
+        self.assertEqual(deconvolver.kernel_len, 2**12)
+
+        #the response of zero is not inverted
+        data = np.random.normal(0, 1, 4096)
+        for correct in [MTin.correct_for_instrument_response, 
+                        MTin.block_correct_for_instrument_response]:
+            corrected = correct(data, 100., responsedata)
+            self.assertEqual(len(corrected), 4096)
+            self.assertTrue(np.all(np.isfinite(corrected)))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import tempfile
+import shutil
+import os
+import numpy as np
+
+try:
+    import mtpy.usgs.zen as MTzen
+except ImportError:
+    #zen needs win32api
+    MTzen = None
+
+
+def write_z3d_file(fn, channel, ch_number, df=256, n_seconds=20,
+                   station='100'):
+    """
+    write a small synthetic .Z3D file: header, schedule and one metadata
+    record of 512 bytes each, followed by gps stamps and df samples per
+    second.
+    """
+
+    header = '\n'.join(['GPS Brd339 Logfile', 'Version = 3321',
+                        'ChannelSerial = 0xD474777C', 'Box number = 26',
+                        'A/D Rate = {0}'.format(df), 'A/D Gain = 1',
+                        'GpsWeek = 1740', 'Lat = 0.7', 'Long = -2.0',
+                        'NumSats = 9'])+'\n'
+    schedule = 'Schedule.Date = 2015-05-22\nSchedule.Time = 08:00:00\n'
+    metadata = '\n\nGPS Brd339 Metadata Record\n'+\
+               'CH.CMP={0}|CH.NUMBER={1}|CH.LENGTH=100|RX.XYZ0={2}:0:0|'\
+               '\n'.format(channel, ch_number, station)
+
+    gps_bytes = 16
+    data = np.zeros((n_seconds, gps_bytes+df), dtype=np.int32)
+    data[:, 0] = 2147483647
+    data[:, 1] = -2147483648
+    data[:, 2] = (432000+np.arange(n_seconds))*1024
+    data[:, gps_bytes:] = np.arange(n_seconds*df).reshape(n_seconds, df)
+
+    with open(fn, 'wb') as fid:
+        for block in [header, schedule, metadata]:
+            fid.write(block+'\x00'*(512-len(block)))
+        data.tofile(fid)
+
+
+@unittest.skipIf(MTzen is None, 'mtpy.usgs.zen cannot be imported')
+class TestBatchConvertZ3D(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for ii, channel in enumerate(['ex', 'ey', 'hx']):
+            write_z3d_file(os.path.join(self.tmpdir,
+                           'mb100_20150522_080000_256_{0}.Z3D'.format(
+                                                        channel.upper())),
+                           channel, ii+1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_merge(self):
+        summary = MTzen.batch_convert_z3d([self.tmpdir], n_workers=1,
+                                          merge=True, verbose=False)
+        merged = summary[np.array([';' in fn for fn in summary['fn']])]
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged['status'][0], 'merged')
+        self.assertTrue(os.path.isfile(merged['out_fn'][0]))
+        #the first 3 stamps are skipped
+        self.assertEqual(merged['npts'][0], 17*256)
+        merge_path = os.path.join(self.tmpdir, 'Merged')
+        self.assertTrue(os.path.isfile(os.path.join(merge_path,
+                                            'z3d_conversion_summary.log')))
+
+        #the merge is in the manifest and not repeated
+        summary = MTzen.batch_convert_z3d([self.tmpdir], n_workers=1,
+                                          merge=True, verbose=False)
+        self.assertTrue(np.all(summary['status'] == 'skipped'))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
 import unittest
 from mtpy.utils import *
 import tempfile
+import shutil
+import os
 import numpy as np
+import mtpy.utils.filehandling as MTfh
 
 class TestFilehandling(unittest.TestCase):
 
@@ -74,5 +77,57 @@ class TestFilehandling(unittest.TestCase):
 
 
 
+class TestBinaryTSFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = np.random.normal(0, 1., 1000)
+        self.ts_tuple = ('mt01', 'ex', 256., 1368616803., 1000, 'mV', 
+                         34.377, -114.592, 0., self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_binary_roundtrip(self):
+        fn = MTfh.write_ts_binary_file_from_tuple(
+                        os.path.join(self.tmpdir, 'mt01.EX.bin'), self.ts_tuple)
+
+        self.assertTrue(MTfh.is_binary_ts_file(fn))
+        self.assertEqual(MTfh.read_ts_header(fn)['nsamples'], 1000)
+
+        for mmap in [False, True]:
+            ts_tuple = MTfh.read_ts_file(fn, mmap=mmap)
+            self.assertEqual(ts_tuple[:-1], self.ts_tuple[:-1])
+            self.assertTrue(np.allclose(ts_tuple[-1], self.data, rtol=1e-6))
+
+    def test_conversion(self):
+        fn = MTfh.write_ts_file_from_tuple(
+                        os.path.join(self.tmpdir, 'mt01.EX'), self.ts_tuple)
+        bin_fn = MTfh.convert_ts_ascii2binary(fn)
+        asc_fn = MTfh.convert_ts_binary2ascii(bin_fn)
+
+        self.assertFalse(MTfh.is_binary_ts_file(asc_fn))
+        self.assertTrue(MTfh.validate_ts_file(bin_fn))
+        self.assertTrue(np.allclose(MTfh.read_ts_file(asc_fn)[-1], self.data,
+                                    rtol=1e-6))
+
+    def test_ascii_range_and_cache(self):
+        fn = MTfh.write_ts_file_from_tuple(
+                        os.path.join(self.tmpdir, 'mt01.EY'), self.ts_tuple)
+        reference = np.loadtxt(fn)
+
+        ts_tuple = MTfh.read_ts_file(fn, sample_range=(256, 512), 
+                                     dtype=np.float32)
+        self.assertEqual(ts_tuple[-1].dtype, np.float32)
+        self.assertEqual(ts_tuple[4], 256)
+        self.assertAlmostEqual(ts_tuple[3], self.ts_tuple[3] + 1.)
+        self.assertTrue(np.allclose(ts_tuple[-1], reference[256:512]))
+
+        for i in range(2):
+            ts_tuple = MTfh.read_ts_file(fn, use_cache=True)
+            self.assertTrue(np.array_equal(ts_tuple[-1], reference))
+        self.assertTrue(os.path.isfile(MTfh.get_ts_cache_filename(fn)))
+
+
 if __name__ == '__main__':
     unittest.main()
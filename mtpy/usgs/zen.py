@@ -21,6 +21,7 @@ import scipy.signal as sps
 import time
 import datetime
 import os
+import multiprocessing
 import struct
 import string
 import win32api
@@ -562,8 +563,13 @@ class Zen3D(object):
     gps_stamps               np.ndarray of gps stamps         None
     header                   Z3D_Header object                Z3D_Header                
     metadata                 Z3D_Metadata                     Z3D_Metadata 
+    read_timing              dictionary of seconds taken by   {}
+                             each stage of read_z3d
     schedule                 Z3D_Schedule_metadata            Z3D_Schedule
     time_series              np.ndarra(len_data)              None
+    timing_hook              function called as               None
+                             timing_hook(fn, stage, seconds)
+                             for each stage of read_z3d
     units                    units in which the data is in    counts           
     zen_schedule             time when zen was set to         None
                              run
@@ -592,15 +598,18 @@ class Zen3D(object):
         
     get_gps_time                 converts the gps counts to relative epoch 
                                  seconds according to gps week.      
+    get_UTC_seconds              converts gps seconds into UTC epoch seconds
     get_UTC_date_time            converts gps seconds into the actual date and
                                  time in UTC.  Note this is different than GPS
                                  time which is how the zen is scheduled, so 
                                  the time will be off by the current amount of
                                  leap seconds.
+    iter_blocks                  iterate over gps validated blocks of the 
+                                 time series without reading the whole file
     plot_timeseries              make a generic plot of the time series
     plot_spectra                 plot a the spectra in loglog scales.
     plot_spectrogram             plot the spectragram of the data.
-    read_z3d                      read 3D file making sure all the time stamps
+    read_z3d                     read 3D file making sure all the time stamps
                                  are correctly spaced.  Returned time series 
                                  starts at  the first stamp which has the 
                                  correct amount of data points between it and 
@@ -615,6 +624,7 @@ class Zen3D(object):
     validate_time_blocks         make sure that the size of each time block
                                  between stamps is equal to the sampling rate
     write_ascii_mt_file          write an mtpy ascii file of the data
+    write_binary_mt_file         write an mtpy binary file of the data
     ============================ ==============================================
       
       
@@ -678,6 +688,9 @@ class Zen3D(object):
         
         self.time_series = None
         
+        self.timing_hook = kwargs.pop('timing_hook', None)
+        self.read_timing = {}
+        
     #====================================== 
     def read_header(self, fn=None, fid=None):
         """
@@ -802,8 +815,10 @@ class Zen3D(object):
         """
         read in z3d file and populate attributes accordingly
         
-        read in the entire file as if everything but header and metadata are
-        np.int32, then extract the gps stamps and convert accordingly
+        memory-map everything but header and metadata as np.int32, then 
+        locate all gps stamps, decode them with a structured view of 
+        self._gps_dtype and remove them from the data with a boolean mask. 
+        Real zero samples are kept in the time series.
         
         Checks to make sure gps time stamps are 1 second apart and incrementing
         as well as checking the number of data points between stamps is the
@@ -811,75 +826,56 @@ class Zen3D(object):
         
         Converts gps_stamps['time'] to seconds relative to header.gps_week 
         
-        We skip the first two gps stamps because there is something wrong with 
-        the data there due to some type of buffering.  
+        We skip the first three gps stamps because there is something wrong 
+        with the data there due to some type of buffering.  
         
         Therefore the first GPS time is when the time series starts, so you
         will notice that gps_stamps[0]['block_len'] = 0, this is because there
         is nothing previous to this time stamp and so the 'block_len' measures
         backwards from the corresponding time index.
         
+        The time taken by each stage of reading is stored in 
+        self.read_timing and passed to self.timing_hook if it is set.
         
         """
         
         print '------- Reading {0} ---------'.format(self.fn)
         st = time.time()
         
-        #get the file size to get an estimate of how many data points there are
-        file_size = os.path.getsize(self.fn)
-        
         # using the with statement works in Python versions 2.7 or higher
         # the added benefit of the with statement is that it will close the
         # file object upon reading completion.
         with open(self.fn, 'rb') as file_id:
-        
             self.read_header(fid=file_id)
             self.read_schedule(fid=file_id)
             self.read_metadata(fid=file_id)
-            
-            # move the read value to where the end of the metadata is
-            file_id.seek(self.metadata.m_tell)
-            
-            # initalize a data array filled with zeros, everything goes into
-            # this array then we parse later
-            data = np.zeros((file_size-512*(2+self.metadata.count))/4, 
-                             dtype=np.int32)
-            # go over a while loop until the data cound exceed the file size
-            data_count = 0
-            while data_count+self.metadata.m_tell/4 < data.size:
-                test_str = np.fromstring(file_id.read(self._block_len), 
-                                         dtype=np.int32)
-                data[data_count:data_count+len(test_str)] = test_str
-                data_count += test_str.size
-
-        # find the gps stamps
-        gps_stamp_find = np.where(data==self._gps_flag_0)[0]
+        self._report_timing('read_metadata', time.time()-st)
         
-        # skip the first two stamps and trim data
+        # map the data section of the file, nothing is read yet
+        et = time.time()
+        data = self._memmap_data()
+        
+        # find the gps stamps, skip the first stamps and trim data
+        gps_stamp_find = self._locate_gps_stamps(data)
+        if gps_stamp_find.size < 4:
+            raise ZenGPSError('Found only {0} GPS stamps in {1}'.format(
+                              gps_stamp_find.size, self.fn))
         data = data[gps_stamp_find[3]:]
-        gps_stamp_find = np.where(data==self._gps_flag_0)[0]
-        
-        self.gps_stamps = np.zeros(len(gps_stamp_find), dtype=self._gps_dtype)
-        
-        for ii, gps_find in enumerate(gps_stamp_find):
-            if data[gps_find+1] == self._gps_flag_1:
-                gps_str = struct.pack('<'+'i'*self._gps_bytes,
-                                      *data[gps_find:gps_find+self._gps_bytes])
-                self.gps_stamps[ii] = np.fromstring(gps_str, 
-                                                   dtype=self._gps_dtype)
-                if ii > 0:
-                    self.gps_stamps[ii]['block_len'] = gps_find-\
-                                           gps_stamp_find[ii-1]-self._gps_bytes 
-                elif ii == 0:
-                    self.gps_stamps[ii]['block_len'] = 0
-                data[gps_find:gps_find+self._gps_bytes] = 0
+        gps_stamp_find = gps_stamp_find[3:]-gps_stamp_find[3]
+        self._report_timing('locate_gps_stamps', time.time()-et)
+
+        et = time.time()
+        self.gps_stamps = self._decode_gps_stamps(data, gps_stamp_find)
+        self._report_timing('decode_gps_stamps', time.time()-et)
 
-        # trim the data after taking out the gps stamps
-        self.time_series = data[np.nonzero(data)]
+        # remove the gps stamps from the data
+        et = time.time()
+        self.time_series = self._remove_gps_stamps(data, gps_stamp_find)
+        del data
+        self._report_timing('extract_time_series', time.time()-et)
         
         # time it
-        et = time.time()
-        print '--> Reading data took: {0:.3f} seconds'.format(et-st)
+        self._report_timing('read_z3d', time.time()-st)
         
         self.validate_time_blocks()
         self.convert_gps_time()
@@ -887,6 +883,224 @@ class Zen3D(object):
         
         print '    found {0} GPS time stamps'.format(self.gps_stamps.shape[0])
         print '    found {0} data points'.format(self.time_series.size)
+        
+    #=======================================
+    def _memmap_data(self):
+        """
+        memory map the data section of the Z3D file (everything after the 
+        metadata) as np.int32.  The metadata must be read first to know 
+        where the data starts.
+        """
+        
+        file_size = os.path.getsize(self.fn)
+        num_ints = (file_size-self.metadata.m_tell)/4
+        
+        return np.memmap(self.fn, dtype=np.int32, mode='r', 
+                         offset=self.metadata.m_tell, shape=(num_ints,))
+        
+    #=======================================
+    def _locate_gps_stamps(self, data):
+        """
+        find the indices of all gps stamps in data, a stamp is where 
+        self._gps_flag_0 is followed by self._gps_flag_1 and the full stamp 
+        fits into data.
+        """
+        
+        gps_stamp_find = np.flatnonzero(data == self._gps_flag_0)
+        gps_stamp_find = gps_stamp_find[gps_stamp_find+self._gps_bytes <= 
+                                        data.size]
+        gps_stamp_find = gps_stamp_find[data[gps_stamp_find+1] == 
+                                        self._gps_flag_1]
+        
+        return gps_stamp_find
+        
+    #=======================================
+    def _decode_gps_stamps(self, data, gps_stamp_find):
+        """
+        decode the gps stamps at indices gps_stamp_find of data into an 
+        array of self._gps_dtype.  The block length of the first stamp is 0.
+        """
+        
+        stamp_index = gps_stamp_find[:, np.newaxis]+np.arange(self._gps_bytes)
+        gps_stamps = np.ascontiguousarray(data[stamp_index], dtype=np.int32)
+        gps_stamps = gps_stamps.view(self._gps_dtype).reshape(-1).copy()
+        
+        gps_stamps['block_len'][0] = 0
+        gps_stamps['block_len'][1:] = np.diff(gps_stamp_find)-self._gps_bytes
+        
+        return gps_stamps
+        
+    #=======================================
+    def _remove_gps_stamps(self, data, gps_stamp_find):
+        """
+        return a copy of data with the gps stamps at indices gps_stamp_find 
+        removed.
+        """
+        
+        keep = np.ones(data.size, dtype=np.bool)
+        keep[(gps_stamp_find[:, np.newaxis]+
+              np.arange(self._gps_bytes)).ravel()] = False
+              
+        return np.asarray(data[keep], dtype=np.int32)
+        
+    #=======================================
+    def _report_timing(self, stage, seconds):
+        """
+        store the time a reading stage took and pass it on to 
+        self.timing_hook(fn, stage, seconds) if it is set
+        """
+        
+        self.read_timing[stage] = seconds
+        if self.timing_hook is not None:
+            self.timing_hook(self.fn, stage, seconds)
+
+    #=======================================
+    def _locate_gps_stamps_chunked(self, data, chunk_len=None):
+        """
+        find the indices of all gps stamps in data, scanning chunk_len 
+        integers at a time so that memory use is bounded for large files.
+        """
+        
+        if chunk_len is None:
+            chunk_len = self._block_len*64
+        
+        lo_find = []
+        for start in range(0, data.size, chunk_len):
+            stop = min(start+chunk_len+self._gps_bytes, data.size)
+            gps_stamp_find = self._locate_gps_stamps(data[start:stop])
+            lo_find.append(gps_stamp_find[gps_stamp_find < chunk_len]+start)
+        
+        if len(lo_find) == 0:
+            return np.zeros(0, dtype=np.int)
+            
+        return np.concatenate(lo_find)
+        
+    #=======================================
+    def iter_blocks(self, block_seconds=60, units='counts', skip_stamps=3,
+                    chunk_len=None):
+        """
+        iterate over the time series of the Z3D file in blocks of GPS 
+        validated data without reading the whole file into memory.
+        
+        The data section is memory-mapped and only one block is copied out 
+        at a time.  A second of data is valid if it has exactly df samples 
+        between its gps stamp and the next one and its stamp is 1 second after
+        the previous stamp.  Blocks consist of consecutive valid seconds, an 
+        invalid second ends the current block and is skipped, so a block can 
+        be shorter than block_seconds.
+        
+        Arguments
+        -------------
+            **block_seconds** : int
+                                number of seconds of data in each block
+                                *default* is 60
+                                
+            **units** : [ 'counts' | 'mV' ]
+                        units of the returned samples, counts are np.int32
+                        *default* is 'counts'
+                        
+            **skip_stamps** : int
+                              number of gps stamps to skip at the beginning
+                              of the file, see read_z3d. *default* is 3
+                              
+            **chunk_len** : int
+                            number of integers scanned at once for gps 
+                            stamps.  *default* is 64*_block_len
+                            
+        Yields
+        -------------
+            **start_time** : float
+                             UTC time of the first sample of the block in 
+                             epoch seconds
+                             
+            **time_series** : np.ndarray
+                              samples of the block
+                              
+        Example
+        ------------
+            >>> import mtpy.usgs.zen as zen
+            >>> fn = r"/home/mt/mt01/mt01_20150522_080000_256_EX.Z3D"
+            >>> z3d_obj = zen.Zen3D(fn)
+            >>> for start_time, ts in z3d_obj.iter_blocks(block_seconds=600):
+            >>> ...     print start_time, ts.std()
+        
+        """
+        
+        with open(self.fn, 'rb') as file_id:
+            self.read_header(fid=file_id)
+            self.read_schedule(fid=file_id)
+            self.read_metadata(fid=file_id)
+            
+        df = int(self.header.ad_rate)
+        second_len = df+self._gps_bytes
+        block_seconds = max(1, int(block_seconds))
+        
+        data, gps_stamp_find, gps_time, good, new_run = \
+                                self._index_gps_seconds(skip_stamps=skip_stamps,
+                                                        chunk_len=chunk_len)
+        if gps_stamp_find.size == 0:
+            return
+        
+        run_start = np.flatnonzero(good & new_run)
+        for r_start in run_start:
+            r_stop = r_start
+            while r_stop < good.size and good[r_stop] and \
+                  (r_stop == r_start or not new_run[r_stop]):
+                r_stop += 1
+                
+            for b_start in range(r_start, r_stop, block_seconds):
+                n_seconds = min(block_seconds, r_stop-b_start)
+                d_start = gps_stamp_find[b_start]
+                block = data[d_start:d_start+n_seconds*second_len]
+                block = block.reshape(n_seconds, second_len)[:, self._gps_bytes:]
+                time_series = np.array(block, dtype=np.int32).ravel()
+                
+                if units == 'mV':
+                    time_series = time_series*self._counts_to_mv_conversion
+                    
+                yield (self.get_UTC_seconds(self.header.gpsweek, 
+                                            gps_time[b_start]),
+                       time_series)
+    
+    
+    #=======================================
+    def _index_gps_seconds(self, skip_stamps=3, chunk_len=None):
+        """
+        memory map the data and index every second of it by its gps stamp,
+        the header and metadata must be read first.
+        
+        Returns
+        -------------
+            **data** : np.memmap of the data section as np.int32
+            
+            **gps_stamp_find** : index of each gps stamp in data
+            
+            **gps_time** : gps time of each stamp in seconds relative to 
+                           the gps week
+                           
+            **good** : True if the second following the stamp has df samples
+            
+            **new_run** : True if a run of consecutive good seconds starts 
+                          at the stamp, which is after a bad second or a jump
+                          in gps time
+        """
+        
+        data = self._memmap_data()
+        gps_stamp_find = self._locate_gps_stamps_chunked(data, 
+                                                  chunk_len=chunk_len)
+        gps_stamp_find = gps_stamp_find[skip_stamps:]
+        
+        # number of samples following each stamp and time of each stamp
+        sample_len = np.append(gps_stamp_find[1:], data.size)-\
+                     gps_stamp_find-self._gps_bytes
+        gps_time = self._convert_gps_seconds(data[gps_stamp_find+2])
+        
+        good = sample_len == int(self.header.ad_rate)
+        new_run = np.ones(good.size, dtype=np.bool)
+        new_run[1:] = np.abs(np.diff(gps_time)-1) > 0.5
+        new_run[1:] |= ~good[:-1]
+        
+        return data, gps_stamp_find, gps_time, good, new_run
     
     #=======================================    
     def read_z3d_slow(self):
@@ -1080,6 +1294,18 @@ class Zen3D(object):
         
         self.gps_stamps['time'][:] = time_conv 
             
+    #==================================================
+    def _convert_gps_seconds(self, gps_int):
+        """
+        convert an array of gps time integers to seconds relative to 
+        the gps week, see convert_gps_time
+        """
+        
+        time_conv = np.asarray(gps_int, dtype=np.float64)/1024.
+        time_ms = (time_conv-np.floor(time_conv))*1.024
+        
+        return np.floor(time_conv)+time_ms
+            
     #==================================================    
     def convert_counts(self):
         """
@@ -1191,6 +1417,32 @@ class Zen3D(object):
                                                  0, 0, 0))
         return date_time
         
+    #==================================================
+    def get_UTC_seconds(self, gps_week, gps_time):
+        """
+        get the UTC time of measurement in epoch seconds, same as 
+        get_UTC_date_time but as a float including fractions of a second.
+        
+        Arguments
+        -------------
+            **gps_week**: int
+                          integer value of gps_week that the data was collected
+            
+            **gps_time**: float
+                          number of seconds from beginning of gps_week
+                              
+        Returns
+        ------------
+            **utc_seconds**: float
+                             seconds since 1970-01-01 00:00:00 UTC
+        
+        """
+        
+        epoch_seconds = time.mktime(self._gps_epoch)-time.timezone
+        
+        return epoch_seconds+(gps_week*self._week_len)+gps_time-\
+                                                        self._leap_seconds
+        
     #==================================================    
     def apply_adaptive_notch_filter(self, notch_dict):
         """
@@ -1204,22 +1456,23 @@ class Zen3D(object):
             **notch_dict** : dictionary
                              dictionary of filter parameters.
                              if an empty dictionary is input the filter looks
-                             for 60 Hz and harmonics to filter out.
+                             for 60 Hz and harmonics to filter out.  
+                             'nperseg' searches the peaks in a Welch 
+                             averaged spectrum.  notch_dict is not changed.
         
         
         """
         
-        try:
-            self.time_series
-        except AttributeError:
-            self.read_3d()
+        if self.time_series is None:
+            self.read_z3d()
         
-        notches = notch_dict.pop('notches', list(np.arange(60, 2048, 60)))
-        notchradius = notch_dict.pop('notchradius', 0.5)
-        freqrad = notch_dict.pop('freqrad', 0.5)
-        rp = notch_dict.pop('rp', 0.1)
+        notches = notch_dict.get('notches', list(np.arange(60, 2048, 60)))
+        notchradius = notch_dict.get('notchradius', 0.5)
+        freqrad = notch_dict.get('freqrad', 0.5)
+        rp = notch_dict.get('rp', 0.1)
+        nperseg = notch_dict.get('nperseg', None)
         kwargs = {'df':self.df, 'notches':notches, 'notchradius':notchradius,
-                  'freqrad':freqrad, 'rp':rp}
+                  'freqrad':freqrad, 'rp':rp, 'nperseg':nperseg}
                   
         self.time_series, self.filt_list = \
                     mtfilt.adaptive_notch_filter(self.time_series, **kwargs) 
@@ -1274,10 +1527,90 @@ class Zen3D(object):
                                                  notch_dict={})
         
         """
+        save_fn, ts_tuple = self._get_mt_file_tuple(save_fn=save_fn,
+                                                    save_station=save_station,
+                                                    ex=ex, ey=ey, 
+                                                    notch_dict=notch_dict)
+        self.fn_mt_ascii = mtfh.write_ts_file_from_tuple(save_fn, ts_tuple,
+                                                         fmt=fmt)
+        
+        print 'Wrote mtpy timeseries file to {0}'.format(self.fn_mt_ascii)
+        
+    #==================================================
+    def write_binary_mt_file(self, save_fn=None, save_station='mb', 
+                             dtype='float32', ex=100., ey=100., 
+                             notch_dict=None):
+        """
+        write an mtpy binary time series data file, which has the same 
+        header as the ascii file followed by little-endian binary data that
+        can be memory-mapped.  See mtpy.utils.filehandling.read_ts_file.
+        
+        Arguments
+        -------------
+            **save_fn** : full path to save file, if None file is saved as:
+                          station_YYYYMMDD_hhmmss_df.component.bin
+                          
+            **save_station** : string
+                               prefix string to add to station number
+            
+            **dtype** : [ 'float32' | 'int32' ]
+                        data type of the file. float32 is in mV and scaled 
+                        by the dipole lengths like write_ascii_mt_file, 
+                        int32 are the raw counts without any scaling.
+                        *default* is 'float32'
+                        
+            **ex**, **ey**, **notch_dict** : see write_ascii_mt_file
+                      
+        Output
+        -------------
+            **fn_mt_binary** : full path to saved file
+            
+        Example
+        ------------
+            >>> import mtpy.usgs.zen as zen
+            >>> fn = r"/home/mt/mt01/mt01_20150522_080000_256_EX.Z3D"
+            >>> z3d_obj = zen.Zen3D(fn)
+            >>> z3d_obj.read_z3d()
+            >>> z3d_obj.write_binary_mt_file(save_station='mt')
+        
+        """
+        
+        if dtype == 'int32':
+            units = 'counts'
+        else:
+            units = 'mV'
+            
+        save_fn, ts_tuple = self._get_mt_file_tuple(save_fn=save_fn,
+                                                    save_station=save_station,
+                                                    ex=ex, ey=ey, 
+                                                    notch_dict=notch_dict,
+                                                    units=units,
+                                                    extension='.bin')
+        self.fn_mt_binary = mtfh.write_ts_binary_file_from_tuple(save_fn, 
+                                                                 ts_tuple, 
+                                                                 dtype=dtype)
+        
+        print 'Wrote mtpy binary timeseries file to {0}'.format(
+                                                            self.fn_mt_binary)
+        
+    #==================================================
+    def _get_mt_file_tuple(self, save_fn=None, save_station='mb', ex=100., 
+                           ey=100., notch_dict=None, units='mV', 
+                           extension=''):
+        """
+        get the file name and the time series tuple (see
+        mtpy.utils.filehandling.write_ts_file_from_tuple) for writing mtpy 
+        time series files.  If units is 'counts' the time series is not 
+        scaled.
+        """
+        
         if self.time_series is None:
             self.read_3d()
             
-        time_series = self.convert_counts()
+        if units == 'counts':
+            time_series = self.time_series.copy()
+        else:
+            time_series = self.convert_counts()
         if save_fn is None:
             svfn_directory = os.path.join(os.path.dirname(self.fn), 'TS')
             if not os.path.exists(svfn_directory):
@@ -1287,16 +1620,18 @@ class Zen3D(object):
             svfn_time = ''.join(self.schedule.Time.split(':'))
             svfn_station = save_station+self.metadata.rx_xyz0.split(':')[0]
             save_fn = os.path.join(svfn_directory, 
-                                   '{0}_{1}_{2}_{3}.{4}'.format(svfn_station,
+                                   '{0}_{1}_{2}_{3}.{4}{5}'.format(svfn_station,
                                                    svfn_date,
                                                    svfn_time,
                                                    int(self.df),
-                                                   self.metadata.ch_cmp.upper()))
+                                                   self.metadata.ch_cmp.upper(),
+                                                   extension))
         #calibrate electric channels 
-        if self.metadata.ch_cmp == 'ex':
-            time_series /= ex
-        elif self.metadata.ch_cmp == 'ey':
-            time_series /= ey
+        if units != 'counts':
+            if self.metadata.ch_cmp == 'ex':
+                time_series /= ex
+            elif self.metadata.ch_cmp == 'ey':
+                time_series /= ey
 
         #apply notch filter if desired
         if notch_dict is not None:
@@ -1312,15 +1647,13 @@ class Zen3D(object):
                         time.mktime(time.strptime(self.zen_schedule,
                                                   datetime_fmt )), 
                         time_series.shape[0], 
-                        'mV', 
+                        units, 
                         '{0:.3f}'.format(np.median(np.rad2deg(self.gps_stamps['lat']))), 
                         '{0:.3f}'.format(np.median(np.rad2deg(self.gps_stamps['lon']))), 
                         0.0, 
-                        time_series)                
-        self.fn_mt_ascii = mtfh.write_ts_file_from_tuple(save_fn, header_tuple,
-                                                         fmt=fmt)
-        
-        print 'Wrote mtpy timeseries file to {0}'.format(self.fn_mt_ascii)
+                        time_series)
+                        
+        return save_fn, header_tuple
     
     #==================================================                                                           
     def plot_time_series(self, fig_num=1):
@@ -2488,6 +2821,104 @@ class Zen3D_old(object):
 #==============================================================================
 # Cache files
 #==============================================================================
+def get_cache_block_index(cache_fn):
+    """
+    index the blocks of a .cac file without reading the data
+    
+    Only the 10 byte block pointers and the trailing block lengths are read,
+    the data of each block is skipped with seek, so indexing is independent
+    of the size of the time series block.
+    
+    Arguments:
+    -----------
+        **cache_fn** : string
+                       full path to .cac file
+                       
+    Outputs:
+    ---------
+        **block_index** : np.ndarray(num_blocks)
+                          structured array with keys
+                          
+                          ========== =========================================
+                          Key        Description
+                          ========== =========================================
+                          type       block type (see Cache._type_dict)
+                          offset     byte offset of the block data
+                          length     number of bytes of the block data
+                          ========== =========================================
+                          
+    raises CacheNavigationError, CacheMetaDataError, CacheCalibrationError or
+    CacheTimeSeriesError (ValueError for other blocks) if the block lengths 
+    at the beginning and end of a block are not the same.
+    """
+    
+    pointer_dtype = np.dtype([('length', '<i4'),
+                              ('flag', '<i4'),
+                              ('type', '<i2')])
+    error_dict = {4:CacheNavigationError,
+                  514:CacheMetaDataError,
+                  768:CacheCalibrationError,
+                  16:CacheTimeSeriesError}
+    
+    file_size = os.path.getsize(cache_fn)
+    index_list = []
+    with open(cache_fn, 'rb') as fid:
+        while fid.tell()+pointer_dtype.itemsize <= file_size:
+            pointer = np.fromstring(fid.read(pointer_dtype.itemsize),
+                                    dtype=pointer_dtype)[0]
+            offset = fid.tell()
+            length = int(pointer['length'])-2
+            fid.seek(length, 1)
+            end_length = np.fromstring(fid.read(4), dtype='<i4')
+            
+            if len(end_length) != 1 or end_length[0] != pointer['length']:
+                error = error_dict.get(int(pointer['type']), ValueError)
+                raise error('Block length {0} != end length {1} for block '
+                            'type {2} at byte {3} in {4}'.format(
+                            pointer['length'], end_length, pointer['type'],
+                            offset, cache_fn))
+            
+            index_list.append((pointer['type'], offset, length))
+            
+    return np.array(index_list, dtype=[('type', np.int16),
+                                       ('offset', np.int64),
+                                       ('length', np.int64)])
+                                       
+def get_cache_time_series(cache_fn, block_entry, num_chn, mode='c'):
+    """
+    get the time series block of a .cac file as np.memmap 
+    
+    Arguments:
+    -----------
+        **cache_fn** : string
+                       full path to .cac file
+                       
+        **block_entry** : entry of get_cache_block_index for the time series 
+                          block
+        
+        **num_chn** : int
+                      number of channels in the file
+                      
+        **mode** : [ 'c' | 'r' | 'r+' ] 
+                   memmap mode, default is 'c' (copy on write) so that
+                   changes to the array are never written to the file
+                      
+    Outputs:
+    ---------
+        **ts** : np.memmap(npnt, num_chn) of np.int32 
+                 zero copy view of the time series block, channels in the 
+                 order of CH.CMP
+    """
+    
+    npnt = int(block_entry['length']/4/num_chn)
+    if int(block_entry['length']/4)%num_chn != 0:
+        print 'Trimming TS by {0} points'.format(
+                                        int(block_entry['length']/4)%num_chn)
+    
+    return np.memmap(cache_fn, dtype='<i4', mode=mode, 
+                     offset=int(block_entry['offset']),
+                     shape=(npnt, num_chn))
+                     
 class Cache_Metadata(object):
     def __init__(self, fn=None, **kwargs):
         self.fn = fn
@@ -2621,6 +3052,8 @@ class Board_Calibration(object):
 class Cache(object):
     """
     deal with Zonge .cac files
+    
+    The time series block is mapped with np.memmap, see read_cache_file.
     """
     def __init__(self, fn=None, **kwargs):
         self.fn = fn
@@ -2629,6 +3062,8 @@ class Cache(object):
         self.time_series = None
         self.other = None
         self.calibration = None
+        self.ts_array = None
+        self.block_index = None
         
         self._flag_len = 10
         self._len_bytes = 4
@@ -2697,69 +3132,154 @@ class Cache(object):
                     return
                             
         
-    def read_cache_file(self, fn=None):
+    def read_cache_file(self, fn=None, mmap=True):
         """
         read .cac file
+        
+        The blocks are indexed once with get_cache_block_index, only the 
+        metadata, calibration and other blocks are read into memory.  The
+        time series block is mapped as a zero copy np.memmap:
+        
+            * *ts_array* : np.memmap(npnt, num_channels) of np.int32
+            * *time_series* : view of ts_array with a key for each channel
+                              (ch_cmp in lower case), each np.ndarray(npnt)
+                              
+        If mmap is False the time series is read into memory.  
         """
         if fn is not None:
             self.fn = fn
+            
+        self.block_index = get_cache_block_index(self.fn)
         
-        f_pointer = True
+        ts_entry = None
         with open(self.fn, 'rb') as fid:
-            while f_pointer:            
-                # read in first pointer            
-                f_pointer, f_str = self._read_file_block(fid)
+            for entry in self.block_index:
+                b_type = int(entry['type'])
+                
+                # time series is mapped once the metadata is known
+                if b_type == 16:
+                    ts_entry = entry
+                    continue
+                    
+                fid.seek(entry['offset'])
+                f_str = fid.read(entry['length'])
                 
                 # if the data type is the meta data
-                if int(f_pointer['type']) == 514:
+                if b_type == 514:
                     meta_obj = Cache_Metadata()
                     meta_obj.read_meta_string(f_str)
 
-                    key = self._type_dict[int(f_pointer['type'])]        
+                    key = self._type_dict[b_type]        
                     setattr(self, key, meta_obj)
                     print 'Read in metadata'
-                    continue
                 
                 # if the data type is calibration
-                elif int(f_pointer['type']) == 768:
+                elif b_type == 768:
                     cal_obj = Board_Calibration(f_str)
                     cal_obj.read_board_cal_str()
                     
-                    key = self._type_dict[int(f_pointer['type'])]        
+                    key = self._type_dict[b_type]        
                     setattr(self, key, cal_obj)
                     print 'Read in calibration'
-                    continue
-                    
-                # if the data type is time series
-                elif int(f_pointer['type']) == 16:
-                    ts_arr = np.fromstring(f_str, dtype=np.int32)
-                    ts_arr = np.resize(ts_arr, (int(self.metadata.ts_npnt), 
-                                                len(self.metadata.ch_cmp)))
-                    
                     
-                    ts = np.zeros(1, 
-                                  dtype=[(cc.lower(), np.int32, 
-                                          (int(self.metadata.ts_npnt),)) for 
-                                          cc in self.metadata.ch_cmp])
-                    
-                    for ii, cc in enumerate(self.metadata.ch_cmp):
-                        ts[cc.lower()][:] = ts_arr[:, ii]
-                    key = self._type_dict[int(f_pointer['type'])]        
-                    setattr(self, key, ts)
-                    print 'Read in time series,  # points = {0}'.format(
-                                                        self.metadata.ts_npnt)
-                    return
-                # if the data type is time series
-                elif int(f_pointer['type']) == 15:
+                # if the data type is other
+                elif b_type == 15:
                     ts = np.fromstring(f_str, dtype=np.int32)
-                    
-
                 
-                    key = self._type_dict[int(f_pointer['type'])]        
+                    key = self._type_dict[b_type]        
                     setattr(self, key, ts)
                     print 'Read in other'
-                    continue
+                    
+        if ts_entry is not None:
+            ch_cmp = self.metadata.ch_cmp
+            if type(ch_cmp) is not list:
+                ch_cmp = [ch_cmp]
+                
+            self.ts_array = get_cache_time_series(self.fn, ts_entry, 
+                                                  len(ch_cmp))
+            if mmap is False:
+                self.ts_array = np.array(self.ts_array)
                 
+            self.time_series = self.ts_array.view(
+                                    dtype=[(cc.lower(), '<i4') 
+                                           for cc in ch_cmp])[:, 0]
+            print 'Read in time series,  # points = {0}'.format(
+                                                    self.ts_array.shape[0])
+                
+#==============================================================================
+# decimate time series block by block
+#==============================================================================
+class _BlockDecimator(object):
+    """
+    decimate a multi channel time series that comes in consecutive blocks
+    
+    A FIR low pass filter (cutoff at 0.8 of the new Nyquist frequency) is 
+    applied with the filter state carried over from one block to the next, 
+    so the result does not depend on the block size.  The filter delay of
+    (n_taps-1)/2 samples is removed, call flush after the last block to get
+    the remaining samples.  Output sample k corresponds to input sample 
+    k*decimate.
+    
+    Arguments:
+    -----------
+        **decimate** : int
+                       decimation factor, 1 passes the data through
+                       
+        **n_chn** : int
+                    number of channels (columns) of each block
+                    
+        **n_taps** : int
+                     number of filter coefficients, *default* is 
+                     20*decimate+1
+    """
+    
+    def __init__(self, decimate, n_chn, n_taps=None):
+        self.factor = int(decimate)
+        self.n_chn = n_chn
+        self.n_in = 0
+        
+        if n_taps is None:
+            n_taps = 20*self.factor+1
+        self.delay = (n_taps-1)/2
+        
+        if self.factor > 1:
+            self.taps = sps.firwin(n_taps, 0.8/self.factor)
+            self.zi = np.zeros((n_taps-1, n_chn))
+        
+    def decimate(self, ts_block):
+        """
+        decimate ts_block, np.ndarray(n_points, n_chn)
+        """
+        
+        if self.factor == 1:
+            self.n_in += ts_block.shape[0]
+            return ts_block
+            
+        f_block, self.zi = sps.lfilter(self.taps, 1., 
+                                       np.asarray(ts_block, dtype=np.float),
+                                       axis=0, zi=self.zi)
+                                       
+        # filtered index g corresponds to input index g-delay
+        g_start = max(self.n_in, self.delay)
+        g_start += (-(g_start-self.delay))%self.factor
+        self.n_in += ts_block.shape[0]
+        
+        return f_block[g_start-(self.n_in-ts_block.shape[0])::self.factor]
+        
+    def flush(self):
+        """
+        return the samples still in the filter after the last block
+        """
+        
+        if self.factor == 1:
+            return np.zeros((0, self.n_chn), dtype=np.int32)
+        
+        n_in = self.n_in
+        f_block = self.decimate(np.zeros((self.delay, self.n_chn)))
+        self.n_in = n_in
+        
+        return f_block
+        
 #==============================================================================
 # 
 #==============================================================================
@@ -2775,13 +3295,16 @@ class ZenCache(object):
     ================== ========================================================
      Attributes         Description
     ================== ======================================================== 
+    block_index         structured array of block type, offset and length
+                        from get_cache_block_index
     cal_data            list of calibrations, as is from file
     fn_list              list of filenames merged together
     log_lines           list of information to put into a log file
     meta_data           dictionary of meta data key words and values
     nav_data            list of navigation data, as is from file
     save_fn             file to save merged file to
-    ts                  np.ndarray(len(ts), num_channels) of time series
+    ts                  np.ndarray(len(ts), num_channels) of time series,
+                        np.memmap if read in with read_cache
     verbose             [ True | False ] True prints information to console
     zt_list              list of class: Zen3D objects
     _ch_factor          scaling factor for the channels, got this from Zonge
@@ -3023,10 +3546,41 @@ class ZenCache(object):
         return ts_array, ts_min
     
     #==================================================    
-    def write_cache_file(self, fn_list, save_fn, station='ZEN', decimate=1):
+    def write_cache_file(self, fn_list, save_fn, station='ZEN', decimate=1,
+                         block_seconds=60):
         """
         write a cache file from given filenames
         
+        The channels are merged in a streaming fashion, so memory use only
+        depends on block_seconds and not on the length of the files:
+        
+            1. each Z3D file is memory mapped and indexed by its gps stamps 
+               (see Zen3D._index_gps_seconds), nothing is read yet.
+            2. channels are aligned by gps index arithmetic, the merged 
+               time series starts at the latest first good second of all
+               channels and ends when the first channel runs out of 
+               consecutive good seconds.
+            3. block_seconds of all channels are copied out of the files at 
+               a time, decimated with a FIR low pass filter whose state is
+               carried over from block to block, and appended to the cache 
+               file.
+               
+        Arguments:
+        -----------
+            **fn_list** : list of Z3D files of one schedule block
+            
+            **save_fn** : full path to .cac file or directory to save to, in 
+                          which case the file is saved to save_fn/Merged
+                          
+            **station** : station name used for the file name
+            
+            **decimate** : int
+                           decimation factor, *default* is 1
+                           
+            **block_seconds** : int
+                                number of seconds merged at a time, 
+                                *default* is 60
+        
         """
         #sort the files so they are in order
         fn_sort_list = []
@@ -3037,44 +3591,75 @@ class ZenCache(object):
 
         fn_list = fn_sort_list
         print fn_list
+        
+        decimate = max(1, int(decimate))
+        block_seconds = max(1, int(block_seconds))
             
-        n_fn = len(fn_list)
         self.zt_list = []
+        index_list = []
         for fn in fn_list:
             zt1 = Zen3D(fn=fn)
             zt1.verbose = self.verbose
-            try:
-                zt1.read_3d()
-            except ZenGPSError:
-                zt1._seconds_diff = 59
-                zt1.read_3d()
+            with open(fn, 'rb') as file_id:
+                zt1.read_header(fid=file_id)
+                zt1.read_schedule(fid=file_id)
+                zt1.read_metadata(fid=file_id)
+            z_index = zt1._index_gps_seconds()
+            if not z_index[3].any():
+                print '***SKIPPING {0} '.format(zt1.fn)
+                print '   because it does not contain good gps stamps'
+                continue
             self.zt_list.append(zt1)
+            index_list.append(z_index)
+            
+        #make sure all files have the same sampling rate
+        self.check_sampling_rate(self.zt_list)
         
-            #fill in meta data from the time series file
-            self.meta_data['DATA.DATE0'] = ','+zt1.date_time[0].split(',')[0]
-            self.meta_data['DATA.TIME0'] = ','+zt1.date_time[0].split(',')[1]
-            self.meta_data['TS.ADFREQ'] = ',{0}'.format(int(zt1.df))
+        #align the channels by gps time
+        start_list = self._align_gps_index(index_list)
+        
+        n_fn = len(self.zt_list)
+        df = int(self.zt_list[0].df)
+        n_seconds = start_list[:, 1].min()
+        n_samples = n_seconds*df
+        ts_len = int(np.ceil(n_samples/float(decimate)))
+        
+        zt1 = self.zt_list[0]
+        gps_time = index_list[0][2][start_list[0, 0]]
+        date_time = zt1.get_UTC_date_time(zt1.header.gpsweek, 
+                                          gps_time+zt1._leap_seconds)
+        
+        #fill in meta data from the time series files
+        self.meta_data['DATA.DATE0'] = ','+date_time.split(',')[0]
+        self.meta_data['DATA.TIME0'] = ','+date_time.split(',')[1]
+        self.meta_data['TS.ADFREQ'] = ',{0}'.format(int(df/decimate))
+        self.meta_data['TS.NPNT'] = ',{0}'.format(ts_len)
+        for zt in self.zt_list:
             self.meta_data['CH.FACTOR'] += ','+self._ch_factor 
             self.meta_data['CH.GAIN'] += ','+self._ch_gain
-            self.meta_data['CH.CMP'] += ','+zt1.ch_cmp.upper()
-            self.meta_data['CH.LENGTH'] += ','+zt1.ch_length
+            self.meta_data['CH.CMP'] += ','+zt.metadata.ch_cmp.upper()
+            self.meta_data['CH.LENGTH'] += ',{0}'.format(zt.metadata.ch_length)
             self.meta_data['CH.EXTGAIN'] += ',1'
             self.meta_data['CH.NOTCH'] += ',NONE'
             self.meta_data['CH.HIGHPASS'] += ',NONE'
             self.meta_data['CH.LOWPASS'] += ','+\
-                                       self._ch_lowpass_dict[str(int(zt1.df))]
-            self.meta_data['CH.ADCARDSN'] += ','+zt1.ch_adcard_sn
-            self.meta_data['CH.NUMBER'] += ',{0}'.format(zt1.ch_number)
-            self.meta_data['RX.STN'] += ','+zt1.rx_stn
+                                self._ch_lowpass_dict.get(str(df), 'NONE')
+            self.meta_data['CH.ADCARDSN'] += ',{0}'.format(
+                                                    zt.header.channelserial)
+            self.meta_data['CH.NUMBER'] += ',{0}'.format(zt.metadata.ch_number)
+            self.meta_data['RX.STN'] += ','+zt.metadata.rx_xyz0.split(':')[0]
             
-        #make sure all files have the same sampling rate
-        self.check_sampling_rate(self.zt_list)
-        
-        #make sure the length of time series is the same for all channels
-        self.ts, ts_len = self.check_time_series(self.zt_list,
-                                                 decimate=decimate)
-        
-        self.meta_data['TS.NPNT'] = ',{0}'.format(ts_len)
+            if self.verbose:
+                print 'TS length for channel {0} '.format(zt.metadata.ch_number)+\
+                      '({0}) '.format(zt.metadata.ch_cmp)+\
+                      '= {0}'.format(ts_len)
+                print '    T0 = {0}\n'.format(date_time)
+            self.log_lines.append(' '*4+\
+                                  'TS length for channel {0} '.format(
+                                                      zt.metadata.ch_number)+\
+                                  '({0}) '.format(zt.metadata.ch_cmp)+\
+                                  '= {0}'.format(ts_len))
+            self.log_lines.append(', T0 = {0}\n'.format(date_time))
         
         #get the file name to save to 
         if save_fn[-4:] == '.cac':
@@ -3094,8 +3679,6 @@ class ZenCache(object):
                     os.mkdir(save_fn)
             self.save_fn = os.path.join(save_fn, general_fn)
                 
-                
-            
         cfid = file(self.save_fn, 'wb+')
         #--> write navigation records first        
         cfid.write(struct.pack('<i', self._nav_len))
@@ -3132,38 +3715,109 @@ class ZenCache(object):
         cfid.write(cal_data[:-1]+'\n')
         cfid.write(struct.pack('<i', cal_len+2))
         
-        #--> write data
-        
+        #--> write time series block, the data are counts which is 
+        #    apparently what MTFT24 expects
         ts_block_len = int(ts_len)*n_fn*4+2
-        
-        #--> Need to scale the time series into counts cause that is apparently
-        #    what MTFT24 expects
-        self.ts = self.ts.astype(np.int32)
-        
-        #--> make sure none of the data is above the allowed level
-        self.ts[np.where(self.ts>2.14e9)] = 2.14e9
-        self.ts[np.where(self.ts<-2.14e9)] = -2.14e9
-        
-        #--> write time series block
         cfid.write(struct.pack('<i', ts_block_len))
         cfid.write(struct.pack('<i', self._flag))
         cfid.write(struct.pack('<h', self._type_dict['ts']))
         
-        #--> need to pack the data as signed integers
-        for zz in range(ts_len):
-            cfid.write(struct.pack('<'+'i'*n_fn, *self.ts[zz]))
+        decimator = _BlockDecimator(decimate, n_fn)
+        n_written = 0
+        second_len = df+zt1._gps_bytes
+        for b_start in range(0, n_seconds, block_seconds):
+            b_len = min(block_seconds, n_seconds-b_start)
+            ts_block = np.zeros((b_len*df, n_fn), dtype=np.int32)
+            for ii, z_index in enumerate(index_list):
+                d_start = z_index[1][start_list[ii, 0]+b_start]
+                block = z_index[0][d_start:d_start+b_len*second_len]
+                ts_block[:, ii] = block.reshape(b_len, second_len)[:, 
+                                                zt1._gps_bytes:].ravel()
+                
+            n_written += self._write_ts_block(cfid, 
+                                              decimator.decimate(ts_block))
+        n_written += self._write_ts_block(cfid, decimator.flush())
+        
+        if n_written != ts_len:
+            cfid.close()
+            raise CacheTimeSeriesError('Wrote {0} points instead of {1} '
+                                       'to {2}'.format(n_written, ts_len,
+                                                       self.save_fn))
                                 
         cfid.write(struct.pack('<i', ts_block_len))
-         
-        
         cfid.close()
         
+        self.ts = None
+        
         if self.verbose:
             print 'Saved File to: ', self.save_fn
         self.log_lines.append('='*72+'\n')
         self.log_lines.append('Saved File to: \n')
         self.log_lines.append(' '*4+'{0}\n'.format(self.save_fn))
         self.log_lines.append('='*72+'\n')
+        
+    #==================================================
+    def _align_gps_index(self, index_list):
+        """
+        align channels by gps index arithmetic.  
+        
+        The common start is the latest first good second of all channels, 
+        its index in each channel is found from the time difference to that
+        channel's first good second, assuming stamps are 1 second apart.
+        
+        Arguments:
+        -----------
+            **index_list** : list of Zen3D._index_gps_seconds outputs
+            
+        Outputs:
+        ---------
+            **start_list** : np.ndarray(num_channels, 2) 
+                             index of the common start second and number of 
+                             consecutive good seconds from there for each 
+                             channel
+        """
+        
+        first_good = [np.flatnonzero(z_index[3])[0] for z_index in index_list]
+        time_max = max([z_index[2][ff] for z_index, ff in 
+                        zip(index_list, first_good)])
+        
+        start_list = np.zeros((len(index_list), 2), dtype=np.int)
+        for ii, (z_index, ff) in enumerate(zip(index_list, first_good)):
+            gps_time, good, new_run = z_index[2:]
+            s_index = ff+int(round(time_max-gps_time[ff]))
+            if s_index >= gps_time.size or \
+               abs(gps_time[s_index]-time_max) > 0.5 or not good[s_index]:
+                raise ZenGPSError('{0} does not contain a good gps stamp '
+                                  'at {1}'.format(self.zt_list[ii].fn, 
+                                                  time_max))
+            run_end = np.flatnonzero(~good[s_index+1:] | 
+                                     new_run[s_index+1:])
+            if run_end.size == 0:
+                n_seconds = gps_time.size-s_index
+            else:
+                n_seconds = run_end[0]+1
+                
+            if s_index != ff:
+                print 'Skipping {0} seconds for {1}'.format(s_index-ff,
+                                            self.zt_list[ii].metadata.ch_cmp)
+            start_list[ii] = [s_index, n_seconds]
+            
+        return start_list
+        
+    #==================================================
+    def _write_ts_block(self, cfid, ts_block):
+        """
+        clip ts_block to the allowed level and append it to the cache file
+        as little endian np.int32, return the number of points written
+        """
+        
+        if ts_block.dtype != np.int32:
+            ts_block = np.round(np.clip(ts_block, -2.14e9, 2.14e9))
+        else:
+            ts_block = np.clip(ts_block, -2.14e9, 2.14e9)
+        ts_block.astype('<i4').tofile(cfid)
+        
+        return ts_block.shape[0]
     
     #==================================================    
     def rewrite_cache_file(self):
@@ -3295,108 +3949,62 @@ class ZenCache(object):
         cfid.close()
         
     #==================================================
-    def read_cache(self, cache_fn):
+    def read_cache(self, cache_fn, mmap=True):
         """
         read a cache file
         
-        """
+        The blocks are indexed once with get_cache_block_index.  The time 
+        series block is not read into memory, ts is a zero copy 
+        np.memmap(npnt, num_channels) opened copy on write, so slicing 
+        channels and time windows only reads the needed parts of the file 
+        and changes to ts are never written back to cache_fn.
         
-        self.save_fn = cache_fn
-        #open cache file to read in as a binary file
-        cfid = file(cache_fn, 'rb')
+        If mmap is False the time series is read into memory.
         
-        #read into a long string
-        cdata = cfid.read()
-        
-        #--> read navigation data
-        nav_block = np.fromstring(cdata[0:self._stamp_len], 
-                                  dtype=self._data_type)
-        
-        #get starting and ending indices for navigation block
-        ii = int(self._stamp_len)
-        jj = self._stamp_len+nav_block['len']-2
-        self.nav_data = np.fromstring(cdata[ii:jj], dtype=np.int8)
-        
-        #get indicies for length of block
-        ii = int(jj)
-        jj = ii+4
-        nav_len_check = np.fromstring(cdata[ii:jj], np.int32)
-        if nav_len_check != nav_block['len']:
-            if self.verbose:
-                print 'Index for second navigation length is {0}'.format(ii)
-            raise CacheNavigationError('Navigation length in data block are'
-                                       'not equal: {0} != {1}'.format(
-                                       nav_block['len'], nav_len_check))
-        
-        #--> read meta data
-        ii = int(jj)
-        jj = ii+self._stamp_len
-        
-        meta_block = np.fromstring(cdata[ii:jj], dtype=self._data_type)
-        ii = int(jj)
-        jj = ii+meta_block['len']-2
-        self.meta_data = {}
-        meta_list = cdata[ii:jj].split('\n')
-        for mm in meta_list:
-            mfind = mm.find(',')
-            self.meta_data[mm[0:mfind]] = mm[mfind+1:].split(',')
+        """
         
-        #get index for second length test
-        ii = int(jj)
-        jj = ii+4
-        meta_len_check = np.fromstring(cdata[ii:jj], dtype=np.int32)
-        if meta_len_check != meta_block['len']:
-            if self.verbose:
-                print 'Index for second meta length is {0}'.format(ii)
-            raise CacheMetaDataError('Meta length in data blocks are not'
-                                     'equal: {0} != {1}'.format(
-                                     meta_block['len'], meta_len_check))
+        self.save_fn = cache_fn
+        self.block_index = get_cache_block_index(cache_fn)
         
-        #--> read calibrations
-        ii = int(jj)
-        jj = ii+self._stamp_len
-        cal_block = np.fromstring(cdata[ii:jj], dtype=self._data_type)
+        type_dict = dict([(value, key) for key, value in 
+                          self._type_dict.items()])
         
-        ii = int(jj)
-        jj = ii+cal_block['len']-2
-        self.cal_data = cdata[ii:jj]
+        with open(cache_fn, 'rb') as cfid:
+            for entry in self.block_index:
+                b_key = type_dict.get(int(entry['type']))
+                if b_key is None or b_key == 'ts':
+                    continue
                 
-        
-        ii = int(jj)
-        jj = ii+4
-        cal_len_check = np.fromstring(cdata[ii:jj], dtype=np.int32)
-        if cal_len_check != cal_block['len']:
-            if self.verbose:
-                print 'Index for second cal length is {0}'.format(ii)
-            raise CacheCalibrationError('Cal length in data blocks are not'
-                                        'equal: {0} != {1}'.format(
-                                        cal_block['len'], cal_len_check))
-        
-        #--> read data
-        ii = int(jj)
-        jj = ii+self._stamp_len
-        
-        ts_block = np.fromstring(cdata[ii:jj], dtype=self._data_type)
-        
-        #get time series data
-        ii = int(jj)
-        jj = ii+ts_block['len']-2
-        self.ts = np.fromstring(cdata[ii:jj], dtype=self._ts_dtype)
-        #resize time series to be length of each channel
+                cfid.seek(entry['offset'])
+                b_str = cfid.read(entry['length'])
+                
+                #--> read navigation data
+                if b_key == 'nav':
+                    self.nav_data = np.fromstring(b_str, dtype=np.int8)
+                    
+                #--> read meta data
+                elif b_key == 'meta':
+                    self.meta_data = {}
+                    meta_list = b_str.split('\n')
+                    for mm in meta_list:
+                        mfind = mm.find(',')
+                        self.meta_data[mm[0:mfind]] = mm[mfind+1:].split(',')
+                        
+                #--> read calibrations
+                elif b_key == 'cal':
+                    self.cal_data = b_str
+        
+        #--> map time series data
+        ts_entry = self.block_index[self.block_index['type'] == 
+                                    self._type_dict['ts']]
+        if len(ts_entry) == 0:
+            raise CacheTimeSeriesError('No time series block in {0}'.format(
+                                       cache_fn))
+                                       
         num_chn = len(self.meta_data['ch.cmp'.upper()])
-        if self.ts.shape[0]%num_chn != 0:
-            print 'Trimming TS by {0} points'.format(self.ts.shape[0]%num_chn)
-        self.ts = np.resize(self.ts, (int(self.ts.shape[0]/num_chn), num_chn))
-        
-        ii = int(jj)
-        jj = ii+4
-        ts_len_check = np.fromstring(cdata[ii:jj], dtype=np.int32)
-        if ts_len_check != ts_block['len']:
-            if self.verbose:
-                print 'Index for second ts length is {0}'.format(ii)
-            raise CacheTimeSeriesError('ts length in data blocks are not'
-                                       'equal: {0} != {1}'.format(
-                                       ts_block['len'], ts_len_check))
+        self.ts = get_cache_time_series(cache_fn, ts_entry[0], num_chn)
+        if mmap is False:
+            self.ts = np.array(self.ts)
 
 #==============================================================================
 # read and write a zen schedule 
@@ -5854,6 +6462,350 @@ def make_mtpy_ts_loop(station_path, station_list, survey_file=None,
         log_fid.writelines(sfn_lines)
     log_fid.close()
     
+#==============================================================================
+# batch conversion of Z3D files
+#==============================================================================
+def get_z3d_schedule_blocks(z3d_path_list):
+    """
+    find all .Z3D files in the given directories (or file names) and group
+    them by station, sampling rate and schedule block.  Only the header,
+    schedule and metadata of each file are read.
+    
+    Arguments
+    -------------
+        **z3d_path_list** : list
+                            list of directories containing .Z3D files
+                            and/or full paths to .Z3D files
+                            
+    Returns
+    -------------
+        **block_dict** : dictionary
+                         keys are (station, df, schedule date_time) and 
+                         values are lists of .Z3D file names of that block
+                         
+    Example
+    ------------
+        >>> import mtpy.usgs.zen as zen
+        >>> block_dict = zen.get_z3d_schedule_blocks([r"/home/mt/mt01"])
+    """
+    
+    if type(z3d_path_list) is str:
+        z3d_path_list = [z3d_path_list]
+        
+    fn_list = []
+    for z3d_path in z3d_path_list:
+        if os.path.isdir(z3d_path):
+            fn_list.extend([os.path.join(z3d_path, fn) 
+                            for fn in sorted(os.listdir(z3d_path))
+                            if fn[-4:].lower() == '.z3d'])
+        elif z3d_path[-4:].lower() == '.z3d':
+            fn_list.append(z3d_path)
+    
+    block_dict = {}
+    for fn in fn_list:
+        zd = Zen3D(fn)
+        with open(fn, 'rb') as file_id:
+            zd.read_header(fid=file_id)
+            zd.read_schedule(fid=file_id)
+            zd.read_metadata(fid=file_id)
+        station = zd.metadata.rx_xyz0.split(':')[0]
+        block_key = (station, int(zd.header.ad_rate), zd.zen_schedule)
+        block_dict.setdefault(block_key, []).append(fn)
+        
+    return block_dict
+    
+def _read_conversion_manifest(manifest_fn):
+    """
+    read a conversion manifest into a dictionary with keys of input files 
+    and values of (modification time, size, output file)
+    """
+    
+    manifest_dict = {}
+    if not os.path.isfile(manifest_fn):
+        return manifest_dict
+        
+    with open(manifest_fn, 'r') as fid:
+        for line in fid:
+            line_list = line.rstrip('\n').split('\t')
+            if len(line_list) != 4:
+                continue
+            manifest_dict[line_list[0]] = (float(line_list[1]), 
+                                           int(line_list[2]), 
+                                           line_list[3])
+                                           
+    return manifest_dict
+    
+def _write_conversion_manifest(manifest_fn, manifest_dict):
+    """
+    write a conversion manifest, see _read_conversion_manifest
+    """
+    
+    with open(manifest_fn, 'w') as fid:
+        for key in sorted(manifest_dict.keys()):
+            fid.write('{0}\t{1:.6f}\t{2}\t{3}\n'.format(key, 
+                                                    *manifest_dict[key]))
+    
+def _is_up_to_date(fn_list, manifest_entry):
+    """
+    check if the output file in manifest_entry was made from the current 
+    versions of the files in fn_list
+    """
+    
+    if manifest_entry is None or not os.path.isfile(manifest_entry[2]):
+        return False
+        
+    mtime = max([os.path.getmtime(fn) for fn in fn_list])
+    size = sum([os.path.getsize(fn) for fn in fn_list])
+    if manifest_entry[0] != round(mtime, 6) or manifest_entry[1] != size:
+        return False
+    
+    return os.path.getmtime(manifest_entry[2]) >= mtime
+    
+def _convert_z3d_file(task):
+    """
+    convert one .Z3D file to an mtpy ascii (or binary) file, used by 
+    batch_convert_z3d.  Return (fn, out_fn, status, npts, file size, time 
+    taken in s, captured output).
+    """
+    
+    fn, kwargs = task
+    
+    st = time.time()
+    out_fn = ''
+    npts = 0
+    with Capturing() as output:
+        try:
+            zd = Zen3D(fn)
+            zd.read_z3d()
+            if 'dtype' in kwargs:
+                zd.write_binary_mt_file(**kwargs)
+                out_fn = zd.fn_mt_binary
+            else:
+                zd.write_ascii_mt_file(**kwargs)
+                out_fn = zd.fn_mt_ascii
+            npts = zd.time_series.size
+            status = 'converted'
+        except Exception as error:
+            print '*** Could not convert {0}: {1}'.format(fn, error)
+            status = 'failed'
+    
+    return (fn, out_fn, status, npts, os.path.getsize(fn), time.time()-st,
+            list(output))
+            
+def _merge_z3d_block(task):
+    """
+    merge the .Z3D files of one schedule block into a cache file, used by 
+    batch_convert_z3d.  Return the same tuple as _convert_z3d_file, with 
+    the file names joined by ';' and their total size.
+    """
+    
+    fn_list, save_path, station = task
+    
+    st = time.time()
+    out_fn = ''
+    npts = 0
+    with Capturing() as output:
+        try:
+            zc = ZenCache()
+            zc.write_cache_file(fn_list, save_path, station=station)
+            out_fn = zc.save_fn
+            npts = int(zc.meta_data['TS.NPNT'][1:])
+            status = 'merged'
+        except Exception as error:
+            print '*** Could not merge {0}: {1}'.format(fn_list, error)
+            status = 'failed'
+            
+    return (';'.join(fn_list), out_fn, status, npts, 
+            sum([os.path.getsize(fn) for fn in fn_list]), time.time()-st, 
+            list(output))
+    
+def batch_convert_z3d(z3d_path_list, n_workers=None, station_name='mb', 
+                      fmt='%.8e', ex=100., ey=100., notch_dict=None, 
+                      binary_dtype=None, merge=False, overwrite=False, 
+                      verbose=True):
+    """
+    convert all .Z3D files found in the given directories to mtpy ascii 
+    files, and optionally merge each schedule block into a cache file,
+    across a pool of processes.
+    
+    Files that have been converted before and have not changed since are
+    skipped unless overwrite is True.  This is tracked in a manifest file
+    z3d_conversion.manifest in the TS (or Merged) directory next to the 
+    .Z3D files.  A summary of the throughput of each file is written to 
+    z3d_conversion_summary.log in the same directory.
+    
+    Arguments
+    -------------
+        **z3d_path_list** : list
+                            list of directories containing .Z3D files
+                            and/or full paths to .Z3D files
+                            
+        **n_workers** : int
+                        number of worker processes, 1 converts serially
+                        *default* is None, which uses all cpus
+                        
+        **station_name**, **fmt**, **ex**, **ey**, **notch_dict** : 
+                        see Zen3D.write_ascii_mt_file
+                        
+        **binary_dtype** : [ None | 'float32' | 'int32' ]
+                           if not None write mtpy binary files of this data
+                           type with Zen3D.write_binary_mt_file instead of
+                           ascii files.  *default* is None
+                        
+        **merge** : [ True | False ]
+                    merge the channels of each schedule block into a cache
+                    file with ZenCache.write_cache_file
+                    *default* is False
+                    
+        **overwrite** : [ True | False ]
+                        convert files even if they are up to date
+                        *default* is False
+                        
+        **verbose** : [ True | False ]
+                      print a line for each file processed
+                      
+    Returns
+    -------------
+        **summary_arr** : np.ndarray(fn, out_fn, status, npts, nbytes, 
+                                     seconds, mb_per_s)
+                          status is [ 'converted' | 'merged' | 'skipped' | 
+                          'failed' ]
+                          
+    Example
+    ------------
+        >>> import mtpy.usgs.zen as zen
+        >>> summary = zen.batch_convert_z3d([r"/home/mt/mt01", 
+                                             r"/home/mt/mt02"],
+                                            n_workers=4, merge=True)
+    """
+    
+    st = time.time()
+    block_dict = get_z3d_schedule_blocks(z3d_path_list)
+    
+    kwargs = {'save_station':station_name, 'ex':ex, 'ey':ey, 
+              'notch_dict':notch_dict}
+    if binary_dtype is None:
+        kwargs['fmt'] = fmt
+    else:
+        kwargs['dtype'] = binary_dtype
+    
+    # make output directories and read in manifests before forking, 
+    # manifests are only written by this process.  Skipped files are kept 
+    # with the name of their output directory
+    manifest_dict = {}
+    convert_tasks = []
+    merge_tasks = []
+    lo_skipped = []
+    for block_key in sorted(block_dict.keys()):
+        for fn in block_dict[block_key]:
+            ts_path = os.path.join(os.path.dirname(fn), 'TS')
+            if not os.path.exists(ts_path):
+                os.mkdir(ts_path)
+            m_fn = os.path.join(ts_path, 'z3d_conversion.manifest')
+            if m_fn not in manifest_dict:
+                manifest_dict[m_fn] = _read_conversion_manifest(m_fn)
+                
+            m_entry = manifest_dict[m_fn].get(fn, None)
+            if not overwrite and _is_up_to_date([fn], m_entry):
+                lo_skipped.append(('TS', (fn, m_entry[2], 'skipped', 0, 
+                                          os.path.getsize(fn), 0.0, [])))
+            else:
+                convert_tasks.append((fn, kwargs))
+                
+        if merge:
+            fn_list = block_dict[block_key]
+            merge_path = os.path.join(os.path.dirname(fn_list[0]), 'Merged')
+            if not os.path.exists(merge_path):
+                os.mkdir(merge_path)
+            m_fn = os.path.join(merge_path, 'z3d_conversion.manifest')
+            if m_fn not in manifest_dict:
+                manifest_dict[m_fn] = _read_conversion_manifest(m_fn)
+                
+            m_entry = manifest_dict[m_fn].get(';'.join(fn_list), None)
+            if not overwrite and _is_up_to_date(fn_list, m_entry):
+                lo_skipped.append(('Merged', (';'.join(fn_list), m_entry[2], 
+                                   'skipped', 0, sum([os.path.getsize(fn) 
+                                           for fn in fn_list]), 0.0, [])))
+            else:
+                merge_tasks.append((fn_list, merge_path, 
+                                    station_name+block_key[0]))
+                
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+        
+    if n_workers > 1 and len(convert_tasks)+len(merge_tasks) > 1:
+        pool = multiprocessing.Pool(processes=n_workers)
+        try:
+            lo_results = pool.map(_convert_z3d_file, convert_tasks, 
+                                  chunksize=1)
+            lo_results += pool.map(_merge_z3d_block, merge_tasks, 
+                                   chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        lo_results = [_convert_z3d_file(task) for task in convert_tasks]
+        lo_results += [_merge_z3d_block(task) for task in merge_tasks]
+        
+    # output directory of each result, conversions go to TS and merges to 
+    # Merged whatever their status
+    lo_out_dirs = ['TS']*len(convert_tasks)+['Merged']*len(merge_tasks)+\
+                  [out_dir for out_dir, result in lo_skipped]
+    lo_results += [result for out_dir, result in lo_skipped]
+    
+    summary_arr = np.zeros(len(lo_results), 
+                           dtype=[('fn', '|S500'),
+                                  ('out_fn', '|S200'),
+                                  ('status', '|S10'),
+                                  ('npts', np.int),
+                                  ('nbytes', np.int),
+                                  ('seconds', np.float),
+                                  ('mb_per_s', np.float)])
+    
+    summary_lines = {}
+    for ii, result in enumerate(lo_results):
+        fn, out_fn, status, npts, nbytes, seconds, output = result
+        summary_arr[ii] = (fn, out_fn, status, npts, nbytes, seconds, 
+                           nbytes/1e6/seconds if seconds > 0 else 0.0)
+        
+        fn_list = fn.split(';')
+        out_path = os.path.join(os.path.dirname(fn_list[0]), lo_out_dirs[ii])
+        
+        # update manifest for files that were written
+        if status in ['converted', 'merged']:
+            m_fn = os.path.join(out_path, 'z3d_conversion.manifest')
+            manifest_dict[m_fn][fn] = (round(max([os.path.getmtime(mfn) 
+                                                  for mfn in fn_list]), 6),
+                                       nbytes, out_fn)
+        
+        line = '{0:<10}{1:>12}{2:>10.2f} s{3:>10.2f} MB/s  {4} --> {5}'.format(
+                status, npts, seconds, summary_arr[ii]['mb_per_s'], fn, 
+                out_fn)
+        summary_lines.setdefault(out_path, []).append(line)
+        if verbose:
+            print line
+        if status == 'failed':
+            summary_lines[out_path].extend([' '*4+o_line 
+                                            for o_line in output])
+    
+    for m_fn in manifest_dict.keys():
+        _write_conversion_manifest(m_fn, manifest_dict[m_fn])
+        
+    for out_path in summary_lines.keys():
+        with open(os.path.join(out_path, 'z3d_conversion_summary.log'), 
+                  'a') as fid:
+            fid.write('-'*72+'\n')
+            fid.write('{0} using {1} workers\n'.format(time.ctime(), 
+                                                        n_workers))
+            fid.write('\n'.join(summary_lines[out_path])+'\n')
+    
+    if verbose:
+        et = time.time()
+        print '--> Processed {0} files in {1:.2f} seconds'.format(
+                                                    len(lo_results), et-st)
+        
+    return summary_arr
+    
 #==============================================================================
 
 # this should capture all the print statements from zen
@@ -11,7 +11,7 @@
     Errors/uncertainties are either calculated by theoretical propagation of errors, or by 
     statistical evaluation: a number of PTs is generated from the values of Z and its uncertainties. For each value of Z
     random numbers for its replacement are drawn from a normal distribution. The value of Zerr determines the sigma of the 
-    distribution.
+    distribution. The realisations are evaluated with the Monte Carlo engine in mtpy.analysis.uncertainty.
 
     From these realisations the PT parameters are taken, and their respective means and standard deviations
     are interpreted as final outputs.
@@ -50,6 +50,7 @@ import os.path as op
 import numpy as np
 import mtpy.core.edi as MTedi
 import mtpy.analysis.pt as MTpt
+import mtpy.analysis.uncertainty as MTunc
 
 #for debugging:
 import ipdb
@@ -181,17 +182,13 @@ def generate_ptcrossdata_file(edi_object, n_iterations, sigma_scaling, outdir,ou
         print '\n\t Done - Written data to file: {0}\n'.format(outfn)
         return
 
-    # for all values n_iterations !=0 loop over abs(n_iterations) #
-    # loops individual per frequency
+    # for all values n_iterations !=0 evaluate abs(n_iterations) realisations
+    # of Z for all frequencies at once
 
+    z = edi_object.Z.z
+    zerr = np.array(edi_object.Z.zerr, dtype='float')
 
     for idx,f in enumerate(freqs):
-    
-        z = edi_object.Z.z
-        zerr = edi_object.Z.zerr
-        
-        lo_pts = []
-        lo_ptserr = []
 
         cur_z = z[idx]
         cur_zerr = zerr[idx]
@@ -224,77 +221,36 @@ def generate_ptcrossdata_file(edi_object, n_iterations, sigma_scaling, outdir,ou
                 cur_zerr[i/2,i%2] = err
                 #print err
 
-        #calculate random numbers: 
-        lo_rands = []
-        for k in np.arange(4):     
-            randnums = sigma_scaling*cur_zerr[k/2,k%2]*np.random.randn(2*abs(int(n_iterations)))
-            lo_rands.append(randnums)
-
-        #Loop over |n_iterations| random realisations: 
-
-        lo_pmin = []
-        lo_pmax = []
-
-        lo_alphas = []
-        lo_betas = []
-        #lo_ellipticities = []
-
-        #print 'running {0} iterations for {1} Hz'.format(n_iterations,f)
-        for run in np.arange(abs(int(n_iterations))):
-            tmp_z = np.array(
-                        [[complex(np.real(cur_z[0,0])+lo_rands[0][run],
-                                np.imag(cur_z[0,0])+lo_rands[0][-run-1]),
-                        complex(np.real(cur_z[0,1])+lo_rands[1][run],
-                                np.imag(cur_z[0,1])+lo_rands[1][-run-1])],
-                        [complex(np.real(cur_z[1,0])+lo_rands[2][run],
-                                np.imag(cur_z[1,0])+lo_rands[2][-run-1]),
-                        complex(np.real(cur_z[1,1])+lo_rands[3][run],
-                                np.imag(cur_z[1,1])+lo_rands[3][-run-1])
-                        ]]
-                        )
-            tmp_pt = MTpt.PhaseTensor(z_array=tmp_z.reshape(1,2,2),freq=f.reshape(1))
-            pi1 = tmp_pt._pi1()[0]
-            pi2 = tmp_pt._pi2()[0]
-            lo_pmin.append(pi2-pi1)
-            lo_pmax.append(pi2+pi1)
-
-            
-            alpha = tmp_pt.alpha[0][0]
-            if alpha < 0 and alpha%90 < 10:
-                lo_alphas.append(alpha%90 +90)
-            else: 
-                lo_alphas.append(alpha%90)
-            
-            # if idx%10==0:
-            #     print alpha,lo_alphas[-1]
-
-            lo_betas.append(tmp_pt.beta[0][0])
-            #in percent:
-            #lo_ellipticities.append(100*tmp_pt.ellipticity[0][0])
-
-        lo_alphas = np.array(lo_alphas)       
-        a = np.median(lo_alphas)
-        aerr = np.median(np.abs(lo_alphas - a))
-        #aerr = np.std(lo_alphas)
-        # if idx%10==0: 
-        #     print '\t',a,aerr
-        #     print
-
-
-        b = np.mean(lo_betas)
-        berr = np.std(lo_betas)
-
-        #ipdb.set_trace()
-
-        #convert to angles:
-        phimin = np.mean([np.degrees(np.arctan(i)) for i in lo_pmin])
-        phiminerr = np.std([np.degrees(np.arctan(i)) for i in lo_pmin])
-        
-        phimax = np.mean([np.degrees(np.arctan(i)) for i in lo_pmax])
-        phimaxerr = np.std([np.degrees(np.arctan(i)) for i in lo_pmax])
+    realisations = MTunc.compute_realisations(z, zerr, freqs, 
+                                              abs(int(n_iterations)),
+                                              sigma_scaling=sigma_scaling)
+
+    lo_alphas = realisations['alpha']
+    lo_alphas = np.where((lo_alphas < 0) & (lo_alphas%90 < 10), 
+                         lo_alphas%90 + 90, lo_alphas%90)
+    alphas = np.median(lo_alphas, axis=0)
+    alphaerrs = np.median(np.abs(lo_alphas - alphas), axis=0)
+
+    betas = np.mean(realisations['beta'], axis=0)
+    betaerrs = np.std(realisations['beta'], axis=0)
+
+    phimins = np.mean(realisations['phimin'], axis=0)
+    phiminerrs = np.std(realisations['phimin'], axis=0)
+
+    phimaxs = np.mean(realisations['phimax'], axis=0)
+    phimaxerrs = np.std(realisations['phimax'], axis=0)
+
+    for idx,f in enumerate(freqs):
+
+        a = alphas[idx]
+        aerr = alphaerrs[idx]
+        b = betas[idx]
+        berr = betaerrs[idx]
+        phimin = phimins[idx]
+        phiminerr = phiminerrs[idx]
+        phimax = phimaxs[idx]
+        phimaxerr = phimaxerrs[idx]
 
-        #e = np.mean(lo_ellipticities)
-        #eerr = np.std(lo_ellipticities)
         e = (phimax-phimin)/(phimax+phimin) 
 
         try:
@@ -15,6 +15,7 @@ import os.path as op
 import numpy as np
 import mtpy.utils.filehandling as MTfh
 import mtpy.utils.exceptions as MTex
+import mtpy.processing.decimation as MTdc
 
 
 
@@ -84,91 +85,18 @@ def run():
             header = None
             #continue
 
-        if header is not None:
-            old_sampling = header['samplingrate']        
-            new_sampling = old_sampling/decimation_factor
-        
-        
-        new_data = []
-        try:
-            #new_data = []
-            #old_data = []
-            counter = 1
-            tempdata = 0 
-            for line in open(infile):
-                line = line.strip().split()
-                if line[0].startswith('#'):
-                    continue
-                val = float(line[0])
-                tempdata += val
-
-
-                if counter ==  1:
-                    new_data.append(val)#tempdata/decimation_factor)
-                    tempdata = 0
-                counter += 1
-                if counter == (decimation_factor+1):
-                    counter = 1 
-
-            #if counter != 0:
-            #    new_data.append(tempdata/counter)
+        if header is not None and 'nsamples' in header:
+            if header['nsamples']%decimation_factor != 0 :
+                print '\tWarning - decimation of file not continuous due to mismatching decimation factor'
 
-        #except:
-
-                #if val%1==0:
-                #    val = int(val)
-                #old_data.append(val)
-
-            #old_data = np.array(old_data)
+        print 'Decimating file {0} by factor {1} '.format(infile, decimation_factor)
 
-        except:
+        try:
+            MTdc.decimate_file(infile, outfile, decimation_factor, antialias=False)
+        except (MTex.MTpyError_ts_data, ValueError, IOError):
             print '\tERROR - file does not contain single column data: {0} - SKIPPED'.format(infile)
             continue
 
-
-        #len_data = len(old_data)
-        if header is not None:
-            n_samples = header['nsamples'] 
-
-            # if len_data != n_samples:
-            #     print '\tWARNING - header shows wrong number of samples: {0} instead of {1}'.format(n_samples,len_data)
-
-
-        print 'Decimating file {0} by factor {1} '.format(infile, decimation_factor)
-
-        if n_samples%decimation_factor != 0 :
-            print '\tWarning - decimation of file not continuous due to mismatching decimation factor'
-
-        #new_data = old_data[::decimation_factor]
-        
-        # index = 0
-        # while index < len(new_data):
-        #     old_data_index = index * decimation_factor
-        #     try:
-        #         new_data[index] = np.mean(old_data[old_data_index:old_data_index+decimation_factor])
-        #     except:
-        #         new_data[index] = np.mean(old_data[old_data_index:])
-
-        #     index += 1
-
-        Fout = open(outfile,'w')
-
-        if header is not None:
-            header['nsamples'] = len(new_data)
-            header['samplingrate'] = new_sampling
-
-            new_header_line = MTfh.get_ts_header_string(header)
-            
-            Fout.write(new_header_line)
-        
-        for i in new_data:
-            if i%1==0:
-                Fout.write('{0:d}\n'.format(int(i)))
-            else:
-                Fout.write('{0:.8}\n'.format(i))
-        #np.savetxt(Fout,new_data)
-        Fout.close()
-
     print '\nOutput files written to {0}'.format(outpath)
     print '\n...Done\n'
 
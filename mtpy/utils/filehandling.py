@@ -47,6 +47,12 @@ epsilon = 1e-9
 lo_headerelements = ['station', 'channel','samplingrate','t_min',
                     'nsamples','unit','lat','lon','elev']
 
+#length of the header block of binary TS files in bytes
+ts_binary_header_len = 512
+
+#data types of binary TS files (little-endian)
+dict_of_ts_binary_dtypes = {'float32':'<f4', 'float64':'<f8', 'int32':'<i4'}
+
 #=================================================================
 
 def read1columntext(textfile):
@@ -1132,12 +1138,12 @@ def validate_ts_file(tsfile):
         t0 = float(header['t_min'])
         ns = int(float(header['nsamples']))
         
-        data = np.loadtxt(tsfile)
+        data = read_ts_file(tsfile)[-1]
         
         if len(data) != ns:
             #print 'data length'
             raise
-        if data.dtype not in [int, float]:
+        if data.dtype.kind not in ['i', 'f']:
             #print 'data type'
             raise
 
@@ -1263,13 +1269,29 @@ def write_ts_file_from_tuple(outfile,ts_tuple, fmt='%.8e'):
     return outfilename
 
 
-def read_ts_file(mtdatafile):
+def read_ts_file(mtdatafile, mmap=False, dtype=None, sample_range=None, 
+                 use_cache=False):
     """
         Read an MTpy TS data file and provide the content as tuple:
 
         (station, channel,samplingrate,t_min,nsamples,unit,lat,lon,elev, data)
         If header information is incomplete, the tuple is filled up with 'None'
 
+        ASCII files are parsed chunk-wise at C-level (see read_ts_ascii_data),
+        binary TS files are detected automatically and read with 
+        read_ts_binary_file.
+
+        Optional input:
+        - mmap : return a read-only memmap for binary files (or caches)
+        - dtype : Numpy data type of the returned data (default float64 for
+                  ASCII files, the file data type for binary files)
+        - sample_range : (start, stop) - only read samples start to stop-1;
+                         t_min and nsamples of the tuple are adjusted
+        - use_cache : keep a binary copy of ASCII files in a hidden sidecar 
+                      file (see get_ts_cache_filename), which is used for 
+                      subsequent reads as long as the modification time of 
+                      the ASCII file does not change
+
     """
 
     infile = op.abspath(mtdatafile)
@@ -1277,18 +1299,243 @@ def read_ts_file(mtdatafile):
         raise MTex.MTpyError_inputarguments('ERROR - Data file not '
                                                 'existing: {0}'.format(infile))
 
+    if is_binary_ts_file(infile):
+        return read_ts_binary_file(infile, mmap=mmap, dtype=dtype, 
+                                   sample_range=sample_range)
+
+    if use_cache is True:
+        cachefile = get_ts_cache_filename(infile)
+        if not _is_valid_ts_cache(infile, cachefile):
+            _write_ts_cache(infile, cachefile)
+        return read_ts_binary_file(cachefile, mmap=mmap, dtype=dtype, 
+                                   sample_range=sample_range)
+
     header = read_ts_header(infile)
     if len(header) == 0 :
         raise MTex.MTpyError_inputarguments('ERROR - Data file not valid - '
                                         'header is missing : {0}'.format(infile))
 
-    data = np.loadtxt(infile)
-    if len(data) != int(float(header['nsamples'])):
+    nsamples = int(float(header['nsamples']))
+    start, stop = _get_sample_range(sample_range, nsamples)
+
+    data = read_ts_ascii_data(infile, start=start, stop=stop, dtype=dtype)
+    if len(data) != stop - start:
         raise MTex.MTpyError_inputarguments('ERROR - Data file not valid '
                                     '- wrong number of samples in data ({1} '
                                     'instead of {2}): {0}'.format(
-                                    infile,len(data) , int(float(
-                                        header['nsamples']))) )
+                                    infile,len(data) , stop - start) )
+
+    return _get_ts_tuple(header, data, start)
+
+
+def read_ts_ascii_data(tsfile, start=0, stop=None, dtype=None, 
+                       chunksize=2**24):
+    """
+        Read the data of an MTpy ASCII TS data file.
+
+        The file is read in chunks of 'chunksize' bytes, which are parsed at
+        C-level with np.fromstring instead of np.loadtxt. The first 'start' 
+        lines are skipped by counting line breaks without parsing them, and
+        reading stops after sample 'stop'-1. If 'stop' is None, all data 
+        until the end of the file is read.
+
+        Return data as 1D Numpy array of type 'dtype' (default float64).
+    """
+
+    if dtype is None:
+        dtype = np.float64
+
+    lo_data = []
+    n_read = 0
+
+    with open(tsfile,'rb') as F:
+        #skip header, comment and empty lines
+        while True:
+            position = F.tell()
+            line = F.readline()
+            if len(line) == 0:
+                break
+            if len(line.strip()) > 0 and line.strip()[0] != '#':
+                F.seek(position)
+                break
+
+        #skip 'start' lines without parsing them
+        to_skip = start
+        while to_skip > 0:
+            chunk = F.read(chunksize)
+            if len(chunk) == 0:
+                break
+            linebreaks = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8)
+                                         == ord('\n'))
+            if len(linebreaks) < to_skip:
+                to_skip -= len(linebreaks)
+                continue
+            F.seek(F.tell() - len(chunk) + linebreaks[to_skip - 1] + 1)
+            to_skip = 0
+
+        #parse chunks of complete lines
+        remainder = ''
+        while stop is None or n_read < stop - start:
+            chunk = F.read(chunksize)
+            if len(chunk) == 0:
+                chunk = remainder
+                remainder = ''
+            else:
+                chunk = remainder + chunk
+                cut = chunk.rfind('\n') + 1
+                remainder = chunk[cut:]
+                chunk = chunk[:cut]
+            if len(chunk) == 0:
+                if len(remainder) == 0:
+                    break
+                continue
+
+            values = np.fromstring(chunk, dtype=np.float64, sep=' ')
+            if stop is not None:
+                values = values[:stop - start - n_read]
+            lo_data.append(values.astype(dtype))
+            n_read += len(values)
+
+    if len(lo_data) == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.concatenate(lo_data)
+
+
+def iter_ts_data_chunks(filename, chunksize=2**20):
+    """
+    Yield the data of a raw ASCII file or an MTpy (ASCII or binary) TS file 
+    as 2D arrays of at most 'chunksize' rows (one column per data column 
+    of the file). Binary files are read via memmap, ASCII files are parsed 
+    chunkwise with np.fromstring.
+
+    """
+
+    if is_binary_ts_file(filename):
+        data = read_ts_binary_file(filename, mmap=True)[-1]
+        for idx in range(0, len(data), chunksize):
+            chunk = np.array(data[idx:idx + chunksize], dtype=np.float64)
+            yield chunk.reshape(-1, 1)
+        return
+
+    with open(filename, 'rb') as F:
+        #skip header, comment and empty lines and get number of columns
+        n_columns = 0
+        while True:
+            position = F.tell()
+            line = F.readline()
+            if len(line) == 0:
+                return
+            if len(line.strip()) > 0 and line.strip()[0] != '#':
+                n_columns = len(line.split())
+                F.seek(position)
+                break
+
+        #parse chunks of about 'chunksize' lines
+        n_bytes = chunksize * len(line)
+        remainder = ''
+        while True:
+            chunk = F.read(n_bytes)
+            if len(chunk) == 0:
+                chunk = remainder
+                remainder = ''
+            else:
+                chunk = remainder + chunk
+                cut = chunk.rfind('\n') + 1
+                remainder = chunk[cut:]
+                chunk = chunk[:cut]
+            if len(chunk) == 0:
+                if len(remainder) == 0:
+                    break
+                continue
+
+            values = np.fromstring(chunk, dtype=np.float64, sep=' ')
+            if len(values) % n_columns != 0:
+                raise MTex.MTpyError_ts_data('inconsistent number of columns'
+                                             ' in data file: '
+                                             '{0}'.format(filename))
+            yield values.reshape(-1, n_columns)
+
+
+def get_ts_cache_filename(tsfile):
+    """
+        Return the name of the hidden binary sidecar cache file of an 
+        MTpy ASCII TS data file.
+    """
+
+    tsfile = op.abspath(tsfile)
+
+    return op.join(op.dirname(tsfile), '.{0}.tscache'.format(
+                                                        op.basename(tsfile)))
+
+
+def _is_valid_ts_cache(tsfile, cachefile):
+    """
+        Check, if the cache file exists and was made from the current 
+        version (same modification time and size) of the TS data file.
+    """
+
+    try:
+        with open(cachefile, 'rb') as F:
+            headerlines = F.read(ts_binary_header_len).split('\n')
+        sourceline = headerlines[2].split()
+        if sourceline[:2] != ['#', 'source']:
+            return False
+        return (float(sourceline[2]) == round(op.getmtime(tsfile), 6) and
+                int(sourceline[3]) == op.getsize(tsfile))
+    except (IOError, IndexError, ValueError):
+        return False
+
+
+def _write_ts_cache(tsfile, cachefile):
+    """
+        Write the binary sidecar cache (float64) of an MTpy ASCII TS file.
+    """
+
+    mtime = op.getmtime(tsfile)
+    size = op.getsize(tsfile)
+
+    ts_tuple = read_ts_file(tsfile)
+    _write_ts_binary(cachefile, ts_tuple, 'float64', 
+                     lo_extralines=['# source {0:.6f} {1}'.format(mtime, size)])
+
+
+def _get_sample_range(sample_range, nsamples):
+    """
+        Return start and stop index from a (start, stop) tuple, clipped to
+        the number of samples.
+    """
+
+    if sample_range is None:
+        return 0, nsamples
+
+    start, stop = sample_range
+    if start is None:
+        start = 0
+    if stop is None or stop > nsamples:
+        stop = nsamples
+    if start < 0 or start > stop:
+        raise MTex.MTpyError_inputarguments('ERROR - invalid sample range: '
+                                            '{0}'.format(sample_range))
+
+    return int(start), int(stop)
+
+
+def _get_ts_tuple(header, data, start=0):
+    """
+        Return the TS tuple for header dictionary and data. If data starts at
+        sample 'start', t_min and nsamples are adjusted.
+    """
+
+    header = dict(header)
+    if start != 0 or ('nsamples' in header and 
+                      int(float(header['nsamples'])) != len(data)):
+        header['nsamples'] = len(data)
+        try:
+            header['t_min'] = float(header['t_min']) + \
+                                start / float(header['samplingrate'])
+        except (KeyError, ValueError, TypeError):
+            pass
 
     lo_header_contents = []
 
@@ -1303,6 +1550,204 @@ def read_ts_file(mtdatafile):
     return tuple(lo_header_contents)
 
 
+def is_binary_ts_file(tsfile):
+    """
+        Check, if a file is an MTpy binary timeseries (TS) data file.
+
+        Return Boolean value True/False .
+    """
+
+    try:
+        read_ts_binary_header(tsfile)
+    except (MTex.MTpyError_ts_data, MTex.MTpyError_inputarguments, IOError):
+        return False
+
+    return True
+
+
+def read_ts_binary_header(tsfile):
+    """
+        Read in the header of an MTpy binary timeseries data file.
+
+        The header block is 'ts_binary_header_len' bytes long and consists of
+        the standard TS header line (so that read_ts_header works on binary
+        files as well), a line '# binary <data type>' and blank padding.
+
+        Return header as dictionary (see read_ts_header) and the Numpy data 
+        type string of the data block.
+    """
+
+    tsfile = op.abspath(tsfile)
+    if not op.isfile(tsfile):
+        raise MTex.MTpyError_inputarguments('Error - '
+            'input file not existing: {0}'.format(tsfile))
+
+    with open(tsfile,'rb') as F:
+        headerblock = F.read(ts_binary_header_len)
+
+    headerlines = headerblock.split('\n')
+    try:
+        if len(headerblock) != ts_binary_header_len:
+            raise
+        binaryline = headerlines[1].split()
+        if binaryline[:2] != ['#','binary']:
+            raise
+        dtype = dict_of_ts_binary_dtypes[binaryline[2]]
+    except:
+        raise MTex.MTpyError_ts_data('No binary header found -'
+            ' check file: {0}'.format(tsfile))
+
+    header_dict = read_ts_header(tsfile)
+
+    return header_dict, dtype
+
+
+def get_ts_binary_header_block(header_dictionary, dtype, lo_extralines=None):
+    """
+        Return the header block of an MTpy binary TS data file (header line,
+        data type line and optional extra lines, padded to 
+        'ts_binary_header_len' bytes).
+    """
+
+    headerblock = get_ts_header_string(header_dictionary) + \
+                    '# binary {0}\n'.format(dtype)
+    if lo_extralines is not None:
+        headerblock += ''.join([line + '\n' for line in lo_extralines])
+    if len(headerblock) > ts_binary_header_len - 1:
+        raise MTex.MTpyError_inputarguments('ERROR - header too long for'
+                                            ' binary TS file')
+
+    return headerblock.ljust(ts_binary_header_len - 1) + '\n'
+
+
+def _write_ts_binary(outfilename, ts_tuple, dtype, lo_extralines=None):
+    """
+        Write header block and data of an MTpy binary TS data file.
+    """
+
+    header_dict = {}
+    for i in range(len(ts_tuple) -1):
+        if ts_tuple[i] is not None:
+            header_dict[lo_headerelements[i]] = ts_tuple[i]
+
+    headerblock = get_ts_binary_header_block(header_dict, dtype, lo_extralines)
+
+    data = np.asarray(ts_tuple[-1]).astype(dict_of_ts_binary_dtypes[dtype])
+
+    try:
+        outF = open(outfilename,'wb')
+        outF.write(headerblock)
+        data.tofile(outF)
+        outF.close()
+    except (ValueError, IOError):
+        raise MTex.MTpyError_inputarguments('ERROR - could not write content'
+                            ' of TS tuple to file : {0}'.format(outfilename))
+
+
+def write_ts_binary_file_from_tuple(outfile, ts_tuple, dtype='float32'):
+    """
+        Write an MTpy binary TS data file, where the content is provided 
+        as tuple:
+
+        (station, channel,samplingrate,t_min,nsamples,unit,lat,lon,elev, data)
+
+        The file starts with a header block of 'ts_binary_header_len' bytes,
+        followed by the data as little-endian float32, float64 or int32 
+        values, so that it can be memory-mapped. 
+
+        Return the name of the written file.
+    """
+
+    if dtype not in dict_of_ts_binary_dtypes:
+        raise MTex.MTpyError_inputarguments('ERROR - data type must be one of'
+                            ' {0}'.format(sorted(dict_of_ts_binary_dtypes)))
+
+    outfilename = make_unique_filename(outfile)
+
+    _write_ts_binary(outfilename, ts_tuple, dtype)
+
+    return outfilename
+
+
+def read_ts_binary_file(mtdatafile, mmap=False, dtype=None, 
+                        sample_range=None):
+    """
+        Read an MTpy binary TS data file and provide the content as tuple:
+
+        (station, channel,samplingrate,t_min,nsamples,unit,lat,lon,elev, data)
+        If header information is incomplete, the tuple is filled up with 'None'
+
+        If 'mmap' is True, data is a read-only Numpy memmap of the file 
+        instead of an array in memory ('dtype' is ignored then).
+        For 'dtype' and 'sample_range' see read_ts_file.
+    """
+
+    infile = op.abspath(mtdatafile)
+    header, filedtype = read_ts_binary_header(infile)
+
+    nsamples = (op.getsize(infile) - ts_binary_header_len) / \
+                np.dtype(filedtype).itemsize
+
+    if 'nsamples' in header and nsamples != int(float(header['nsamples'])):
+        raise MTex.MTpyError_inputarguments('ERROR - Data file not valid '
+                                    '- wrong number of samples in data ({1} '
+                                    'instead of {2}): {0}'.format(
+                                    infile, nsamples, int(float(
+                                        header['nsamples']))) )
+
+    start, stop = _get_sample_range(sample_range, nsamples)
+    offset = ts_binary_header_len + start * np.dtype(filedtype).itemsize
+
+    if mmap is True:
+        data = np.memmap(infile, dtype=filedtype, mode='r', offset=offset, 
+                         shape=(stop - start,))
+    else:
+        with open(infile,'rb') as F:
+            F.seek(offset)
+            data = np.fromfile(F, dtype=filedtype, count=stop - start)
+        if dtype is not None:
+            data = data.astype(dtype)
+
+    return _get_ts_tuple(header, data, start)
+
+
+def convert_ts_ascii2binary(infile, outfile=None, dtype='float32'):
+    """
+        Convert an MTpy ASCII TS data file into an MTpy binary TS data file.
+
+        If no output file is given, '.bin' is appended to the input file name.
+
+        Return the name of the written file.
+    """
+
+    if outfile is None:
+        outfile = op.abspath(infile) + '.bin'
+
+    return write_ts_binary_file_from_tuple(outfile, read_ts_file(infile), 
+                                           dtype=dtype)
+
+
+def convert_ts_binary2ascii(infile, outfile=None, fmt='%.8e'):
+    """
+        Convert an MTpy binary TS data file into an MTpy ASCII TS data file.
+
+        If no output file is given, a trailing '.bin' is removed from the 
+        input file name (or '.asc' is appended otherwise).
+
+        Return the name of the written file.
+    """
+
+    if outfile is None:
+        outfile = op.abspath(infile)
+        if outfile.endswith('.bin'):
+            outfile = outfile[:-4]
+        else:
+            outfile += '.asc'
+
+    return write_ts_file_from_tuple(outfile, read_ts_binary_file(infile), 
+                                    fmt=fmt)
+
+
 def reorient_files(lo_files, configfile, lo_stations = None, outdir = None):
 
     #read config file